@@ -85,13 +85,11 @@ import socket
 import threading
 import select
 import traceback
+import heapq
+import Queue
 
 __all__ = ["Zeroconf", "ServiceInfo", "ServiceBrowser"]
 
-# hook for threads
-
-globals()['_GLOBAL_DONE'] = 0
-
 # Some timing constants
 
 _UNREGISTER_TIME = 125
@@ -323,6 +321,11 @@ class DNSRecord(DNSEntry):
         self.created = other.created
         self.ttl = other.ttl
 
+    def dataKey(self):
+        """Returns the record's data in a hashable form, which together
+        with its name, type and class identifies it in a DNSCache"""
+        return None
+
     def write(self, out):
         """Abstract method"""
         raise AbstractMethodException
@@ -349,6 +352,10 @@ class DNSAddress(DNSRecord):
             return self.address == other.address
         return 0
 
+    def dataKey(self):
+        """Returns the record's data in a hashable form"""
+        return self.address
+
     def __repr__(self):
         """String representation"""
         try:
@@ -375,6 +382,10 @@ class DNSHinfo(DNSRecord):
             return self.cpu == other.cpu and self.os == other.os
         return 0
 
+    def dataKey(self):
+        """Returns the record's data in a hashable form"""
+        return (self.cpu, self.os)
+
     def __repr__(self):
         """String representation"""
         return self.cpu + " " + self.os
@@ -396,6 +407,10 @@ class DNSPointer(DNSRecord):
             return self.alias == other.alias
         return 0
 
+    def dataKey(self):
+        """Returns the record's data in a hashable form"""
+        return self.alias
+
     def __repr__(self):
         """String representation"""
         return self.toString(self.alias)
@@ -417,6 +432,10 @@ class DNSText(DNSRecord):
             return self.text == other.text
         return 0
 
+    def dataKey(self):
+        """Returns the record's data in a hashable form"""
+        return self.text
+
     def __repr__(self):
         """String representation"""
         if len(self.text) > 10:
@@ -447,6 +466,10 @@ class DNSService(DNSRecord):
             return self.priority == other.priority and self.weight == other.weight and self.port == other.port and self.server == other.server
         return 0
 
+    def dataKey(self):
+        """Returns the record's data in a hashable form"""
+        return (self.priority, self.weight, self.port, self.server)
+
     def __repr__(self):
         """String representation"""
         return self.toString("%s:%s" % (self.server, self.port))
@@ -772,35 +795,77 @@ class DNSOutgoing(object):
 
 
 class DNSCache(object):
-    """A cache of DNS entries"""
+    """A cache of DNS entries, indexed by name, type, class and data so
+    that lookups don't depend on how many entries there are, with a heap
+    of expiration times so that expired entries can be found without
+    looking at the rest"""
     
     def __init__(self):
+        # maps key to a dict of entries keyed by (type, class, data)
         self.cache = {}
+        # (expiration time, entry) pairs; an entry's TTL may have been
+        # reset since it was pushed, so times are checked when popped
+        self.expirations = []
+        self.lock = threading.RLock()
+
+    def _slot(self, entry):
+        return (entry.type, entry.clazz, entry.dataKey())
+
+    def _schedule(self, entry):
+        expires = entry.getExpirationTime(100)
+        # a later expiration is picked up when the earlier one comes
+        # round, so each entry is in the heap only once or twice
+        if getattr(entry, 'scheduled', None) is None or expires < entry.scheduled:
+            entry.scheduled = expires
+            heapq.heappush(self.expirations, (expires, id(entry), entry))
 
     def add(self, entry):
         """Adds an entry"""
+        self.lock.acquire()
         try:
-            list = self.cache[entry.key]
-        except:
-            list = self.cache[entry.key] = []
-        list.append(entry)
+            self.cache.setdefault(entry.key, {})[self._slot(entry)] = entry
+            self._schedule(entry)
+        finally:
+            self.lock.release()
 
     def remove(self, entry):
         """Removes an entry"""
+        self.lock.acquire()
         try:
-            list = self.cache[entry.key]
-            list.remove(entry)
-        except:
-            pass
+            entries = self.cache.get(entry.key)
+            if entries is not None and entries.get(self._slot(entry)) is entry:
+                del entries[self._slot(entry)]
+                if not entries:
+                    del self.cache[entry.key]
+        finally:
+            self.lock.release()
+
+    def resetTTL(self, entry, other):
+        """Sets the TTL of a cached entry to that of another record"""
+        self.lock.acquire()
+        try:
+            entry.resetTTL(other)
+            self._schedule(entry)
+        finally:
+            self.lock.release()
 
     def get(self, entry):
         """Gets an entry by key.  Will return None if there is no
-        matching entry."""
+        matching entry.  Records are matched on their data too, other
+        entries only on name, type and class."""
+        self.lock.acquire()
         try:
-            list = self.cache[entry.key]
-            return list[list.index(entry)]
-        except:
+            entries = self.cache.get(entry.key)
+            if not entries:
+                return None
+            if isinstance(entry, DNSRecord):
+                return entries.get(self._slot(entry))
+            for record in entries.values():
+                if record.type == entry.type and record.clazz == entry.clazz:
+                    return record
             return None
+        finally:
+            self.lock.release()
 
     def getByDetails(self, name, type, clazz):
         """Gets an entry by details.  Will return None if there is
@@ -810,27 +875,71 @@ class DNSCache(object):
 
     def entriesWithName(self, name):
         """Returns a list of entries whose key matches the name."""
+        self.lock.acquire()
         try:
-            return self.cache[name]
-        except:
-            return []
+            return self.cache.get(name.lower(), {}).values()
+        finally:
+            self.lock.release()
 
     def entries(self):
         """Returns a list of all entries"""
-        def add(x, y): return x+y
+        self.lock.acquire()
         try:
-            return reduce(add, self.cache.values())
-        except:
-            return []
+            result = []
+            for entries in self.cache.values():
+                result.extend(entries.values())
+            return result
+        finally:
+            self.lock.release()
+
+    def expire(self, now):
+        """Removes the entries which have expired by now, and returns
+        them"""
+        expired = []
+        self.lock.acquire()
+        try:
+            while self.expirations and self.expirations[0][0] <= now:
+                (expires, ignored, entry) = heapq.heappop(self.expirations)
+                if entry.scheduled != expires:
+                    # superseded by an earlier expiration
+                    continue
+                entry.scheduled = None
+                if self.get(entry) is not entry:
+                    continue
+                if entry.isExpired(now):
+                    self.remove(entry)
+                    expired.append(entry)
+                else:
+                    # its TTL has been reset since
+                    self._schedule(entry)
+        finally:
+            self.lock.release()
+        return expired
+
+    def nextExpiration(self):
+        """Returns the time the next entry is due to expire, or None if
+        the cache is empty"""
+        self.lock.acquire()
+        try:
+            if self.expirations:
+                return self.expirations[0][0]
+            return None
+        finally:
+            self.lock.release()
 
 
 class Engine(threading.Thread):
-    """An engine wraps read access to sockets, allowing objects that
-    need to receive data from sockets to be called back when the
-    sockets are ready.
+    """The engine is the one thread a Zeroconf instance runs.  It waits
+    on sockets with select(), calling readers back when their sockets
+    are ready, and in between runs timers when they are due, so that
+    browsing, listener callbacks and cache expiry all happen in the same
+    loop rather than each needing a thread of its own.
 
     A reader needs a handle_read() method, which is called when the socket
-    it is interested in is ready for reading.
+    it is interested in is ready for reading.  A timer needs a
+    handle_timer(now) method, which is called when it is due and returns
+    the time (in milliseconds) it is next due, or None if it has nothing
+    more to do until it is woken with notify().
 
     Writers are not implemented here, because we only send short
     packets.
@@ -840,32 +949,67 @@ class Engine(threading.Thread):
         threading.Thread.__init__(self)
         self.zeroconf = zeroconf
         self.readers = {} # maps socket to reader
+        self.timers = {} # maps timer to the time it is next due
         self.timeout = 5
         self.condition = threading.Condition()
+        # notify() sends a byte to this socket to wake the loop up
+        self.waker = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.waker.bind(('127.0.0.1', 0))
+        self.waker.setblocking(0)
         self.daemon = True
         self.start()
 
     def run(self):
-        while not globals()['_GLOBAL_DONE']:
-            rs = self.getReaders()
-            if len(rs) == 0:
-                # No sockets to manage, but we wait for the timeout
-                # or addition of a socket
-                #
-                self.condition.acquire()
-                self.condition.wait(self.timeout)
-                self.condition.release()
-            else:
-                try:
-                    rr, wr, er = select.select(rs, [], [], self.timeout)
-                    for socket in rr:
-                        try:
-                            self.readers[socket].handle_read()
-                        except:
-                            # Ignore errors that occur on shutdown
-                            pass
-                except:
-                    pass
+        while not self.zeroconf.done:
+            nextTime = self.runTimers(currentTimeMillis())
+            timeout = self.timeout
+            if nextTime is not None:
+                timeout = min(timeout, max(0, (nextTime - currentTimeMillis()) / 1000))
+            rs = self.getReaders() + [self.waker]
+            try:
+                rr, wr, er = select.select(rs, [], [], timeout)
+                for socket in rr:
+                    if socket is self.waker:
+                        self.drainWaker()
+                        continue
+                    try:
+                        self.readers[socket].handle_read()
+                    except:
+                        # Ignore errors that occur on shutdown
+                        pass
+            except:
+                pass
+
+    def runTimers(self, now):
+        """Runs the timers which are due, and returns the time the next
+        one is due"""
+        self.condition.acquire()
+        due = [timer for (timer, when) in self.timers.items()
+               if when is not None and when <= now]
+        self.condition.release()
+        for timer in due:
+            try:
+                when = timer.handle_timer(now)
+            except:
+                traceback.print_exc()
+                when = None
+            self.condition.acquire()
+            if timer in self.timers:
+                self.timers[timer] = when
+            self.condition.release()
+        self.condition.acquire()
+        times = [when for when in self.timers.values() if when is not None]
+        self.condition.release()
+        if times:
+            return min(times)
+        return None
+
+    def drainWaker(self):
+        try:
+            while self.waker.recv(64):
+                pass
+        except socket.error:
+            pass
 
     def getReaders(self):
         result = []
@@ -877,19 +1021,82 @@ class Engine(threading.Thread):
     def addReader(self, reader, socket):
         self.condition.acquire()
         self.readers[socket] = reader
-        self.condition.notify()
         self.condition.release()
+        self.notify()
 
     def delReader(self, socket):
         self.condition.acquire()
         del(self.readers[socket])
-        self.condition.notify()
         self.condition.release()
+        self.notify()
 
-    def notify(self):
+    def addTimer(self, timer, when=0):
+        """Adds a timer, first due at when (by default straight away)"""
+        self.wakeTimer(timer, when)
+
+    def wakeTimer(self, timer, when=0):
+        """Makes a timer due at when, if that's earlier than it already
+        is (by default straight away)"""
         self.condition.acquire()
-        self.condition.notify()
+        current = self.timers.get(timer)
+        if current is None or when < current:
+            self.timers[timer] = when
         self.condition.release()
+        self.notify()
+
+    def delTimer(self, timer):
+        self.condition.acquire()
+        self.timers.pop(timer, None)
+        self.condition.release()
+        self.notify()
+
+    def notify(self):
+        """Wakes the loop up, so that it picks up changes to readers
+        and timers"""
+        if threading.currentThread() is self:
+            # it'll look at them again before it next waits
+            return
+        try:
+            self.waker.sendto('x', self.waker.getsockname())
+        except socket.error:
+            pass
+
+    def close(self):
+        self.notify()
+        if threading.currentThread() is not self:
+            self.join(self.timeout + 1)
+        self.waker.close()
+
+class Dispatcher(threading.Thread):
+    """Calls browser listeners back, in the order their events happened,
+    on a thread of its own rather than the engine's, so that a listener
+    may block, e.g. in getServiceInfo() waiting for replies the engine
+    reads, without holding up all other traffic."""
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.queue = Queue.Queue()
+        self.daemon = True
+        self.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            (callback, args) = item
+            try:
+                callback(*args)
+            except:
+                traceback.print_exc()
+
+    def dispatch(self, callback, *args):
+        self.queue.put((callback, args))
+
+    def close(self):
+        self.queue.put(None)
+        if threading.currentThread() is not self:
+            self.join(1)
 
 class Listener(object):
     """A Listener is used by this module to listen on the multicast
@@ -906,54 +1113,20 @@ class Listener(object):
     def handle_read(self):
         data, (addr, port) = self.zeroconf.socket.recvfrom(_MAX_MSG_ABSOLUTE)
         self.data = data
-        msg = DNSIncoming(data)
-        if msg.isQuery():
-            # Always multicast responses
-            #
-            if port == _MDNS_PORT:
-                self.zeroconf.handleQuery(msg, _MDNS_ADDR, _MDNS_PORT)
-            # If it's not a multicast query, reply via unicast
-            # and multicast
-            #
-            elif port == _DNS_PORT:
-                self.zeroconf.handleQuery(msg, addr, port)
-                self.zeroconf.handleQuery(msg, _MDNS_ADDR, _MDNS_PORT)
-        else:
-            self.zeroconf.handleResponse(msg)
-
-
-class Reaper(threading.Thread):
-    """A Reaper is used by this module to remove cache entries that
-    have expired."""
-    
-    def __init__(self, zeroconf):
-        threading.Thread.__init__(self)
-        self.daemon = True
-        self.zeroconf = zeroconf
-        self.start()
-
-    def run(self):
-        while 1:
-            self.zeroconf.wait(10 * 1000)
-            if globals()['_GLOBAL_DONE']:
-                return
-            now = currentTimeMillis()
-            for record in self.zeroconf.cache.entries():
-                if record.isExpired(now):
-                    self.zeroconf.updateRecord(now, record)
-                    self.zeroconf.cache.remove(record)
+        self.zeroconf.handlePacket(data, addr, port)
 
 
-class ServiceBrowser(threading.Thread):
+class ServiceBrowser(object):
     """Used to browse for a service of a specific type.
 
     The listener object will have its addService() and
     removeService() methods called when this browser
-    discovers changes in the services availability."""
+    discovers changes in the services availability.  Queries are
+    sent from the Zeroconf instance's engine thread, and the listener
+    called from its dispatcher thread, so it may call getServiceInfo()."""
     
     def __init__(self, zeroconf, type, listener):
         """Creates a browser for a specific type"""
-        threading.Thread.__init__(self)
         self.zeroconf = zeroconf
         self.type = type
         self.listener = listener
@@ -961,12 +1134,11 @@ class ServiceBrowser(threading.Thread):
         self.nextTime = currentTimeMillis()
         self.delay = _BROWSER_TIME
         self.list = []
-        self.daemon = True
 
         self.done = 0
 
         self.zeroconf.addListener(self, DNSQuestion(self.type, _TYPE_PTR, _CLASS_IN))
-        self.start()
+        self.zeroconf.engine.addTimer(self)
 
     def updateRecord(self, zeroconf, now, record):
         """Callback invoked by Zeroconf when new information arrives.
@@ -982,46 +1154,51 @@ class ServiceBrowser(threading.Thread):
                     del(self.services[record.alias.lower()])
                     callback = lambda x: self.listener.removeService(x, self.type, record.alias)
                     self.list.append(callback)
+                    self.zeroconf.engine.wakeTimer(self)
                     return
-            except:
+            except KeyError:
                 if not expired:
                     self.services[record.alias.lower()] = record
                     callback = lambda x: self.listener.addService(x, self.type, record.alias)
                     self.list.append(callback)
+                    self.zeroconf.engine.wakeTimer(self)
 
             expires = record.getExpirationTime(75)
             if expires < self.nextTime:
                 self.nextTime = expires
+                self.zeroconf.engine.wakeTimer(self, expires)
 
     def cancel(self):
         self.done = 1
-        self.zeroconf.notifyAll()
+        self.zeroconf.engine.delTimer(self)
+        self.zeroconf.removeListener(self)
 
-    def run(self):
-        while 1:
-            event = None
-            now = currentTimeMillis()
-            if len(self.list) == 0 and self.nextTime > now:
-                self.zeroconf.wait(self.nextTime - now)
-            if globals()['_GLOBAL_DONE'] or self.done:
-                return
-            now = currentTimeMillis()
+    def handle_timer(self, now):
+        """Called by the engine when a query or listener callbacks are
+        due.  Returns when it next needs calling."""
+        if self.zeroconf.done or self.done:
+            return None
 
-            if self.nextTime <= now:
-                out = DNSOutgoing(_FLAGS_QR_QUERY)
-                out.addQuestion(DNSQuestion(self.type, _TYPE_PTR, _CLASS_IN))
-                for record in self.services.values():
-                    if not record.isExpired(now):
-                        out.addAnswerAtTime(record, now)
-                self.zeroconf.send(out)
-                self.nextTime = now + self.delay
-                self.delay = min(20 * 1000, self.delay * 2)
-
-            if len(self.list) > 0:
-                event = self.list.pop(0)
-
-            if event is not None:
-                event(self.zeroconf)
+        if self.nextTime <= now:
+            out = DNSOutgoing(_FLAGS_QR_QUERY)
+            out.addQuestion(DNSQuestion(self.type, _TYPE_PTR, _CLASS_IN))
+            for record in self.services.values():
+                if not record.isExpired(now):
+                    out.addAnswerAtTime(record, now)
+            self.zeroconf.send(out)
+            self.nextTime = now + self.delay
+            self.delay = min(20 * 1000, self.delay * 2)
+
+        while self.list:
+            self.zeroconf.dispatcher.dispatch(self.runEvent, self.list.pop(0))
+
+        return self.nextTime
+
+    def runEvent(self, event):
+        """Called by the dispatcher to pass an event on to the listener,
+        unless the browser has been cancelled in the meantime"""
+        if not self.done:
+            event(self.zeroconf)
                 
 
 class ServiceInfo(object):
@@ -1238,8 +1415,11 @@ class Zeroconf(object):
     """
     def __init__(self, bindaddress=None):
         """Creates an instance of the Zeroconf class, establishing
-        multicast communications, listening and reaping threads."""
-        globals()['_GLOBAL_DONE'] = 0
+        multicast communications and the thread which listens for
+        packets and reaps expired cache entries."""
+        # set by close(), ending this instance's engine but not those of
+        # any other instances in the process
+        self.done = 0
         if bindaddress is None:
             self.intf = socket.gethostbyname(socket.gethostname())
         else:
@@ -1280,9 +1460,10 @@ class Zeroconf(object):
 
         self.condition = threading.Condition()
         
+        self.dispatcher = Dispatcher()
         self.engine = Engine(self)
         self.listener = Listener(self)
-        self.reaper = Reaper(self)
+        self.engine.addTimer(self, None)
 
     def isLoopback(self):
         return self.intf.startswith("127.0.0.1")
@@ -1446,28 +1627,54 @@ class Zeroconf(object):
     def updateRecord(self, now, rec):
         """Used to notify listeners of new information that has updated
         a record."""
-        for listener in self.listeners:
+        for listener in list(self.listeners):
             listener.updateRecord(self, now, rec)
         self.notifyAll()
 
+    def handle_timer(self, now):
+        """Called by the engine when cache entries are due to expire.
+        Removes them, telling listeners they have gone."""
+        for record in self.cache.expire(now):
+            self.updateRecord(now, record)
+        return self.cache.nextExpiration()
+
+    def handlePacket(self, data, addr, port):
+        """Deal with a packet received from addr and port"""
+        msg = DNSIncoming(data)
+        if msg.isQuery():
+            # Always multicast responses
+            #
+            if port == _MDNS_PORT:
+                self.handleQuery(msg, _MDNS_ADDR, _MDNS_PORT)
+            # If it's not a multicast query, reply via unicast
+            # and multicast
+            #
+            elif port == _DNS_PORT:
+                self.handleQuery(msg, addr, port)
+                self.handleQuery(msg, _MDNS_ADDR, _MDNS_PORT)
+        else:
+            self.handleResponse(msg)
+
     def handleResponse(self, msg):
         """Deal with incoming response packets.  All answers
         are held in the cache, and listeners are notified."""
         now = currentTimeMillis()
         for record in msg.answers:
             expired = record.isExpired(now)
-            if record in self.cache.entries():
+            entry = self.cache.get(record)
+            if entry is not None:
                 if expired:
-                    self.cache.remove(record)
+                    self.cache.remove(entry)
                 else:
-                    entry = self.cache.get(record)
-                    if entry is not None:
-                        entry.resetTTL(record)
-                        record = entry
-            else:
+                    self.cache.resetTTL(entry, record)
+                    record = entry
+            elif not expired:
                 self.cache.add(record)
                 
             self.updateRecord(now, record)
+        nextExpiration = self.cache.nextExpiration()
+        if nextExpiration is not None:
+            self.engine.wakeTimer(self, nextExpiration)
 
     def handleQuery(self, msg, addr, port):
         """Deal with incoming query packets.  Provides a response if
@@ -1528,13 +1735,15 @@ class Zeroconf(object):
     def close(self):
         """Ends the background threads, and prevent this instance from
         servicing further queries."""
-        if globals()['_GLOBAL_DONE'] == 0:
-            globals()['_GLOBAL_DONE'] = 1
+        if not self.done:
+            self.done = 1
             self.notifyAll()
             self.engine.notify()
             self.unregisterAllServices()
             self.socket.setsockopt(socket.SOL_IP, socket.IP_DROP_MEMBERSHIP, socket.inet_aton(_MDNS_ADDR) + socket.inet_aton('0.0.0.0'))
             self.socket.close()
+            self.engine.close()
+            self.dispatcher.close()
             
 # Test a few module features, including service registration, service
 # query (for Zoe), and service unregistration.
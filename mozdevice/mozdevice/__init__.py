@@ -5,4 +5,12 @@
 from devicemanager import DMError
 from devicemanagerADB import DeviceManagerADB
 from devicemanagerSUT import DeviceManagerSUT
-from droid import DroidADB, DroidSUT, DroidConnectByHWID
+from droid import DroidADB, DroidSUT, DroidConnectByHWID, DroidDiscoverAll
+from devicepool import DevicePool, DeviceResult
+from rebootmonitor import RebootMonitor, RebootHandle
+from adbclient import ADBClient
+from logcat import LogcatStreamer
+from capabilitycache import CapabilityCache
+from processtable import ProcessTable
+from metrics import DeviceMetrics
+from discovery import DeviceRegistry, DiscoveryService
@@ -0,0 +1,357 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Client for the adb server's TCP protocol, so adb commands can be run
+without starting the adb binary
+"""
+
+import os
+import socket
+import stat
+import struct
+import threading
+import time
+
+from devicemanager import DMError, _ShellOutput
+
+# shell protocol v2 packet ids
+_SHELL_STDOUT = 1
+_SHELL_STDERR = 2
+_SHELL_EXIT = 3
+_SHELL_CLOSE_STDIN = 4
+
+# largest DATA packet the sync protocol allows
+SYNC_DATA_MAX = 64 * 1024
+
+class ADBClient(object):
+    """
+    Talks to the adb server (normally on localhost:5037) directly, for
+    host: commands, shell: commands with their exact exit status, and
+    sync: file transfers.
+
+    Host and shell commands each need a connection of their own, as the adb
+    server closes it once they are done; a single sync connection is kept
+    open and reused for every stat, list, push and pull.
+    """
+
+    def __init__(self, serial=None, host='127.0.0.1', port=5037, timeout=300):
+        """
+        serial - device to talk to, or None for the only one connected
+        timeout - seconds to wait for the adb server before giving up
+        """
+        self.serial = serial
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._sync = None
+        self._syncLock = threading.Lock()
+        # None until we know whether the device supports shell protocol v2
+        self._shellV2 = None
+
+    def _connect(self, timeout=None):
+        try:
+            return socket.create_connection((self.host, self.port),
+                                            timeout or self.timeout)
+        except socket.error, e:
+            raise DMError("Unable to connect to adb server at %s:%s: %s" %
+                          (self.host, self.port, e))
+
+    @staticmethod
+    def _applyDeadline(sock, deadline):
+        """
+        Limits the next operation on sock to the time left until deadline,
+        raising socket.timeout if there is none left
+        """
+        if deadline is None:
+            return
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise socket.timeout("timed out")
+        sock.settimeout(remaining)
+
+    @classmethod
+    def _recvExactly(cls, sock, length, deadline=None):
+        data = []
+        while length:
+            cls._applyDeadline(sock, deadline)
+            chunk = sock.recv(min(length, SYNC_DATA_MAX))
+            if not chunk:
+                raise DMError("adb server closed the connection unexpectedly")
+            data.append(chunk)
+            length -= len(chunk)
+        return ''.join(data)
+
+    def _request(self, sock, request):
+        """
+        Sends a request to the adb server, raising DMError if it fails
+        """
+        sock.sendall('%04x%s' % (len(request), request))
+        status = self._recvExactly(sock, 4)
+        if status == 'OKAY':
+            return
+        if status == 'FAIL':
+            raise DMError("adb server refused '%s': %s" %
+                          (request, self._recvString(sock)))
+        raise DMError("Unexpected response from adb server: %r" % status)
+
+    def _recvString(self, sock):
+        return self._recvExactly(sock, int(self._recvExactly(sock, 4), 16))
+
+    def _transport(self, timeout=None):
+        """
+        Returns a connection switched over to talking to the device
+        """
+        sock = self._connect(timeout)
+        try:
+            if self.serial:
+                self._request(sock, 'host:transport:%s' % self.serial)
+            else:
+                self._request(sock, 'host:transport-any')
+        except:
+            sock.close()
+            raise
+        return sock
+
+    def hostCommand(self, command):
+        """
+        Runs a host: command on the adb server, e.g. 'version' or 'devices'
+
+        returns: the server's reply
+        """
+        sock = self._connect()
+        try:
+            self._request(sock, 'host:' + command)
+            return self._recvString(sock)
+        except socket.error, e:
+            raise DMError("Error talking to adb server: %s" % e)
+        finally:
+            sock.close()
+
+    def devices(self):
+        """
+        returns: list of (serial, state) tuples for the devices adb knows of
+        """
+        return [tuple(line.split('\t', 1)) for line in
+                self.hostCommand('devices').splitlines() if '\t' in line]
+
+    def getState(self):
+        """
+        returns: the state of the device, e.g. 'device' or 'offline'
+        """
+        if self.serial:
+            sock = self._connect()
+            try:
+                self._request(sock, 'host-serial:%s:get-state' % self.serial)
+                return self._recvString(sock)
+            finally:
+                sock.close()
+        return self.hostCommand('get-state')
+
+    def shell(self, cmdline, outputfile, timeout=None):
+        """
+        Runs cmdline on the device, streaming its output (stdout and stderr)
+        to outputfile as it arrives. Like DeviceManager.shell, outputfile
+        can also be a function to call with each line of output. The command
+        is given timeout seconds in all, however much output it sends.
+
+        returns: the command's exit code
+        """
+        output = _ShellOutput(outputfile)
+        deadline = time.time() + (timeout or self.timeout)
+        if self._shellV2 is not False:
+            sock = self._transport(timeout)
+            try:
+                try:
+                    self._request(sock, 'shell,v2,raw:' + cmdline)
+                    self._shellV2 = True
+                except DMError:
+                    if self._shellV2:
+                        raise
+                    # an older device: fall back to the plain shell service
+                    self._shellV2 = False
+                else:
+                    return self._shellV2Output(sock, output, deadline)
+            except socket.timeout:
+                raise DMError("Timeout exceeded for shell call", timeout=True)
+            except socket.error, e:
+                raise DMError("Error talking to adb server: %s" % e)
+            finally:
+                sock.close()
+
+        # the plain shell service doesn't report the exit code, so echo it
+        sock = self._transport(timeout)
+        try:
+            self._request(sock, 'shell:(%s); echo $?' % cmdline)
+            return self._shellV1Output(sock, output, deadline)
+        except socket.timeout:
+            raise DMError("Timeout exceeded for shell call", timeout=True)
+        except socket.error, e:
+            raise DMError("Error talking to adb server: %s" % e)
+        finally:
+            sock.close()
+
+    def _shellV2Output(self, sock, output, deadline):
+        sock.sendall(struct.pack('<BI', _SHELL_CLOSE_STDIN, 0))
+        while True:
+            (packetId, length) = struct.unpack('<BI', self._recvExactly(sock, 5, deadline))
+            data = self._recvExactly(sock, length, deadline)
+            if packetId in (_SHELL_STDOUT, _SHELL_STDERR):
+                output.write(data)
+            elif packetId == _SHELL_EXIT:
+                output.finish()
+                return ord(data[0])
+
+    def _shellV1Output(self, sock, output, deadline):
+        # the last line, which is the exit code, is held back until the end
+        while True:
+            self._applyDeadline(sock, deadline)
+            data = sock.recv(SYNC_DATA_MAX)
+            if not data:
+                break
+            output.write(data)
+
+        m = output.finish('([0-9]+)\s*$')
+        if not m:
+            raise DMError("Unable to find exit code of shell command")
+        return int(m.group(1))
+
+    def _syncRequest(self, command, path):
+        self._sync.sendall(command + struct.pack('<I', len(path)) + path)
+
+    def _syncCall(self, func, *args):
+        """
+        Calls func(*args) with the shared sync connection open, dropping the
+        connection if anything goes wrong in the middle of a transfer
+        """
+        with self._syncLock:
+            try:
+                if not self._sync:
+                    self._sync = self._transport()
+                    self._request(self._sync, 'sync:')
+                return func(*args)
+            except DMError:
+                self._closeSync()
+                raise
+            except (socket.error, IOError), e:
+                self._closeSync()
+                raise DMError("Error talking to adb server: %s" % e)
+
+    def _closeSync(self):
+        if self._sync:
+            try:
+                self._sync.close()
+            except socket.error:
+                pass
+            self._sync = None
+
+    def _syncFail(self, status):
+        if status == 'FAIL':
+            raise DMError("adb sync failed: %s" % self._recvExactly(
+                    self._sync, struct.unpack('<I', self._recvExactly(self._sync, 4))[0]))
+        raise DMError("Unexpected adb sync response: %r" % status)
+
+    def stat(self, path):
+        """
+        returns: (mode, size, mtime) for path on the device, or None if it
+                 doesn't exist
+        """
+        def doStat():
+            self._syncRequest('STAT', path)
+            status = self._recvExactly(self._sync, 4)
+            if status != 'STAT':
+                self._syncFail(status)
+            (mode, size, mtime) = struct.unpack('<III', self._recvExactly(self._sync, 12))
+            if mode == 0:
+                return None
+            return (mode, size, mtime)
+        return self._syncCall(doStat)
+
+    def isDir(self, path):
+        st = self.stat(path)
+        return st is not None and stat.S_ISDIR(st[0])
+
+    def listDir(self, path):
+        """
+        returns: list of (name, mode, size, mtime) tuples for the entries of
+                 the directory path on the device ('.' and '..' excluded)
+        """
+        def doList():
+            self._syncRequest('LIST', path)
+            entries = []
+            while True:
+                status = self._recvExactly(self._sync, 4)
+                if status not in ('DENT', 'DONE'):
+                    self._syncFail(status)
+                (mode, size, mtime, namelen) = struct.unpack(
+                    '<IIII', self._recvExactly(self._sync, 16))
+                if status == 'DONE':
+                    return entries
+                name = self._recvExactly(self._sync, namelen)
+                if name not in ('.', '..'):
+                    entries.append((name, mode, size, mtime))
+        return self._syncCall(doList)
+
+    def push(self, localFile, remotePath, mode=0644):
+        """
+        Copies localFile (a path or file object) from the host to remotePath
+        on the device
+        """
+        def doPush(f):
+            self._syncRequest('SEND', '%s,%d' % (remotePath, mode))
+            while True:
+                data = f.read(SYNC_DATA_MAX)
+                if not data:
+                    break
+                self._sync.sendall('DATA' + struct.pack('<I', len(data)) + data)
+            self._sync.sendall('DONE' + struct.pack('<I', int(time.time())))
+            status = self._recvExactly(self._sync, 4)
+            if status != 'OKAY':
+                self._syncFail(status)
+            self._recvExactly(self._sync, 4)
+
+        if isinstance(localFile, basestring):
+            with open(localFile, 'rb') as f:
+                return self._syncCall(doPush, f)
+        return self._syncCall(doPush, localFile)
+
+    def pull(self, remotePath, localFile):
+        """
+        Copies remotePath on the device to localFile (a path or file object)
+        on the host, streaming it in pieces
+        """
+        def doPull(f):
+            self._syncRequest('RECV', remotePath)
+            while True:
+                status = self._recvExactly(self._sync, 4)
+                length = struct.unpack('<I', self._recvExactly(self._sync, 4))[0]
+                if status == 'DONE':
+                    return
+                if status != 'DATA':
+                    if status == 'FAIL':
+                        raise DMError("adb sync failed: %s" %
+                                      self._recvExactly(self._sync, length))
+                    self._syncFail(status)
+                f.write(self._recvExactly(self._sync, length))
+
+        if isinstance(localFile, basestring):
+            try:
+                with open(localFile, 'wb') as f:
+                    return self._syncCall(doPull, f)
+            except DMError:
+                os.remove(localFile)
+                raise
+        return self._syncCall(doPull, localFile)
+
+    def close(self):
+        """
+        Closes the shared sync connection
+        """
+        with self._syncLock:
+            if self._sync:
+                try:
+                    self._syncRequest('QUIT', '')
+                except socket.error:
+                    pass
+            self._closeSync()
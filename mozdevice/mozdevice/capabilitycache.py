@@ -0,0 +1,93 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Remembers what devices can do across processes, so that device managers
+don't have to probe a device they have seen recently all over again
+"""
+
+import json
+import os
+import tempfile
+import time
+
+class CapabilityCache(object):
+    """
+    A JSON file of the capabilities found for each device (root, run-as,
+    unzip, device root and so on), keyed by serial number and build
+    fingerprint, so that flashing a new build invalidates them. Entries
+    older than ttl seconds are ignored.
+
+    The file is rewritten atomically, so any number of processes can share
+    it; if two of them update it at once, one of the updates is lost, which
+    only means that device gets probed again next time.
+    """
+
+    def __init__(self, path=None, ttl=24 * 60 * 60):
+        """
+        path - cache file, defaults to ~/.mozdevice/capabilities.json
+        ttl - seconds an entry stays valid for
+        """
+        if not path:
+            path = os.path.join(os.path.expanduser('~'), '.mozdevice',
+                                'capabilities.json')
+        self.path = path
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(serial, fingerprint):
+        return '%s %s' % (serial, fingerprint)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        return entries
+
+    def get(self, serial, fingerprint):
+        """
+        returns: dict of the capabilities stored for the device, or None if
+                 there are none or they have expired
+        """
+        entry = self._load().get(self._key(serial, fingerprint))
+        if not entry or time.time() - entry.get('time', 0) > self.ttl:
+            return None
+        return entry.get('capabilities')
+
+    def put(self, serial, fingerprint, capabilities):
+        """
+        Stores a dict of capabilities for the device, dropping any expired
+        entries on the way
+        """
+        now = time.time()
+        entries = dict((key, entry) for (key, entry) in self._load().iteritems()
+                       if now - entry.get('time', 0) <= self.ttl)
+        entries[self._key(serial, fingerprint)] = { 'time': now,
+                                                    'capabilities': capabilities }
+        self._save(entries)
+
+    def remove(self, serial, fingerprint):
+        """
+        Forgets the capabilities stored for a device
+        """
+        entries = self._load()
+        if entries.pop(self._key(serial, fingerprint), None) is not None:
+            self._save(entries)
+
+    def _save(self, entries):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            (fd, tmpPath) = tempfile.mkstemp(dir=directory, prefix='.capabilities')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f, indent=2, sort_keys=True)
+            os.rename(tmpPath, self.path)
+        except (IOError, OSError), e:
+            # the cache only saves time, so failing to write it isn't fatal
+            print "unable to write device capability cache %s: %s" % (self.path, e)
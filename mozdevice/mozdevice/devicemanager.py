@@ -5,19 +5,29 @@
 import hashlib
 import socket
 import os
+import posixpath
+import Queue
 import re
 import struct
+import sys
+import threading
+import time
 import StringIO
+import tempfile
 import zlib
 
-from Zeroconf import Zeroconf, ServiceBrowser
+from Zeroconf import Zeroconf, ServiceBrowser, _TYPE_SRV, _CLASS_IN
+from logcat import LogcatStreamer, filterLines, _compileFilterOut
+from processtable import ProcessTable
 
 class DMError(Exception):
     "generic devicemanager exception."
 
-    def __init__(self, msg= '', fatal = False):
+    def __init__(self, msg= '', fatal = False, timeout = False):
         self.msg = msg
         self.fatal = fatal
+        # whether the error is that the device took too long to respond
+        self.timeout = timeout
 
     def __str__(self):
         return self.msg
@@ -33,7 +43,13 @@ def abstractmethod(method):
 
 class DeviceManager:
 
+    debug = 0
     _logcatNeedsRoot = True
+    # most pieces of data the iter* methods queue up before the transfer
+    # waits for them to be consumed
+    iter_queue_size = 64
+    # background logcat capture started by recordLogcat()
+    _logcat = None
 
     @abstractmethod
     def shell(self, cmd, outputfile, env=None, cwd=None, timeout=None, root=False):
@@ -41,7 +57,8 @@ class DeviceManager:
         Executes shell command on device and returns exit code
 
         cmd - Command string to execute
-        outputfile - File to store output
+        outputfile - File to stream output to as it arrives, or a function
+                     to call with each line of output
         env - Environment to pass to exec command
         cwd - Directory to execute command from
         timeout - specified in seconds, defaults to 'default_timeout'
@@ -59,12 +76,89 @@ class DeviceManager:
         """
         buf = StringIO.StringIO()
         retval = self.shell(cmd, buf, env=env, cwd=cwd, timeout=timeout, root=root)
-        output = str(buf.getvalue()[0:-1]).rstrip()
+        output = str(buf.getvalue()).rstrip()
         buf.close()
         if retval != 0:
             raise DMError("Non-zero return code for command: %s (output: '%s', retval: '%s')" % (cmd, output, retval))
         return output
 
+    def iterShellOutput(self, cmd, env=None, cwd=None, timeout=None, root=False):
+        """
+        Executes shell command on device, yielding its output a line at a
+        time as it arrives, so it can be processed before the command has
+        finished and without ever being held in memory as a whole. Raises
+        DMError at the end if the command has a non-zero return code.
+
+        env - Environment to pass to exec command
+        cwd - Directory to execute command from
+        timeout - specified in seconds, defaults to 'default_timeout'
+        root - Specifies whether command requires root privileges
+        """
+        def transfer(dm, put):
+            retval = dm.shell(cmd, put, env=env, cwd=cwd, timeout=timeout, root=root)
+            if retval != 0:
+                raise DMError("Non-zero return code for command: %s (retval: '%s')" %
+                              (cmd, retval))
+        return self._iterTransfer(transfer)
+
+    def _iterTransfer(self, transfer, abort=None):
+        """
+        Runs transfer(dm, put) in a thread of its own, where dm is the device
+        manager to run it on, yielding each piece of data it passes to put.
+        Once iter_queue_size pieces are waiting to be consumed, put blocks
+        until the consumer catches up, so memory use is bounded by that
+        rather than by the size of the transfer. Exceptions raised by the
+        transfer are raised by the iterator once the data before them has
+        been consumed. Unless the transfer has a connection of its own, the
+        device manager mustn't be used for anything else until the iteration
+        is over.
+
+        If the iterator is closed before the end, abort() is called to cut
+        the transfer short if given; either way, the rest of its data is
+        discarded and closing waits for it to finish, so the device manager
+        is free to use again afterwards.
+        """
+        pieces = Queue.Queue(self.iter_queue_size)
+        abandoned = threading.Event()
+
+        def put(data):
+            if not abandoned.is_set():
+                pieces.put((data, None))
+
+        def run():
+            excinfo = None
+            try:
+                transfer(self, put)
+            except Exception:
+                excinfo = sys.exc_info()
+            if not abandoned.is_set():
+                pieces.put((None, excinfo or True))
+
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+        try:
+            while True:
+                (data, end) = pieces.get()
+                if end is None:
+                    yield data
+                    continue
+                if end is not True:
+                    raise end[0], end[1], end[2]
+                break
+        finally:
+            if t.is_alive():
+                abandoned.set()
+                if abort:
+                    abort()
+                # unblocks a put that was waiting for room in the queue
+                while t.is_alive():
+                    try:
+                        pieces.get(timeout=0.1)
+                    except Queue.Empty:
+                        pass
+            t.join()
+
     @abstractmethod
     def pushFile(self, localname, destname, retryLimit=1):
         """
@@ -99,7 +193,83 @@ class DeviceManager:
         Push localDir from host to remoteDir on the device
         """
 
+    def syncDir(self, localDir, remoteDir, deleteStale=False, retryLimit=None):
+        """
+        Makes remoteDir on the device match localDir on the host, pushing
+        only the files whose md5 hash differs from the copy on the device.
+
+        deleteStale - also remove files under remoteDir that aren't in localDir
+
+        returns: dict of transfer statistics:
+          filesSent, bytesSent - files pushed, and their total size
+          filesSkipped, bytesSkipped - files already up to date on the device
+          filesDeleted - stale files removed from the device
+        """
+        remoteDir = remoteDir.rstrip('/')
+        remoteHashes = self._getRemoteDirHashes(remoteDir)
+
+        stats = { 'filesSent': 0, 'bytesSent': 0,
+                  'filesSkipped': 0, 'bytesSkipped': 0,
+                  'filesDeleted': 0 }
+        pushes = []
+        localFiles = set()
+        for root, dirs, files in os.walk(localDir, followlinks=True):
+            for f in files:
+                localName = os.path.join(root, f)
+                relName = os.path.relpath(localName, localDir).replace(os.sep, '/')
+                localFiles.add(relName)
+                size = os.path.getsize(localName)
+                if remoteHashes.get(relName) == self._getCachedLocalHash(localName):
+                    stats['filesSkipped'] += 1
+                    stats['bytesSkipped'] += size
+                else:
+                    pushes.append((localName, remoteDir + '/' + relName))
+                    stats['filesSent'] += 1
+                    stats['bytesSent'] += size
+
+        if (self.debug >= 2):
+            print "syncing directory: %s to %s (%d of %d files changed)" % \
+                (localDir, remoteDir, len(pushes), len(localFiles))
+
+        if pushes:
+            self._pushFiles(pushes, retryLimit=retryLimit)
+
+        if deleteStale:
+            stale = [remoteDir + '/' + relName for relName in remoteHashes
+                     if relName not in localFiles]
+            if stale:
+                self._removeFiles(stale)
+            stats['filesDeleted'] = len(stale)
+
+        return stats
+
     @abstractmethod
+    def _getRemoteDirHashes(self, remoteDir):
+        """
+        Returns the md5 hashes of all files under remoteDir on the device, in
+        as few commands as possible
+
+        returns:
+          success: dict of hashes by path relative to remoteDir ('/' separated)
+          failure: {} (everything will be considered out of date)
+        """
+
+    def _pushFiles(self, pushes, retryLimit=None):
+        """
+        Copies a list of (localname, destname) tuples from the host to the
+        device, creating any missing directories
+        """
+        for (localname, destname) in pushes:
+            self.mkDirs(destname)
+            self.pushFile(localname, destname, retryLimit=retryLimit)
+
+    def _removeFiles(self, filenames):
+        """
+        Removes a list of files from the device
+        """
+        for filename in filenames:
+            self.removeFile(filename)
+
     def fileExists(self, filepath):
         """
         Checks if filepath exists and is a file on the device file system
@@ -108,6 +278,8 @@ class DeviceManager:
           success: True
           failure: False
         """
+        entry = self._statPath(filepath)
+        return entry is not None and entry[1] != 'd'
 
     @abstractmethod
     def listFiles(self, rootdir):
@@ -119,6 +291,61 @@ class DeviceManager:
           failure: None
         """
 
+    def listDirDetailed(self, remoteDir, recursive=True):
+        """
+        Lists the contents of remoteDir on the device along with their
+        metadata, using a single ls command
+
+        recursive - also list the contents of every subdirectory
+
+        returns: list of (path, type, size, mtime) tuples, with directories
+                 listed before their contents. type is 'd' (directory), 'f'
+                 (file), 'l' (symlink) or another ls type character; size is
+                 in bytes (None for directories) and mtime in seconds since
+                 the epoch (None if it couldn't be parsed). [] if remoteDir
+                 doesn't exist.
+        """
+        remoteDir = remoteDir.rstrip('/') or '/'
+        buf = StringIO.StringIO()
+        self.shell(['ls', '-alR' if recursive else '-al', remoteDir], buf)
+        return _parseLsOutput(buf.getvalue(), remoteDir)
+
+    def walk(self, remoteDir):
+        """
+        Generates a (dirpath, dirnames, filenames) tuple for remoteDir and
+        each directory below it, like os.walk, from a single recursive
+        listing
+        """
+        remoteDir = remoteDir.rstrip('/') or '/'
+        contents = { remoteDir: ([], []) }
+        dirs = [remoteDir]
+        for (path, entryType, size, mtime) in self.listDirDetailed(remoteDir):
+            parent, name = posixpath.split(path)
+            if parent not in contents:
+                continue
+            if entryType == 'd':
+                contents[parent][0].append(name)
+                contents[path] = ([], [])
+                dirs.append(path)
+            else:
+                contents[parent][1].append(name)
+
+        for d in dirs:
+            yield (d, contents[d][0], contents[d][1])
+
+    def _statPath(self, remotePath):
+        """
+        Returns the (path, type, size, mtime) listing entry for remotePath
+        itself, or None if it doesn't exist
+        """
+        remotePath = remotePath.rstrip('/') or '/'
+        buf = StringIO.StringIO()
+        self.shell(['ls', '-ald', remotePath], buf)
+        for entry in _parseLsOutput(buf.getvalue(), remotePath):
+            if entry[0] == remotePath:
+                return entry
+        return None
+
     @abstractmethod
     def removeFile(self, filename):
         """
@@ -149,19 +376,53 @@ class DeviceManager:
           failure: []
         """
 
+    # seconds a snapshot of the process list is reused for
+    process_cache_ttl = 1.0
+    _processTable = None
+
+    def getProcessTable(self, maxAge=None):
+        """
+        Returns a ProcessTable snapshot of the processes running on the
+        device. A snapshot less than maxAge seconds old (process_cache_ttl
+        by default) is reused rather than listing the processes again, so
+        a maxAge of 0 always gets a fresh one.
+        """
+        if maxAge is None:
+            maxAge = self.process_cache_ttl
+        table = self._processTable
+        if table is None or table.age >= maxAge:
+            table = ProcessTable(self.getProcessList())
+            self._processTable = table
+        return table
+
+    def _invalidateProcessTable(self):
+        """
+        Drops the cached process list, after starting or killing a process
+        """
+        self._processTable = None
+
     def processExist(self, appname):
         """
-        Iterates process list and checks if pid exists
+        Looks appname up in a (recent) snapshot of the process list
 
         returns:
           success: pid
           failure: None
         """
+        pids = self.getProcessTable().pids(self._processName(appname))
+        if pids:
+            return pids[0]
+        return None
+
+    @staticmethod
+    def _processName(appname):
+        """
+        Returns the name the process started by a command line shows up as
+        in the process list
+        """
         if not isinstance(appname, basestring):
             raise TypeError("appname %s is not a string" % appname)
 
-        pid = None
-
         #filter out extra spaces
         parts = filter(lambda x: x != '', appname.split(' '))
         appname = ' '.join(parts)
@@ -174,19 +435,42 @@ class DeviceManager:
 
         pieces = appname.split(' ')
         parts = pieces[0].split('/')
-        app = parts[-1]
-
-        procList = self.getProcessList()
-        if (procList == []):
-            return None
-
-        for proc in procList:
-            procName = proc[1].split('/')[-1]
-            if (procName == app):
-                pid = proc[0]
-                break
-        return pid
-
+        return parts[-1]
+
+    def _pidof(self, name):
+        """
+        Returns the pids of the processes called name, using a check which is
+        cheaper than listing every process, or None if the device doesn't
+        have one
+        """
+        return None
+
+    def waitForProcess(self, name, state='running', timeout=30):
+        """
+        Waits until a process called name is running (state 'running') or
+        until there is none left (state 'stopped'). The device is checked
+        with pidof where it has it, and with a fresh process list otherwise,
+        at intervals growing from 0.1 to 1 second.
+
+        returns: True if the process got to the state within timeout
+                 seconds, False otherwise
+        """
+        if state not in ('running', 'stopped'):
+            raise ValueError("state must be 'running' or 'stopped', not %r" % state)
+        name = name.split('/')[-1]
+        deadline = time.time() + timeout
+        delay = 0.1
+        while True:
+            pids = self._pidof(name)
+            if pids is None:
+                pids = self.getProcessTable(maxAge=0).pids(name)
+            if bool(pids) == (state == 'running'):
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 1.0)
 
     @abstractmethod
     def killProcess(self, appname, forceKill=False):
@@ -225,6 +509,26 @@ class DeviceManager:
         Copy file from device (remoteFile) to host (localFile)
         """
 
+    def iterFile(self, remoteFile, chunkSize=65536):
+        """
+        Returns an iterator over the contents of remoteFile, in chunks of
+        up to chunkSize bytes, for files too large to read into memory. By
+        default the file is pulled to a temporary file on the host, which is
+        then read back; device managers which can do better stream it
+        straight from the device as it arrives.
+        """
+        def transfer(dm, put):
+            (fd, localFile) = tempfile.mkstemp()
+            os.close(fd)
+            try:
+                dm.getFile(remoteFile, localFile)
+                with open(localFile, 'rb') as f:
+                    for chunk in iter(lambda: f.read(chunkSize), ''):
+                        put(chunk)
+            finally:
+                os.remove(localFile)
+        return self._iterTransfer(transfer)
+
     @abstractmethod
     def getDirectory(self, remoteDir, localDir, checkDir=True):
         """
@@ -255,6 +559,16 @@ class DeviceManager:
           failure: None
         """
 
+    def getRemoteHashes(self, paths):
+        """
+        Returns the md5 hashes of a list of files on the device, computed on
+        the device in as few commands as possible
+
+        returns: dict of hashes by path, with None for any file which
+                 couldn't be hashed
+        """
+        return dict((path, self._getRemoteHash(path)) for path in paths)
+
     @staticmethod
     def _getLocalHash(filename):
         """
@@ -284,6 +598,24 @@ class DeviceManager:
         hexval = mdsum.hexdigest()
         return hexval
 
+    def _getCachedLocalHash(self, filename):
+        """
+        Like _getLocalHash, but remembers hashes for as long as the file's
+        size and modification time stay the same
+        """
+        if not hasattr(self, '_localHashCache'):
+            self._localHashCache = {}
+
+        st = os.stat(filename)
+        key = os.path.abspath(filename)
+        cached = self._localHashCache.get(key)
+        if cached and cached[0] == (st.st_size, st.st_mtime):
+            return cached[1]
+
+        hexval = self._getLocalHash(filename)
+        self._localHashCache[key] = ((st.st_size, st.st_mtime), hexval)
+        return hexval
+
     @abstractmethod
     def getDeviceRoot(self):
         """
@@ -396,6 +728,19 @@ class DeviceManager:
           failure: None
         """
 
+    @abstractmethod
+    def rebootAsync(self, monitor=None, timeout=None, **kwargs):
+        """
+        Reboots the device, returning straight away. Readiness checks for
+        any number of devices share a single RebootMonitor event loop.
+
+        monitor - RebootMonitor to wait on, defaults to a shared one
+        timeout - seconds to wait for the device before giving up
+
+        returns: RebootHandle, whose wait() or result() block until the
+                 device is back up
+        """
+
     def validateDir(self, localDir, remoteDir):
         """
         Validate localDir from host to remoteDir on the device
@@ -407,16 +752,21 @@ class DeviceManager:
 
         if (self.debug >= 2):
             print "validating directory: " + localDir + " to " + remoteDir
-        for root, dirs, files in os.walk(localDir):
-            parts = root.split(localDir)
-            for f in files:
-                remoteRoot = remoteDir + '/' + parts[1]
-                remoteRoot = remoteRoot.replace('/', '/')
-                if (parts[1] == ""):
-                    remoteRoot = remoteDir
-                remoteName = remoteRoot + '/' + f
-                if (self.validateFile(remoteName, os.path.join(root, f)) <> True):
-                        return False
+        files = []
+        for root, dirs, filenames in os.walk(localDir):
+            relRoot = os.path.relpath(root, localDir)
+            for f in filenames:
+                if relRoot == '.':
+                    remoteName = remoteDir + '/' + f
+                else:
+                    remoteName = '/'.join([remoteDir] + relRoot.split(os.sep) + [f])
+                files.append((os.path.join(root, f), remoteName))
+
+        remoteHashes = self.getRemoteHashes([remoteName for (localName, remoteName) in files])
+        for (localName, remoteName) in files:
+            remoteHash = remoteHashes.get(remoteName)
+            if remoteHash is None or remoteHash != self._getCachedLocalHash(localName):
+                return False
         return True
 
     @abstractmethod
@@ -486,14 +836,34 @@ class DeviceManager:
           failure: None
         """
 
-    def recordLogcat(self):
+    def recordLogcat(self, filterSpecs=["dalvikvm:S", "ConnectivityService:S",
+                                        "WifiMonitor:S", "WifiStateTracker:S",
+                                        "wpa_supplicant:S", "NetworkStateTracker:S"],
+                     format="time", filterOutRegexps=[], maxLines=100000):
         """
-        Clears the logcat file making it easier to view specific events
-        """
-        #TODO: spawn this off in a separate thread/process so we can collect all the logcat information
+        Clears the logcat file and starts capturing it in the background,
+        making it easier to view specific events. Later calls to getLogcat()
+        with the same filterSpecs and format are answered from what has been
+        captured, rather than by downloading the whole log again.
 
-        # Right now this is just clearing the logcat so we can only see what happens after this call.
+        returns: the LogcatStreamer doing the capturing, which can also be
+                 used to get the lines logged since a marker
+        """
+        self.stopLogcat()
         self.shellCheckOutput(['/system/bin/logcat', '-c'], root=self._logcatNeedsRoot)
+        self._logcat = LogcatStreamer(self, filterSpecs=filterSpecs, format=format,
+                                      filterOutRegexps=filterOutRegexps,
+                                      maxLines=maxLines)
+        self._logcat.start()
+        return self._logcat
+
+    def stopLogcat(self):
+        """
+        Stops capturing logcat in the background, if recordLogcat() started it
+        """
+        if self._logcat:
+            self._logcat.stop()
+            self._logcat = None
 
     def getLogcat(self, filterSpecs=["dalvikvm:S", "ConnectivityService:S",
                                       "WifiMonitor:S", "WifiStateTracker:S",
@@ -503,58 +873,193 @@ class DeviceManager:
         """
         Returns the contents of the logcat file as a list of strings
         """
+        logcat = self._logcat
+        if logcat and logcat.filterSpecs == list(filterSpecs) and \
+                logcat.format == format:
+            return logcat.linesSince(0, filterOutRegexps)
+
         cmdline = ["/system/bin/logcat", "-v", format, "-d"] + filterSpecs
         lines = self.shellCheckOutput(cmdline,
                                       root=self._logcatNeedsRoot).split('\r')
 
-        for regex in filterOutRegexps:
-            lines = [line for line in lines if not re.search(regex, line)]
+        return filterLines(lines, filterOutRegexps)
+
+    def iterLogcat(self, filterSpecs=["dalvikvm:S", "ConnectivityService:S",
+                                      "WifiMonitor:S", "WifiStateTracker:S",
+                                      "wpa_supplicant:S", "NetworkStateTracker:S"],
+                   format="time",
+                   filterOutRegexps=[]):
+        """
+        Like getLogcat, but yields the lines of the log (each ending in a
+        newline) one at a time as they are read from the device, filtering
+        them on the way, rather than returning them all at once
+        """
+        logcat = self._logcat
+        if logcat and logcat.filterSpecs == list(filterSpecs) and \
+                logcat.format == format:
+            for line in logcat.linesSince(0, filterOutRegexps):
+                yield line
+            return
+
+        filterOut = _compileFilterOut(filterOutRegexps)
+        cmdline = ["/system/bin/logcat", "-v", format, "-d"] + filterSpecs
+        for line in self.iterShellOutput(cmdline, root=self._logcatNeedsRoot):
+            line = line.rstrip('\r\n')
+            if line and not (filterOut and filterOut.search(line)):
+                yield line + '\n'
+
+    @abstractmethod
+    def _streamShell(self, cmd, lineCallback, root=False):
+        """
+        Starts a shell command which runs until it is stopped (like logcat)
+        in the background, calling lineCallback with each line of its output
+        as it arrives and then with None once the command has ended
 
-        return lines
+        returns: a function which stops the command
+        """
 
     @staticmethod
-    def _writePNG(buf, width, height):
+    def _writePNG(rawfile, pngfile, width, height, compressionLevel=6):
         """
-        Method for writing a PNG from a buffer, used by getScreenshot on older devices
+        Method for writing a PNG from a raw RGBA framebuffer read from
+        rawfile, used by saveScreenshot on older devices. The image is
+        compressed a row at a time and written out in pieces, so it is never
+        held in memory as a whole.
         Based on: http://code.activestate.com/recipes/577443-write-a-png-image-in-native-python/
         """
-        width_byte_4 = width * 4
-        raw_data = b"".join(b'\x00' + buf[span:span + width_byte_4] for span in range(0, (height - 1) * width * 4, width_byte_4))
         def png_pack(png_tag, data):
             chunk_head = png_tag + data
-            return struct.pack("!I", len(data)) + chunk_head + struct.pack("!I", 0xFFFFFFFF & zlib.crc32(chunk_head))
-        return b"".join([
-                b'\x89PNG\r\n\x1a\n',
-                png_pack(b'IHDR', struct.pack("!2I5B", width, height, 8, 6, 0, 0, 0)),
-                png_pack(b'IDAT', zlib.compress(raw_data, 9)),
-                png_pack(b'IEND', b'')])
+            pngfile.write(struct.pack("!I", len(data)) + chunk_head +
+                          struct.pack("!I", 0xFFFFFFFF & zlib.crc32(chunk_head)))
+
+        pngfile.write(b'\x89PNG\r\n\x1a\n')
+        png_pack(b'IHDR', struct.pack("!2I5B", width, height, 8, 6, 0, 0, 0))
 
-    def saveScreenshot(self, filename):
+        # a PNG may split its image data over any number of IDAT chunks
+        compressor = zlib.compressobj(compressionLevel)
+        idat = []
+        idatSize = 0
+        width_byte_4 = width * 4
+        for row in range(height):
+            data = rawfile.read(width_byte_4)
+            if len(data) != width_byte_4:
+                raise DMError("Screenshot data ends after %d of %d rows" % (row, height))
+            compressed = compressor.compress(b'\x00' + data)
+            if compressed:
+                idat.append(compressed)
+                idatSize += len(compressed)
+                if idatSize >= 65536:
+                    png_pack(b'IDAT', b"".join(idat))
+                    idat = []
+                    idatSize = 0
+        idat.append(compressor.flush())
+        png_pack(b'IDAT', b"".join(idat))
+        png_pack(b'IEND', b'')
+
+    # whether screencap can write PNGs itself (None until we've tried)
+    _screencapPNG = None
+
+    def _captureScreen(self, remoteFile):
+        """
+        Takes a screenshot into remoteFile on the device, as a PNG if the
+        device's screencap can encode one and as a raw framebuffer otherwise
+
+        returns: True for a PNG, False for a raw framebuffer
+        """
+        screencap = '/system/bin/screencap'
+        if self._screencapPNG is None:
+            if not self.fileExists(screencap):
+                raise DMError("Unable to capture screenshot on device: no screencap utility")
+            # screencap -p is only in Android 4.0 and later
+            retval = self.shell([screencap, "-p", remoteFile], StringIO.StringIO(),
+                                root=True)
+            self._screencapPNG = (retval == 0 and self.fileExists(remoteFile))
+            if self._screencapPNG:
+                return True
+        elif self._screencapPNG:
+            self.shellCheckOutput([screencap, "-p", remoteFile], root=True)
+            return True
+
+        self.shellCheckOutput(["sh", "-c", "%s > %s" % (screencap, remoteFile)],
+                              root=True)
+        return False
+
+    def _getRawScreenshot(self, remoteFile, filename, compressionLevel):
+        """
+        Copies the raw framebuffer in remoteFile to the host and encodes it as
+        a PNG in filename
+        """
+        (fd, rawFilename) = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.getFile(remoteFile, rawFilename)
+            with open(rawFilename, 'rb') as rawfile:
+                (width, height, pixelFormat) = struct.unpack("III", rawfile.read(12))
+                with open(filename, 'wb') as pngfile:
+                    self._writePNG(rawfile, pngfile, width, height, compressionLevel)
+        finally:
+            os.remove(rawFilename)
+
+    def saveScreenshot(self, filename, compressionLevel=6):
         """
         Takes a screenshot of what's being display on the device. Uses
         "screencap" on newer (Android 3.0+) devices (and some older ones with
         the functionality backported). This function also works on B2G.
 
+        Where screencap can write a PNG itself, it's copied straight into
+        filename; otherwise the raw framebuffer is copied and encoded here,
+        at the given zlib compressionLevel (1 is fastest, 9 smallest).
+
         Throws an exception on failure. This will always fail on devices
         without the screencap utility.
         """
-        screencap = '/system/bin/screencap'
-        if not self.fileExists(screencap):
-            raise DMError("Unable to capture screenshot on device: no screencap utility")
-
-        with open(filename, 'w') as pngfile:
-            # newer versions of screencap can write directly to a png, but some
-            # older versions can't
-            tempScreenshotFile = self.getDeviceRoot() + "/ss-dm.tmp"
-            self.shellCheckOutput(["sh", "-c", "%s > %s" %
-                                   (screencap, tempScreenshotFile)],
+        tempScreenshotFile = self.getDeviceRoot() + "/ss-dm.tmp"
+        if self._captureScreen(tempScreenshotFile):
+            self.getFile(tempScreenshotFile, filename)
+        else:
+            self._getRawScreenshot(tempScreenshotFile, filename, compressionLevel)
+        self.removeFile(tempScreenshotFile)
+
+    def saveScreenshots(self, localDir, count, interval=0, compressionLevel=6):
+        """
+        Takes count screenshots in quick succession, interval seconds apart,
+        e.g. to record what happens during a UI test. All of the screenshots
+        are taken by a single shell command, without a round trip to the
+        device in between, and then copied to localDir as screenshot-0000.png,
+        screenshot-0001.png and so on.
+
+        returns: list of the local filenames, in order
+        """
+        remoteDir = self.getDeviceRoot() + "/ss-dm-burst"
+        self.removeDir(remoteDir)
+        self.mkDir(remoteDir)
+
+        # find out how screencap works using the first screenshot
+        isPNG = self._captureScreen(remoteDir + "/0")
+        if isPNG:
+            capture = '/system/bin/screencap -p %s/$i' % remoteDir
+        else:
+            capture = '/system/bin/screencap > %s/$i' % remoteDir
+        if interval:
+            capture = 'sleep %s; %s' % (interval, capture)
+        if count > 1:
+            self.shellCheckOutput(["sh", "-c", "i=1; while [ $i -lt %d ]; do %s; "
+                                   "i=$((i+1)); done" % (count, capture)],
                                   root=True)
-            buf = self.pullFile(tempScreenshotFile)
-            width = int(struct.unpack("I", buf[0:4])[0])
-            height = int(struct.unpack("I", buf[4:8])[0])
-            with open(filename, 'w') as pngfile:
-                pngfile.write(self._writePNG(buf[12:], width, height))
-            self.removeFile(tempScreenshotFile)
+
+        if not os.path.exists(localDir):
+            os.makedirs(localDir)
+        filenames = []
+        for i in range(count):
+            filename = os.path.join(localDir, "screenshot-%04d.png" % i)
+            if isPNG:
+                self.getFile("%s/%d" % (remoteDir, i), filename)
+            else:
+                self._getRawScreenshot("%s/%d" % (remoteDir, i), filename,
+                                       compressionLevel)
+            filenames.append(filename)
+        self.removeDir(remoteDir)
+        return filenames
 
     @abstractmethod
     def chmodDir(self, remoteDir, mask="777"):
@@ -645,64 +1150,232 @@ class NetworkTools:
 
         return seed
 
-def _pop_last_line(file_obj):
+# an entry in ls -l output, as printed by toolbox, toybox or busybox ls
+_lsEntryRE = re.compile(r'^(?P<type>[-bcdlps])[-rwxsStT]{9}\S*\s+(?P<fields>.*?)\s+'
+                        r'(?:(?P<isodate>\d{4}-\d\d-\d\d \d\d:\d\d(?::\d\d)?)'
+                        r'(?:\.\d+)?(?: [-+]\d{4})?'
+                        r'|(?P<date>[A-Z][a-z]{2} +\d{1,2} +(?:\d\d:\d\d|\d{4})))'
+                        r' (?P<name>.+)$')
+
+def _parseLsTime(m):
     """
-    Utility function to get the last line from a file (shared between ADB and
-    SUT device managers). Function also removes it from the file. Intended to
-    strip off the return code from a shell command.
+    Utility function to convert the date of an ls -l entry into seconds since
+    the epoch. Returns None if it can't be parsed.
     """
-    bytes_from_end = 1
-    file_obj.seek(0, 2)
-    length = file_obj.tell() + 1
-    while bytes_from_end < length:
-        file_obj.seek((-1)*bytes_from_end, 2)
-        data = file_obj.read()
-
-        if bytes_from_end == length-1 and len(data) == 0: # no data, return None
-            return None
+    try:
+        if m.group('isodate'):
+            date = m.group('isodate')
+            fmt = '%Y-%m-%d %H:%M:%S' if date.count(':') == 2 else '%Y-%m-%d %H:%M'
+            return time.mktime(time.strptime(date, fmt))
+
+        # busybox leaves out the year for recent files and the time for old ones
+        date = ' '.join(m.group('date').split())
+        if ':' in date:
+            now = time.localtime()
+            t = time.strptime('%s %d' % (date, now.tm_year), '%b %d %H:%M %Y')
+            if t > now:
+                t = time.strptime('%s %d' % (date, now.tm_year - 1), '%b %d %H:%M %Y')
+        else:
+            t = time.strptime(date, '%b %d %Y')
+        return time.mktime(t)
+    except (ValueError, OverflowError):
+        return None
 
-        if data[0] == '\n' or bytes_from_end == length-1:
-            # found the last line, which should have the return value
-            if data[0] == '\n':
-                data = data[1:]
+def _parseLsOutput(output, remoteDir):
+    """
+    Utility function to parse the output of ls -al or ls -alR on remoteDir
+    (shared between ADB and SUT device managers) into a list of
+    (path, type, size, mtime) tuples. Lines that aren't entries or directory
+    headers, such as errors and totals, are ignored.
+    """
+    entries = []
+    curDir = remoteDir
+    for line in output.replace('\0', '').splitlines():
+        line = line.rstrip('\r')
+        m = _lsEntryRE.match(line)
+        if not m:
+            if line.endswith(':'):
+                curDir = line[:-1].rstrip('/') or '/'
+            continue
+
+        name = m.group('name')
+        entryType = m.group('type')
+        if entryType == 'l':
+            name = name.split(' -> ')[0]
+        if name in ('.', '..'):
+            continue
+        entryType = { '-': 'f' }.get(entryType, entryType)
+
+        size = None
+        fields = m.group('fields').split()
+        if entryType != 'd' and fields and fields[-1].isdigit():
+            size = int(fields[-1])
+
+        # a path given on the command line is printed as-is
+        if name.startswith('/'):
+            path = name
+        else:
+            path = posixpath.join(curDir, name)
+        entries.append((path, entryType, size, _parseLsTime(m)))
 
-            # truncate off the return code line
-            file_obj.truncate(length - bytes_from_end)
-            file_obj.seek(0,2)
-            file_obj.write('\0')
+    return entries
 
-            return data
+class _ShellOutput(object):
+    """
+    File-like object for the output of a shell command, the last line of
+    which gives its exit status (shared between ADB and SUT device
+    managers). Output is passed on to outputfile as it arrives, apart from
+    the last line received so far, which is held back until finish() as it
+    may be that status line. Nothing is ever rewound, so outputfile can be
+    a pipe or a socket.
+
+    outputfile can also be a function, which is then called with each line
+    of output (including its newline) as it arrives.
+    """
+
+    def __init__(self, outputfile):
+        if hasattr(outputfile, 'write'):
+            self._out = outputfile.write
+        else:
+            self._lineCallback = outputfile
+            self._out = self._writeLines
+        # incomplete line not yet passed to the line callback
+        self._partial = ''
+        self._held = ''
+
+    def _writeLines(self, data):
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self._lineCallback(line + '\n')
+
+    def write(self, data):
+        if '\n' not in data:
+            self._held += data
+            return
+        held = self._held + data
+        # the status line is the last one with anything on it, so any
+        # trailing newlines are held back along with it
+        end = held.rstrip('\r\n').rfind('\n')
+        if end == -1:
+            self._held = held
+        else:
+            self._out(held[:end + 1])
+            self._held = held[end + 1:]
+
+    def finish(self, statusRE=None):
+        """
+        Ends the output, searching the held back last line for statusRE.
+        Anything on that line before the status (output which didn't end
+        with a newline) is passed on, as is the whole line if there is no
+        status on it or statusRE is None.
+
+        returns: the match object, or None if there was no status
+        """
+        (last, self._held) = (self._held, '')
+        m = re.search(statusRE, last) if statusRE else None
+        output = last[:m.start()] if m else last
+        if output:
+            self._out(output)
+        if self._partial:
+            self._lineCallback(self._partial)
+            self._partial = ''
+        return m
+
+class _ChunkWriter(object):
+    """
+    File-like object which passes whatever is written to it on to a
+    function, in chunks of up to chunkSize bytes
+    """
+
+    def __init__(self, callback, chunkSize):
+        self._callback = callback
+        self._chunkSize = chunkSize
+
+    def write(self, data):
+        for i in range(0, len(data), self._chunkSize):
+            self._callback(data[i:i + self._chunkSize])
+
+# SUTAgents announce themselves with mDNS service names like
+# 'SUTAgent [hwid:015d2bc2825ff206] [ip:10_242_29_221]._sutagent._tcp.local.'
+_AGENT_HWID_RE = re.compile(r'\[hwid:([^\]]*)\]')
+_AGENT_IP_RE = re.compile(r'\[ip:([0-9_]*)\]')
+
+def _parseAgentName(name):
+    """
+    returns: (hwid, ip) from the name of a SUTAgent's mDNS service, or None
+             if it isn't one
+    """
+    if not name.startswith("SUTAgent"):
+        return None
 
-        bytes_from_end += 1
+    sutname = name.split('.')[0]
+    m = _AGENT_HWID_RE.search(sutname)
+    if m is None:
+        return None
 
-    return None
+    hwid = m.group(1)
+
+    m = _AGENT_IP_RE.search(sutname)
+    if m is None:
+        return None
+
+    return (hwid, m.group(1).replace("_", "."))
+
+def _agentPort(zeroconf, name):
+    """
+    returns: the port a SUTAgent announced itself on, from the SRV record
+             which arrives along with its name
+    """
+    srv = zeroconf.cache.getByDetails(name, _TYPE_SRV, _CLASS_IN)
+    if srv is None:
+        return 20701
+    return srv.port
 
 class ZeroconfListener(object):
     def __init__(self, hwid, evt):
         self.hwid = hwid
         self.evt = evt
 
-    # Format is 'SUTAgent [hwid:015d2bc2825ff206] [ip:10_242_29_221]._sutagent._tcp.local.'
     def addService(self, zeroconf, type, name):
         #print "Found _sutagent service broadcast:", name
-        if not name.startswith("SUTAgent"):
+        agent = _parseAgentName(name)
+        if agent is None:
             return
 
-        sutname = name.split('.')[0]
-        m = re.search('\[hwid:([^\]]*)\]', sutname)
-        if m is None:
-            return
+        (hwid, ip) = agent
+        if self.hwid == hwid:
+            self.ip = ip
+            self.evt.set()
 
-        hwid = m.group(1)
+    def removeService(self, zeroconf, type, name):
+        pass
 
-        m = re.search('\[ip:([0-9_]*)\]', sutname)
-        if m is None:
+class ZeroconfInventoryListener(object):
+    """
+    Collects every SUTAgent that announces itself, rather than waiting for
+    a particular one. If count is given, evt is set once that many have
+    been found.
+    """
+
+    def __init__(self, evt=None, count=None):
+        self.evt = evt
+        self.count = count
+        self.started = time.time()
+        # maps hwid to {'ip', 'port', 'seconds'}, where seconds is how long
+        # after browsing started the agent showed up
+        self.agents = {}
+
+    def addService(self, zeroconf, type, name):
+        agent = _parseAgentName(name)
+        if agent is None:
             return
 
-        ip = m.group(1).replace("_", ".")
-        
-        if self.hwid == hwid:
-            self.ip = ip
+        (hwid, ip) = agent
+        if hwid not in self.agents:
+            self.agents[hwid] = { 'ip': ip, 'port': _agentPort(zeroconf, name),
+                                  'seconds': time.time() - self.started }
+        if self.evt and self.count and len(self.agents) >= self.count:
             self.evt.set()
 
     def removeService(self, zeroconf, type, name):
@@ -3,12 +3,260 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import subprocess
-from devicemanager import DeviceManager, DMError, _pop_last_line
+from devicemanager import DeviceManager, DMError, _ChunkWriter, _ShellOutput
+import adbclient
+import ziparchive
+from metrics import DeviceMetrics
+import rebootmonitor
+import json
 import re
 import os
+import posixpath
+import Queue
 import shutil
+import StringIO
 import tempfile
+import threading
 import time
+import uuid
+
+class ADBShellSessionDied(Exception):
+    "the persistent adb shell exited; the command should be run another way"
+
+class ADBShellSession(object):
+    """
+    A long-lived adb shell process which runs command lines one at a time.
+    The start and end of each command's output, and its exit code, are found
+    through sentinel lines, so that commands don't each pay for starting adb
+    and connecting to the device.
+    """
+
+    def __init__(self, adbArgs):
+        """
+        adbArgs - adb command line up to the command, e.g. ['adb', '-s', serial]
+        """
+        self._adbArgs = adbArgs
+        self._proc = None
+        self._lines = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        self._proc = subprocess.Popen(self._adbArgs + ['shell'], stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self._lines = Queue.Queue()
+        t = threading.Thread(target=self._readLines, args=(self._proc.stdout, self._lines))
+        t.daemon = True
+        t.start()
+
+    @staticmethod
+    def _readLines(stdout, lines):
+        for line in iter(stdout.readline, ''):
+            lines.put(line)
+        lines.put(None)
+
+    def close(self):
+        if self._proc and self._proc.poll() is None:
+            try:
+                self._proc.kill()
+            except OSError:
+                pass
+        self._proc = None
+
+    def run(self, cmdline, timeout, outputfile=None):
+        """
+        Runs cmdline in the session, starting it if needed. If outputfile
+        (a file, or a function to call with each line) is given, output is
+        streamed to it as it arrives rather than returned.
+
+        returns: (exit code, output or None if it was streamed)
+        raises: ADBShellSessionDied if the session couldn't run the command,
+                DMError if it timed out or the session died while running it
+        """
+        with self._lock:
+            if not self._proc or self._proc.poll() is not None:
+                self._start()
+
+            # the markers are quoted in two halves so that, if adb gives us a
+            # pty, the echo of the command line itself doesn't match them
+            token = uuid.uuid4().hex
+            begin = 'BEGIN_' + token
+            end = 'END_' + token
+            quote = lambda marker: '"%s""%s"' % (marker[:1], marker[1:])
+            try:
+                self._proc.stdin.write('echo %s; (%s) </dev/null 2>&1; echo %s"$?"\n' %
+                                       (quote(begin), cmdline, quote(end + ' ')))
+                self._proc.stdin.flush()
+            except (IOError, OSError):
+                self.close()
+                raise ADBShellSessionDied()
+
+            buf = None
+            if outputfile is None:
+                buf = StringIO.StringIO()
+                outputfile = buf
+            output = _ShellOutput(outputfile)
+            started = False
+            streamed = False
+            deadline = time.time() + timeout
+            while True:
+                try:
+                    line = self._lines.get(True, max(0, deadline - time.time()))
+                except Queue.Empty:
+                    self.close()
+                    raise DMError("Timeout exceeded for shell call", timeout=True)
+                if line is None:
+                    self.close()
+                    if streamed:
+                        # some output has gone already, so it can't be rerun
+                        raise DMError("adb shell exited while running '%s'" % cmdline)
+                    raise ADBShellSessionDied()
+
+                if not started:
+                    started = line.rstrip('\r\n') == begin
+                    continue
+                # output without a trailing newline runs into the end marker
+                i = line.find(end + ' ')
+                if i >= 0:
+                    output.write(line[:i])
+                    output.finish()
+                    return (int(line[i + len(end) + 1:].split()[0]),
+                            buf.getvalue() if buf else None)
+                output.write(line)
+                streamed = buf is None
+
+class _ShellResult(object):
+    """
+    Stands in for the Popen object returned by _runCmd when a shell command
+    ran without an adb process of its own
+    """
+
+    def __init__(self, returncode, output):
+        self.returncode = returncode
+        self.stdout = StringIO.StringIO(output)
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        return self.returncode
+
+    def communicate(self, input=None):
+        return (self.stdout.read(), None)
+
+class _TimedOutput(object):
+    """
+    The output of a _TimedProcess, which tells it when it has been read to
+    the end
+    """
+
+    def __init__(self, f, finished):
+        self._f = f
+        self._finished = finished
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        if size < 0 or not data:
+            self._finished()
+        return data
+
+    def readline(self, size=-1):
+        line = self._f.readline(size)
+        if not line:
+            self._finished()
+        return line
+
+    def readlines(self):
+        lines = self._f.readlines()
+        self._finished()
+        return lines
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+class _TimedProcess(object):
+    """
+    Wraps the Popen object returned by _runCmd, recording how long the
+    command took once it is seen to have finished: when it is waited for,
+    polled or communicated with, or its output has been read to the end
+    """
+
+    def __init__(self, proc, metrics, operation):
+        self._proc = proc
+        self._metrics = metrics
+        self._operation = operation
+        self._start = time.time()
+        self._recorded = False
+        self.stdout = _TimedOutput(proc.stdout, self._finished)
+
+    def _finished(self):
+        if not self._recorded:
+            self._recorded = True
+            self._metrics.record(self._operation, time.time() - self._start)
+
+    def poll(self):
+        returncode = self._proc.poll()
+        if returncode is not None:
+            self._finished()
+        return returncode
+
+    def wait(self):
+        returncode = self._proc.wait()
+        self._finished()
+        return returncode
+
+    def communicate(self, input=None):
+        output = self._proc.communicate(input)
+        self._finished()
+        return output
+
+    def __getattr__(self, name):
+        return getattr(self._proc, name)
+
+class _PullJournal(object):
+    """
+    The files getDirectory has pulled into a directory so far, with their
+    size and modification time on the device and their md5 hash, kept in
+    a JSON file there so that an interrupted pull can be resumed
+    """
+
+    # least seconds between saves while files are being pulled
+    save_interval = 1
+
+    def __init__(self, path, remoteDir):
+        self.path = path
+        self.remoteDir = remoteDir
+        self._files = {}
+        self._saved = time.time()
+        try:
+            with open(path) as f:
+                journal = json.load(f)
+            if journal.get('remoteDir') == remoteDir:
+                self._files = journal.get('files', {})
+        except (IOError, ValueError, AttributeError):
+            pass
+
+    def get(self, relName):
+        return self._files.get(relName)
+
+    def add(self, relName, size, mtime, hash):
+        self._files[relName] = { 'size': size, 'mtime': mtime, 'hash': hash }
+        if time.time() - self._saved >= self.save_interval:
+            self.save()
+
+    def save(self):
+        (fd, tmpPath) = tempfile.mkstemp(dir=os.path.dirname(self.path),
+                                         prefix='.mozdevice-pull')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({ 'remoteDir': self.remoteDir, 'files': self._files }, f)
+        os.rename(tmpPath, self.path)
+        self._saved = time.time()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
 
 class DeviceManagerADB(DeviceManager):
 
@@ -20,14 +268,54 @@ class DeviceManagerADB(DeviceManager):
     _pollingInterval = 0.01
     _packageName = None
     _tempDir = None
+    _hasUnzip = False
+    _capabilityCache = None
+    _deviceIdentity = None
+    _havePidof = None
+    _haveMd5sum = None
     default_timeout = 300
+    reboot_timeout = 600
+
+    # pushDir splits trees bigger than this into several archives...
+    push_shard_size = 32 * 1024 * 1024
+    # ...up to this many, pushed in parallel
+    push_max_shards = 4
+    # largest archive kept in memory rather than in a temporary file
+    push_spool_size = 16 * 1024 * 1024
+    # whether pushFile checks the pushed file's md5 hash on the device
+    push_validate = False
+    # longest md5sum command line used when hashing many files at once
+    hash_cmdline_limit = 4096
+    # getDirectory pulls this many files at once
+    pull_workers = 4
+    # getDirectory's record of the files it has pulled, kept in the local
+    # directory until the whole tree is there
+    pull_journal_name = '.mozdevice-pull.json'
 
     def __init__(self, host=None, port=5555, retryLimit=5, packageName='fennec',
-                 adbPath='adb', deviceSerial=None, deviceRoot=None, **kwargs):
+                 adbPath='adb', deviceSerial=None, deviceRoot=None,
+                 useShellSession=False, useADBClient=False, capabilityCache=None,
+                 metrics=None, **kwargs):
         self.host = host
         self.port = port
         self.retryLimit = retryLimit
         self.deviceRoot = deviceRoot
+        # statistics about the commands run
+        self.metrics = metrics or DeviceMetrics()
+
+        # run shell commands through one long-lived adb shell rather than
+        # starting adb for each of them
+        self._useShellSession = useShellSession
+        self._session = None
+
+        # talk to the adb server directly for shell commands and file
+        # transfers, rather than running adb at all
+        self._client = None
+        if useADBClient:
+            serial = deviceSerial
+            if not serial and host:
+                serial = "%s:%s" % (host, port)
+            self._client = adbclient.ADBClient(serial)
 
         # the path to adb, or 'adb' to assume that it's on the PATH
         self._adbPath = adbPath
@@ -51,9 +339,15 @@ class DeviceManagerADB(DeviceManager):
         if self.host:
             self._connectRemoteADB()
 
+        # a CapabilityCache lets us skip probing a device we've seen before
+        self._capabilityCache = capabilityCache
+
         # verify that we can connect to the device. can't continue
         self._verifyDevice()
 
+        if capabilityCache and self._loadCapabilities():
+            return
+
         # set up device root
         self._setupDeviceRoot()
 
@@ -76,7 +370,14 @@ class DeviceManagerADB(DeviceManager):
         except DMError:
             pass
 
+        if capabilityCache:
+            self._saveCapabilities()
+
     def __del__(self):
+        if self._session:
+            self._session.close()
+        if self._client:
+            self._client.close()
         if self.host:
             self._disconnectRemoteADB()
 
@@ -91,9 +392,6 @@ class DeviceManagerADB(DeviceManager):
         timeout - specified in seconds, defaults to 'default_timeout'
         root - Specifies whether command requires root privileges
         """
-        # FIXME: this function buffers all output of the command into memory,
-        # always. :(
-
         # If requested to run as root, check that we can actually do that
         if root and not self._haveRootShell and not self._haveSu:
             raise DMError("Shell command '%s' requested to run as root but root "
@@ -108,55 +406,138 @@ class DeviceManagerADB(DeviceManager):
             cmdline = "su -c \"%s\"" % self._escapedCommandLine(cmd)
         else:
             cmdline = self._escapedCommandLine(cmd)
-        cmdline += "; echo $?"
 
         # prepend cwd and env to command if necessary
-        if cwd:
-            cmdline = "cd %s; %s" % (cwd, cmdline)
-        if env:
-            envstr = '; '.join(map(lambda x: 'export %s=%s' % (x[0], x[1]), env.iteritems()))
-            cmdline = envstr + "; " + cmdline
+        def wrap(cmdline):
+            if cwd:
+                cmdline = "cd %s; %s" % (cwd, cmdline)
+            if env:
+                envstr = '; '.join(map(lambda x: 'export %s=%s' % (x[0], x[1]), env.iteritems()))
+                cmdline = envstr + "; " + cmdline
+            return cmdline
+
+        if not timeout:
+            # We are asserting that all commands will complete in this time unless otherwise specified
+            timeout = self.default_timeout
+        timeout = int(timeout)
+
+        with self.metrics.measure(self._operationName(["shell"] + cmd)):
+            return self._shell(wrap(cmdline), outputfile, timeout)
+
+    def _shell(self, cmdline, outputfile, timeout):
+        """
+        Does the work of shell() with the final command line
+        """
+        if self._client:
+            return self._client.shell(cmdline, outputfile, timeout)
+
+        session = self._getShellSession()
+        if session:
+            try:
+                return session.run(cmdline, timeout, outputfile)[0]
+            except ADBShellSessionDied:
+                self.metrics.countReconnect()
 
         # all output should be in stdout
         args=[self._adbPath]
         if self._deviceSerial:
             args.extend(['-s', self._deviceSerial])
-        args.extend(["shell", cmdline])
+        args.extend(["shell", cmdline + "; echo $?"])
 
-        procOut = tempfile.SpooledTemporaryFile()
         procErr = tempfile.SpooledTemporaryFile()
-        proc = subprocess.Popen(args, stdout=procOut, stderr=procErr)
-
-        if not timeout:
-            # We are asserting that all commands will complete in this time unless otherwise specified
-            timeout = self.default_timeout
-
-        timeout = int(timeout)
-        start_time = time.time()
-        ret_code = proc.poll()
-        while ((time.time() - start_time) <= timeout) and ret_code == None:
-            time.sleep(self._pollingInterval)
-            ret_code = proc.poll()
-        if ret_code == None:
-            proc.kill()
-            raise DMError("Timeout exceeded for shell call")
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=procErr)
 
-        procOut.seek(0)
-        outputfile.write(procOut.read().rstrip('\n'))
-        procOut.close()
+        # stream the output as it arrives, holding back the last line, which
+        # is the return code
+        output = _ShellOutput(outputfile)
+        if self._waitForProcess(proc, timeout, output) is None:
+            raise DMError("Timeout exceeded for shell call", timeout=True)
         procErr.close()
 
-        lastline = _pop_last_line(outputfile)
-        if lastline:
-            m = re.search('([0-9]+)', lastline)
-            if m:
-                return_code = m.group(1)
-                outputfile.seek(-2, 2)
-                outputfile.truncate() # truncate off the return code
-                return int(return_code)
+        m = output.finish('([0-9]+)\s*$')
+        if m:
+            return int(m.group(1))
 
         return None
 
+    def _streamShell(self, cmd, lineCallback, root=False):
+        """
+        Starts a shell command which runs until it is stopped (like logcat)
+        in the background, calling lineCallback with each line of its output
+        as it arrives and then with None once the command has ended
+
+        returns: a function which stops the command
+        """
+        # a long-running command would tie up the native client's or the
+        # shell session's connection, so it gets an adb process of its own
+        cmdline = self._escapedCommandLine(cmd)
+        if root and not self._haveRootShell:
+            cmdline = "su -c \"%s\"" % cmdline
+        args = [self._adbPath]
+        if self._deviceSerial:
+            args.extend(['-s', self._deviceSerial])
+        args.extend(["shell", cmdline])
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+        def read():
+            for line in iter(proc.stdout.readline, ''):
+                lineCallback(line)
+            proc.wait()
+            lineCallback(None)
+        t = threading.Thread(target=read)
+        t.daemon = True
+        t.start()
+
+        def stop():
+            if proc.poll() is None:
+                try:
+                    proc.kill()
+                except OSError:
+                    pass
+            t.join()
+        return stop
+
+    def _getShellSession(self):
+        """
+        Returns the persistent shell session, or None if it isn't enabled
+        """
+        if not self._useShellSession:
+            return None
+        if not self._session:
+            args = [self._adbPath]
+            if self._deviceSerial:
+                args.extend(['-s', self._deviceSerial])
+            self._session = ADBShellSession(args)
+        return self._session
+
+    def _waitForProcess(self, proc, timeout, outputfile=None):
+        """
+        Waits for proc to finish, draining any output pipes, and kills it if
+        it takes longer than timeout seconds. If outputfile is given, the
+        process's stdout is copied to it in pieces as it arrives.
+
+        returns: the exit code, or None if the process had to be killed
+        """
+        killed = []
+        def kill():
+            killed.append(True)
+            try:
+                proc.kill()
+            except OSError:
+                pass
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+        try:
+            if outputfile:
+                for data in iter(lambda: os.read(proc.stdout.fileno(), 65536), ''):
+                    outputfile.write(data)
+            proc.communicate()
+        finally:
+            timer.cancel()
+        if killed:
+            return None
+        return proc.returncode
+
     def _connectRemoteADB(self):
         self._checkCmd(["connect", self.host + ":" + str(self.port)])
 
@@ -182,10 +563,23 @@ class DeviceManagerADB(DeviceManager):
                     retryLimit=retryLimit)
             self.shellCheckOutput(["dd", "if=" + remoteTmpFile, "of=" + destname])
             self.shellCheckOutput(["rm", remoteTmpFile])
+        elif self._client:
+            with self.metrics.measure('push') as measurement:
+                st = os.stat(localname)
+                self._client.push(localname, destname, st.st_mode & 0777)
+                measurement.bytesSent = st.st_size
         else:
             self._checkCmd(["push", os.path.realpath(localname), destname],
                     retryLimit=retryLimit)
 
+        if self.push_validate:
+            localHash = self._getLocalHash(localname)
+            remoteHash = self.getRemoteHashes([destname])[destname]
+            if localHash != remoteHash:
+                raise DMError("Automation Error: Push File failed to Validate! (file: %s, "
+                              "localhash: %s, remotehash: %s)" %
+                              (localname, localHash, remoteHash))
+
     def mkDir(self, name):
         """
         Creates a single directory on the device file system
@@ -197,6 +591,9 @@ class DeviceManagerADB(DeviceManager):
     def pushDir(self, localDir, remoteDir, retryLimit=None):
         """
         Push localDir from host to remoteDir on the device
+
+        returns: dict of transfer statistics if the directory was pushed as
+                 zip archives (see _pushArchives), None otherwise
         """
         # adb "push" accepts a directory as an argument, but if the directory
         # contains symbolic links, the links are pushed, rather than the linked
@@ -207,17 +604,7 @@ class DeviceManagerADB(DeviceManager):
             self.mkDirs(remoteDir+"/x")
         if self._useZip:
             try:
-                localZip = tempfile.mktemp() + ".zip"
-                remoteZip = remoteDir + "/adbdmtmp.zip"
-                subprocess.Popen(["zip", "-r", localZip, '.'], cwd=localDir,
-                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-                self.pushFile(localZip, remoteZip, retryLimit=retryLimit)
-                os.remove(localZip)
-                data = self._runCmdAs(["shell", "unzip", "-o", remoteZip,
-                                       "-d", remoteDir]).stdout.read()
-                self._checkCmdAs(["shell", "rm", remoteZip], retryLimit=retryLimit)
-                if re.search("unzip: exiting", data) or re.search("Operation not permitted", data):
-                    raise Exception("unzip failed, or permissions error")
+                return self._pushArchives(localDir, remoteDir, retryLimit)
             except:
                 print "zip/unzip failure: falling back to normal push"
                 self._useZip = False
@@ -230,10 +617,104 @@ class DeviceManagerADB(DeviceManager):
             self._checkCmd(["push", tmpDirTarget, remoteDir], retryLimit=retryLimit)
             shutil.rmtree(tmpDir)
 
+    def _pushArchives(self, localDir, remoteDir, retryLimit):
+        """
+        Pushes localDir as zip archives, built in-process and unzipped on
+        the device. Trees larger than push_shard_size are split into up to
+        push_max_shards archives, which are built and pushed in parallel.
+
+        returns: dict of statistics: files and bytes (as on the host),
+                 archiveBytes (as pushed), shards, seconds, and bytesPerSecond
+        """
+        start = time.time()
+        files = ziparchive.collectFiles(localDir)
+        stats = { 'files': len(files),
+                  'bytes': sum(size for (path, arcname, size) in files),
+                  'archiveBytes': 0,
+                  'shards': 0 }
+        if files:
+            shards = ziparchive.splitShards(files, self.push_shard_size,
+                                            self.push_max_shards)
+            stats['shards'] = len(shards)
+            # unzipping several archives into the same tree at once could
+            # trip over directories being created, so that's done in turn
+            unzipLock = threading.Lock()
+            errors = []
+            sizes = []
+
+            def pushShard(i, shard):
+                try:
+                    sizes.append(self._pushArchive(shard, "%s/adbdmtmp-%d.zip" % (remoteDir, i),
+                                                   remoteDir, retryLimit, unzipLock))
+                except Exception, e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=pushShard, args=(i, shard))
+                       for (i, shard) in enumerate(shards)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            if errors:
+                raise errors[0]
+            stats['archiveBytes'] = sum(sizes)
+
+        stats['seconds'] = time.time() - start
+        stats['bytesPerSecond'] = stats['bytes'] / max(stats['seconds'], 0.001)
+        if self.debug:
+            print "pushed %d files (%d bytes, %d compressed) in %d archive(s): %.1fs, %.1f MB/s" % \
+                (stats['files'], stats['bytes'], stats['archiveBytes'], stats['shards'],
+                 stats['seconds'], stats['bytesPerSecond'] / (1024 * 1024))
+        return stats
+
+    def _pushArchive(self, files, remoteZip, remoteDir, retryLimit, unzipLock):
+        """
+        Builds a zip archive of files, pushes it to remoteZip and unzips it
+        into remoteDir
+
+        returns: size of the archive
+        """
+        # zipfile has to seek back to fill in each file's header, so the
+        # archive can't be written straight into the push; it's spooled
+        # instead, in memory where it's small enough. Pushing through adb
+        # itself needs it to have a name.
+        if self._client and not self._useRunAs:
+            archive = tempfile.SpooledTemporaryFile(self.push_spool_size)
+        else:
+            archive = tempfile.NamedTemporaryFile(suffix=".zip")
+        try:
+            ziparchive.writeZip(files, archive)
+            archive.flush()
+            size = archive.tell()
+            archive.seek(0)
+            if isinstance(archive, tempfile.SpooledTemporaryFile):
+                # the shared client would push the shards one at a time
+                client = adbclient.ADBClient(self._client.serial, self._client.host,
+                                             self._client.port, self._client.timeout)
+                try:
+                    client.push(archive, remoteZip)
+                finally:
+                    client.close()
+            else:
+                self.pushFile(archive.name, remoteZip, retryLimit=retryLimit)
+        finally:
+            archive.close()
+
+        with unzipLock:
+            data = self._runCmdAs(["shell", "unzip", "-o", remoteZip,
+                                   "-d", remoteDir]).stdout.read()
+        self._checkCmdAs(["shell", "rm", remoteZip], retryLimit=retryLimit)
+        if re.search("unzip: exiting", data) or re.search("Operation not permitted", data):
+            raise DMError("unzip failed, or permissions error")
+        return size
+
     def dirExists(self, remotePath):
         """
         Return True if remotePath is an existing directory on the device.
         """
+        if self._client:
+            return self._client.isDir(remotePath)
+
         p = self._runCmd(["shell", "ls", "-a", remotePath + '/'])
 
         data = p.stdout.readlines()
@@ -243,17 +724,6 @@ class DeviceManagerADB(DeviceManager):
                 return False
         return True
 
-    def fileExists(self, filepath):
-        """
-        Return True if filepath exists and is a file on the device file system
-        """
-        p = self._runCmd(["shell", "ls", "-a", filepath])
-        data = p.stdout.readlines()
-        if (len(data) == 1):
-            if (data[0].rstrip() == filepath):
-                return True
-        return False
-
     def removeFile(self, filename):
         """
         Removes filename from the device
@@ -265,10 +735,13 @@ class DeviceManagerADB(DeviceManager):
         """
         Does a recursive delete of directory on the device: rm -Rf remoteDir
         """
-        if (self.dirExists(remoteDir)):
+        entry = self._statPath(remoteDir.strip())
+        if entry is None:
+            return
+        if entry[1] == 'd':
             self._runCmd(["shell", "rm", "-r", remoteDir]).wait()
         else:
-            self.removeFile(remoteDir.strip())
+            self._runCmd(["shell", "rm", remoteDir.strip()]).wait()
 
     def listFiles(self, rootdir):
         """
@@ -276,6 +749,9 @@ class DeviceManagerADB(DeviceManager):
 
         returns array of filenames, ['file1', 'file2', ...]
         """
+        if self._client:
+            return [entry[0] for entry in self._client.listDir(rootdir)]
+
         p = self._runCmd(["shell", "ls", "-a", rootdir])
         data = p.stdout.readlines()
         data[:] = [item.rstrip('\r\n') for item in data]
@@ -315,6 +791,25 @@ class DeviceManagerADB(DeviceManager):
             proc =  p.stdout.readline()
         return ret
 
+    def _pidof(self, name):
+        """
+        Returns the pids of the processes called name using pidof, or None
+        if the device doesn't have it
+        """
+        if self._havePidof is False:
+            return None
+        # not through run-as, as apps can't always see other apps' processes
+        buf = StringIO.StringIO()
+        retcode = self.shell(["pidof", name], buf)
+        output = buf.getvalue()
+        pids = [int(pid) for pid in output.split() if pid.isdigit()]
+        if retcode not in (0, 1) or 'not found' in output or (retcode == 0 and not pids):
+            # pidof is only in Android 6.0 and later
+            self._havePidof = False
+            return None
+        self._havePidof = True
+        return pids
+
     def fireProcess(self, appname, failIfRunning=False):
         """
         Starts a process
@@ -338,6 +833,7 @@ class DeviceManagerADB(DeviceManager):
 
         DEPRECATED: Use shell() or launchApplication() for new code
         """
+        self._invalidateProcessTable()
         if cmd[0] == "am":
             self._checkCmd(["shell"] + cmd)
             return outputFile
@@ -382,7 +878,8 @@ class DeviceManagerADB(DeviceManager):
 
         If forceKill is True, process is killed regardless of state
         """
-        procs = self.getProcessList()
+        procs = self.getProcessTable(maxAge=0)
+        self._invalidateProcessTable()
         for (pid, name, user) in procs:
             if name == appname:
                 args = ["shell", "kill"]
@@ -405,6 +902,18 @@ class DeviceManagerADB(DeviceManager):
         """
         Pulls remoteFile from device to host
         """
+        if self._client:
+            try:
+                with self.metrics.measure('pull') as measurement:
+                    self._client.pull(remoteFile, localFile)
+                    measurement.bytesReceived = os.path.getsize(localFile)
+                return
+            except DMError:
+                # with run-as, the file may just not be readable by the shell
+                # user; fall back to copying it somewhere readable first
+                if not self._useRunAs:
+                    raise
+
         try:
             # First attempt to pull file regularly
             outerr = self._runCmd(["pull",  remoteFile, localFile]).communicate()
@@ -448,11 +957,185 @@ class DeviceManagerADB(DeviceManager):
         """
         self._runPull(remoteFile, localFile)
 
+    def iterFile(self, remoteFile, chunkSize=65536):
+        """
+        Returns an iterator over the contents of remoteFile, in chunks of up
+        to chunkSize bytes. With the native client, the file is streamed
+        from the device as it is received; otherwise it goes through a
+        temporary file on the host.
+        """
+        if not self._client or self._useRunAs:
+            return DeviceManager.iterFile(self, remoteFile, chunkSize)
+        return self._iterTransfer(
+            lambda dm, put: dm._client.pull(remoteFile, _ChunkWriter(put, chunkSize)))
+
     def getDirectory(self, remoteDir, localDir, checkDir=True):
         """
         Copy directory structure from device (remoteDir) to host (localDir)
+
+        The tree is listed with sizes and its files pulled pull_workers at a
+        time, each retried up to retryLimit times. Files already in localDir
+        with the same size and md5 hash as on the device are skipped, and a
+        journal of the files pulled so far is kept in localDir until the
+        whole tree has been pulled, so that a pull which is interrupted
+        carries on where it stopped when run again. Symlinks to files are
+        pulled as the files they point to; symlinks to directories are
+        skipped, as they may lead back into the tree or out of it.
+
+        returns: dict of statistics: files, skipped, bytes (pulled),
+                 seconds and bytesPerSecond
+        """
+        start = time.time()
+        remoteDir = remoteDir.rstrip('/') or '/'
+        if checkDir and not self.dirExists(remoteDir):
+            raise DMError("Automation Error: Error getting directory: %s not a directory" %
+                          remoteDir)
+        if not os.path.exists(localDir):
+            os.makedirs(localDir)
+
+        files = []
+        for (path, entryType, size, mtime) in self.listDirDetailed(remoteDir):
+            relName = posixpath.relpath(path, remoteDir)
+            localPath = os.path.join(localDir, *relName.split('/'))
+            if entryType == 'd':
+                if not os.path.exists(localPath):
+                    os.makedirs(localPath)
+            elif entryType == 'l' and self.dirExists(path):
+                continue
+            elif entryType in ('f', 'l'):
+                # the size listed for a link is that of the link itself
+                files.append((path, relName, localPath,
+                              size if entryType == 'f' else None, mtime))
+
+        journal = _PullJournal(os.path.join(localDir, self.pull_journal_name), remoteDir)
+        pulls = self._unpulledFiles(files, journal)
+        stats = { 'files': len(files),
+                  'skipped': len(files) - len(pulls),
+                  'bytes': 0 }
+
+        errors = []
+        queue = Queue.Queue()
+        for pull in pulls:
+            queue.put(pull)
+        lock = threading.Lock()
+
+        def worker():
+            client = None
+            try:
+                if self._client and not self._useRunAs:
+                    # the shared client would pull the files one at a time
+                    client = adbclient.ADBClient(self._client.serial, self._client.host,
+                                                 self._client.port, self._client.timeout)
+                while not errors:
+                    try:
+                        (remoteFile, relName, localPath, size, mtime) = queue.get_nowait()
+                    except Queue.Empty:
+                        return
+                    self._pullFileChecked(client, remoteFile, localPath, size)
+                    localHash = self._getLocalHash(localPath)
+                    with lock:
+                        stats['bytes'] += os.path.getsize(localPath)
+                        journal.add(relName, size, mtime, localHash)
+            except Exception, e:
+                # whatever went wrong, it is raised once the other workers
+                # have stopped, so that the journal is kept
+                errors.append(e)
+            finally:
+                if client:
+                    client.close()
+
+        threads = [threading.Thread(target=worker)
+                   for i in range(min(self.pull_workers, len(pulls)))]
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            if errors:
+                raise errors[0]
+        except:
+            # the files pulled so far needn't be pulled again next time
+            journal.save()
+            raise
+        journal.remove()
+
+        stats['seconds'] = time.time() - start
+        stats['bytesPerSecond'] = stats['bytes'] / max(stats['seconds'], 0.001)
+        if self.debug:
+            print "pulled %d of %d files (%d bytes, %d already there): %.1fs, %.1f MB/s" % \
+                (len(pulls), stats['files'], stats['bytes'], stats['skipped'],
+                 stats['seconds'], stats['bytesPerSecond'] / (1024 * 1024))
+        return stats
+
+    def _unpulledFiles(self, files, journal):
+        """
+        Returns those of the (remoteFile, relName, localPath, size, mtime)
+        tuples in files which don't already have an identical copy on the
+        host: one with the size and hash the journal recorded when it was
+        pulled, or failing that one with the same size and the same md5
+        hash as on the device
+        """
+        pulls = []
+        unknown = []
+        for entry in files:
+            (remoteFile, relName, localPath, size, mtime) = entry
+            if not os.path.isfile(localPath) or \
+                    (size is not None and os.path.getsize(localPath) != size):
+                pulls.append(entry)
+                continue
+            pulled = journal.get(relName)
+            if pulled and pulled['size'] == size and pulled['mtime'] == mtime and \
+                    pulled['hash'] == self._getCachedLocalHash(localPath):
+                continue
+            unknown.append(entry)
+
+        if unknown and self._haveMd5sum is not False:
+            # one batch of md5sum commands for all of them; without md5sum
+            # the files would have to be pulled to hash them anyway
+            hashes = self.getRemoteHashes([entry[0] for entry in unknown])
+            for entry in unknown:
+                localHash = self._getCachedLocalHash(entry[2])
+                if hashes[entry[0]] and hashes[entry[0]] == localHash:
+                    journal.add(entry[1], entry[3], entry[4], localHash)
+                else:
+                    pulls.append(entry)
+        else:
+            pulls.extend(unknown)
+        return pulls
+
+    def _pullFileChecked(self, client, remoteFile, localFile, size):
         """
-        self._runCmd(["pull", remoteDir, localDir])
+        Pulls remoteFile to localFile with client (or adb if None), by way
+        of a partial file which only replaces localFile once it has been
+        pulled whole. Retries up to retryLimit times.
+        """
+        partFile = localFile + '.part'
+        for attempt in range(1, self.retryLimit + 1):
+            try:
+                if client:
+                    with self.metrics.measure('pull') as measurement:
+                        client.pull(remoteFile, partFile)
+                        measurement.bytesReceived = os.path.getsize(partFile)
+                else:
+                    self._runPull(remoteFile, partFile)
+                if not os.path.isfile(partFile):
+                    raise DMError("Error pulling remote file '%s'" % remoteFile)
+                if size is not None and os.path.getsize(partFile) != size:
+                    raise DMError("Error pulling remote file '%s': got %d of %d bytes" %
+                                  (remoteFile, os.path.getsize(partFile), size))
+                if os.path.exists(localFile):
+                    os.remove(localFile)
+                os.rename(partFile, localFile)
+                return
+            except DMError:
+                if attempt == self.retryLimit:
+                    if os.path.exists(partFile):
+                        os.remove(partFile)
+                    raise
+                self.metrics.countRetry('pull')
+                if self.debug:
+                    print "retrying pull of %s (attempt %d of %d)" % \
+                        (remoteFile, attempt + 1, self.retryLimit)
 
     def validateFile(self, remoteFile, localFile):
         """
@@ -468,16 +1151,109 @@ class DeviceManagerADB(DeviceManager):
         """
         Return the md5 sum of a file on the device
         """
-        localFile = tempfile.mkstemp()[1]
-        localFile = self._runPull(remoteFile, localFile)
+        return self.getRemoteHashes([remoteFile])[remoteFile]
+
+    def getRemoteHashes(self, paths):
+        """
+        Returns the md5 hashes of a list of files on the device, computed on
+        the device by md5sum with as many files per command as fit on a
+        command line. Devices without md5sum have the files pulled and
+        hashed on the host instead.
+
+        returns: dict of hashes by path, with None for any file which
+                 couldn't be hashed
+        """
+        paths = list(paths)
+        hashes = self._md5sumHashes(paths)
+        if self._haveMd5sum is False:
+            for path in paths:
+                hashes[path] = self._pullHash(path)
+        return hashes
+
+    def _md5sumHashes(self, paths):
+        """
+        Hashes a list of files on the device with md5sum, as many files per
+        command as fit on a command line
+
+        returns: dict of hashes by path, with None for any file which
+                 couldn't be hashed, including all of them if the device
+                 turns out not to have md5sum
+        """
+        hashes = dict((path, None) for path in paths)
 
-        if localFile is None:
+        # split the paths so that each command line, the spaces between the
+        # arguments included, stays within hash_cmdline_limit characters
+        batches = []
+        length = 0
+        for path in paths:
+            if batches and length + 1 + len(path) <= self.hash_cmdline_limit:
+                batches[-1].append(path)
+                length += 1 + len(path)
+            else:
+                batches.append([path])
+                length = len("md5sum") + 1 + len(path)
+
+        for batch in batches:
+            if self._haveMd5sum is False:
+                break
+            buf = StringIO.StringIO()
+            # md5sum fails if any of the files is missing, but still hashes
+            # the rest
+            retcode = self.shell(["md5sum"] + batch, buf)
+            output = buf.getvalue()
+            found = False
+            for line in output.splitlines():
+                fields = line.strip().split(None, 1)
+                if len(fields) == 2 and fields[1] in hashes and len(fields[0]) == 32:
+                    hashes[fields[1]] = fields[0]
+                    found = True
+            if self._haveMd5sum is None:
+                if not found and (retcode == 127 or 'not found' in output):
+                    # md5sum is only in Android 6.0 and later
+                    self._haveMd5sum = False
+                elif found:
+                    self._haveMd5sum = True
+        return hashes
+
+    def _pullHash(self, remoteFile):
+        """
+        Returns the md5 sum of a file on the device by pulling it, or None if
+        it can't be pulled
+        """
+        (fd, localFile) = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self._runPull(remoteFile, localFile)
+            if not os.path.getsize(localFile) and not self.fileExists(remoteFile):
+                return None
+            return self._getLocalHash(localFile)
+        except DMError:
             return None
+        finally:
+            os.remove(localFile)
 
-        md5 = self._getLocalHash(localFile)
-        os.remove(localFile)
+    def _getRemoteDirHashes(self, remoteDir):
+        """
+        Returns the md5 hashes of all files under remoteDir on the device,
+        listed with a single ls command and hashed with as few md5sum
+        commands as fit the files on their command lines
+        """
+        if self._haveMd5sum is False:
+            # pulling the files to hash them costs as much as pushing them
+            return {}
+        try:
+            paths = [path for (path, entryType, size, mtime)
+                     in self.listDirDetailed(remoteDir) if entryType == 'f']
+            remoteHashes = self._md5sumHashes(paths)
+        except DMError:
+            return {}
 
-        return md5
+        hashes = {}
+        prefix = remoteDir + '/'
+        for (path, md5) in remoteHashes.iteritems():
+            if md5 is not None and path.startswith(prefix):
+                hashes[path[len(prefix):]] = md5
+        return hashes
 
     def _setupDeviceRoot(self):
         """
@@ -563,12 +1339,32 @@ class DeviceManagerADB(DeviceManager):
         """
         Reboots the device
         """
-        self._runCmd(["reboot"])
         if (not wait):
+            self._runCmd(["reboot"])
             return
-        countdown = 40
-        while (countdown > 0):
-            self._checkCmd(["wait-for-device", "shell", "ls", "/sbin"])
+        self.rebootAsync().result()
+
+    def rebootAsync(self, monitor=None, timeout=None, **kwargs):
+        """
+        Reboots the device without waiting for it to come back.
+
+        monitor - RebootMonitor to wait on, defaults to the shared one
+        timeout - seconds to wait, defaults to reboot_timeout
+
+        returns: RebootHandle
+        """
+        monitor = monitor or rebootmonitor.getDefaultMonitor()
+        self._checkCmd(["reboot"])
+
+        adbArgs = [self._adbPath]
+        if self._deviceSerial:
+            adbArgs.extend(['-s', self._deviceSerial])
+        connectArgs = None
+        if self.host:
+            connectArgs = [self._adbPath, "connect", self.host + ":" + str(self.port)]
+        return monitor.watch(rebootmonitor.ADBProbe(adbArgs, connectArgs),
+                             timeout or self.reboot_timeout,
+                             name=self._deviceSerial or self.host)
 
     def updateApp(self, appBundlePath, **kwargs):
         """
@@ -658,6 +1454,23 @@ class DeviceManagerADB(DeviceManager):
         self.reboot()
         return
 
+    # names metrics are recorded under for shell commands, by the program run
+    _shellOperations = { 'md5sum': 'hash', 'ls': 'ls', 'dd': 'push' }
+
+    @classmethod
+    def _operationName(cls, args):
+        """
+        Returns the name metrics are recorded under for an adb command
+        """
+        if args[0] != "shell":
+            return args[0]
+        program = args[1:]
+        if program[:1] == ["run-as"]:
+            program = program[2:]
+        if not program:
+            return 'shell'
+        return cls._shellOperations.get((program[0].split() or [''])[0].split('/')[-1], 'shell')
+
     def _runCmd(self, args):
         """
         Runs a command using adb
@@ -674,7 +1487,28 @@ class DeviceManagerADB(DeviceManager):
             args.insert(1, "run-as")
             args.insert(2, self._packageName)
         finalArgs.extend(args)
-        return subprocess.Popen(finalArgs, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+        operation = self._operationName(args)
+        if self._client and args[0] == "shell" and len(args) > 1:
+            buf = StringIO.StringIO()
+            with self.metrics.measure(operation):
+                return_code = self._client.shell(' '.join(args[1:]), buf, self.default_timeout)
+            return _ShellResult(return_code, buf.getvalue())
+
+        session = self._getShellSession()
+        if session and args[0] == "shell" and len(args) > 1:
+            try:
+                # adb shell joins its arguments with spaces, and so do we
+                with self.metrics.measure(operation):
+                    return _ShellResult(*session.run(' '.join(args[1:]),
+                                                     self.default_timeout))
+            except ADBShellSessionDied:
+                self.metrics.countReconnect()
+
+        # the caller waits for the process, which records how long it took
+        return _TimedProcess(subprocess.Popen(finalArgs, stdout=subprocess.PIPE,
+                                              stderr=subprocess.STDOUT),
+                             self.metrics, operation)
 
     def _runCmdAs(self, args):
         """
@@ -713,20 +1547,47 @@ class DeviceManagerADB(DeviceManager):
             timeout = self.default_timeout
 
         timeout = int(timeout)
+        with self.metrics.measure(self._operationName(args)) as measurement:
+            ret_code = self._checkCmdWithRetries(args, finalArgs, timeout, retryLimit)
+            if args[0] == "push" and os.path.isfile(args[1]):
+                measurement.bytesSent = os.path.getsize(args[1])
+            elif args[0] == "pull" and len(args) > 2 and os.path.isfile(args[2]):
+                measurement.bytesReceived = os.path.getsize(args[2])
+            return ret_code
+
+    def _checkCmdWithRetries(self, args, finalArgs, timeout, retryLimit):
+        """
+        Does the work of _checkCmd, retrying commands which time out
+        """
+        session = self._getShellSession()
+        if session and (args[0] != "shell" or len(args) < 2):
+            session = None
+        if self._client and args[0] == "shell" and len(args) > 1:
+            return self._client.shell(' '.join(args[1:]), StringIO.StringIO(), timeout)
+
         retries = 0
         while retries < retryLimit:
+            if retries:
+                self.metrics.countRetry(self._operationName(args))
+            if session:
+                try:
+                    return session.run(' '.join(args[1:]), timeout)[0]
+                except ADBShellSessionDied:
+                    self.metrics.countReconnect()
+                    session = None
+                    continue
+                except DMError:
+                    retries += 1
+                    continue
+
             proc = subprocess.Popen(finalArgs, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            start_time = time.time()
-            ret_code = proc.poll()
-            while ((time.time() - start_time) <= timeout) and ret_code == None:
-                time.sleep(self._pollingInterval)
-                ret_code = proc.poll()
+            ret_code = self._waitForProcess(proc, timeout)
             if ret_code == None:
-                proc.kill()
                 retries += 1
                 continue
             return ret_code
-        raise DMError("Timeout exceeded for _checkCmd call after %d retries." % retries)
+        raise DMError("Timeout exceeded for _checkCmd call after %d retries." % retries,
+                      timeout=True)
 
     def _checkCmdAs(self, args, timeout=None, retryLimit=None):
         """
@@ -761,10 +1622,91 @@ class DeviceManagerADB(DeviceManager):
             self._checkCmdAs(["shell", "chmod", mask, remoteDir.strip()])
             print "chmod " + remoteDir.strip()
 
+    def _getDeviceIdentity(self):
+        """
+        Returns (serial, build fingerprint) for the device, which identify
+        its entry in the capability cache
+        """
+        if not self._deviceIdentity:
+            output = self._runCmd(["shell", "getprop ro.serialno; "
+                                   "getprop ro.build.fingerprint"]).communicate()[0]
+            lines = [line.strip() for line in output.splitlines()]
+            lines += [''] * (2 - len(lines))
+            serial = self._deviceSerial
+            if not serial and self.host:
+                serial = "%s:%s" % (self.host, self.port)
+            self._deviceIdentity = (serial or lines[0], lines[1])
+        return self._deviceIdentity
+
+    def _loadCapabilities(self):
+        """
+        Sets up the device from the capability cache, if it has an entry for
+        the device
+
+        returns: True if it did, False if the device needs to be probed
+        """
+        (serial, fingerprint) = self._getDeviceIdentity()
+        if not serial or not fingerprint:
+            return False
+        capabilities = self._capabilityCache.get(serial, fingerprint)
+        if not capabilities:
+            return False
+
+        if self.deviceRoot:
+            # an explicit device root still has to be checked
+            self._setupDeviceRoot()
+        else:
+            self.deviceRoot = capabilities['deviceRoot']
+        self._haveRootShell = capabilities['haveRootShell']
+        self._haveSu = capabilities['haveSu']
+
+        # whether run-as works depends on the package
+        if capabilities['runAsPackage'] == self._packageName:
+            self._useRunAs = capabilities['useRunAs']
+            if self._useRunAs:
+                print "will execute commands via run-as " + self._packageName
+        else:
+            try:
+                self._verifyRunAs()
+            except DMError:
+                pass
+            self._saveCapabilities(unzip=capabilities['unzip'])
+
+        self._useZip = capabilities['unzip']
+        if self._useZip:
+            print "will use zip to push directories"
+        return True
+
+    def _saveCapabilities(self, unzip=None):
+        """
+        Stores what was found out about the device in the capability cache
+        """
+        (serial, fingerprint) = self._getDeviceIdentity()
+        if not serial or not fingerprint:
+            return
+        if unzip is None:
+            unzip = self._hasUnzip
+        self._capabilityCache.put(serial, fingerprint, {
+                'deviceRoot': self.deviceRoot,
+                'haveRootShell': self._haveRootShell,
+                'haveSu': self._haveSu,
+                'runAsPackage': self._packageName,
+                'useRunAs': self._useRunAs,
+                'unzip': unzip })
+
     def _verifyADB(self):
         """
         Check to see if adb itself can be executed.
         """
+        if self._client:
+            try:
+                self._client.hostCommand('version')
+                return
+            except DMError:
+                # no adb server to talk to yet: check that adb can be run,
+                # which starts one when it's needed
+                pass
+
         if self._adbPath != 'adb':
             if not os.access(self._adbPath, os.X_OK):
                 raise DMError("invalid adb path, or adb not executable: %s", self._adbPath)
@@ -779,21 +1721,35 @@ class DeviceManagerADB(DeviceManager):
     def _verifyDevice(self):
         # If there is a device serial number, see if adb is connected to it
         if self._deviceSerial:
-            deviceStatus = None
-            proc = subprocess.Popen([self._adbPath, "devices"],
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.STDOUT)
-            for line in proc.stdout:
-                m = re.match('(.+)?\s+(.+)$', line)
-                if m:
-                    if self._deviceSerial == m.group(1):
-                        deviceStatus = m.group(2)
+            devices = None
+            if self._client:
+                try:
+                    devices = self._client.devices()
+                except DMError:
+                    pass
+            if devices is None:
+                devices = []
+                proc = subprocess.Popen([self._adbPath, "devices"],
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT)
+                for line in proc.stdout:
+                    m = re.match('(.+)?\s+(.+)$', line)
+                    if m:
+                        devices.append((m.group(1), m.group(2)))
+            deviceStatus = dict(devices).get(self._deviceSerial)
             if deviceStatus == None:
                 raise DMError("device not found: %s" % self._deviceSerial)
             elif deviceStatus != "device":
                 raise DMError("bad status for device %s: %s" % (self._deviceSerial, deviceStatus))
 
         # Check to see if we can connect to device and run a simple command
+        if self._capabilityCache:
+            # getting what the cache needs to know about the device does that
+            # just as well
+            if not self._getDeviceIdentity()[1]:
+                raise DMError("unable to connect to device")
+            return
+
         ret = None
         try:
             ret = self._checkCmd(["shell", "echo"])
@@ -865,19 +1821,13 @@ class DeviceManagerADB(DeviceManager):
         else:
             return False
 
-    def _isLocalZipAvailable(self):
-        try:
-            subprocess.check_call(["zip", "-?"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        except:
-            return False
-        return True
-
     def _verifyZip(self):
-        # If "zip" can be run locally, and "unzip" can be run remotely, then pushDir
-        # can use these to push just one file per directory -- a significant
-        # optimization for large directories.
+        # If "unzip" can be run remotely, then pushDir can push a directory as
+        # a few zip archives (built in-process) rather than file by file -- a
+        # significant optimization for large directories.
         self._useZip = False
-        if (self._isUnzipAvailable() and self._isLocalZipAvailable()):
+        self._hasUnzip = self._isUnzipAvailable()
+        if self._hasUnzip:
             print "will use zip to push directories"
             self._useZip = True
         else:
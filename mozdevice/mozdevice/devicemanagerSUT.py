@@ -2,35 +2,139 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import copy
+import hashlib
+import Queue
 import select
 import socket
+import threading
 import time
 import os
 import re
 import posixpath
 import subprocess
 import StringIO
-from devicemanager import DeviceManager, DMError, NetworkTools, _pop_last_line
+import sys
+from contextlib import contextmanager
+from devicemanager import DeviceManager, DMError, NetworkTools, _ChunkWriter, _ShellOutput
+from metrics import DeviceMetrics
+import rebootmonitor
 import errno
 from distutils.version import StrictVersion
 
+class SUTConnectionPool(object):
+    """
+    A bounded pool of connections to a SUT agent, which can be checked out
+    from any thread.
+
+    Each connection is a copy of the device manager with a socket of its
+    own, so it connects lazily and reconnects and retries independently of
+    the others.
+    """
+
+    def __init__(self, dm, size):
+        self._dm = dm
+        self.size = size
+        self._idle = []
+        self._created = 0
+        # connections checked out, and those of them which were checked out
+        # when the pool was closed, to be closed when they're checked in
+        self._checkedOut = set()
+        self._closing = set()
+        self._cond = threading.Condition()
+
+    def checkout(self, timeout=None):
+        """
+        Returns an idle connection, creating one if the pool isn't full yet.
+        Waits up to timeout seconds (forever if None) for one to be checked
+        back in otherwise.
+        """
+        expires = None
+        if timeout is not None:
+            expires = time.time() + timeout
+
+        with self._cond:
+            while not self._idle and self._created >= self.size:
+                if expires is None:
+                    self._cond.wait()
+                else:
+                    remaining = expires - time.time()
+                    if remaining <= 0:
+                        raise DMError("Automation Error: no connection to %s available "
+                                      "after %s seconds" % (self._dm.host, timeout))
+                    self._cond.wait(remaining)
+            if self._idle:
+                conn = self._idle.pop()
+                self._checkedOut.add(conn)
+                return conn
+            self._created += 1
+
+        conn = self._dm._newConnection()
+        with self._cond:
+            self._checkedOut.add(conn)
+        return conn
+
+    def checkin(self, conn):
+        """
+        Returns a connection to the pool
+        """
+        with self._cond:
+            self._checkedOut.discard(conn)
+            if conn in self._closing:
+                self._closing.discard(conn)
+                self._closeConnection(conn)
+            self._idle.append(conn)
+            self._cond.notify()
+
+    def close(self):
+        """
+        Closes the sockets of all idle connections, and those of the
+        connections checked out as they are checked back in. Connections
+        reconnect if they are used again.
+        """
+        with self._cond:
+            for conn in self._idle:
+                self._closeConnection(conn)
+            self._closing.update(self._checkedOut)
+
+    @staticmethod
+    def _closeConnection(conn):
+        if conn._sock:
+            conn._sock.close()
+            conn._sock = None
+
+
 class DeviceManagerSUT(DeviceManager):
     debug = 2
     _base_prompt = '$>'
-    _base_prompt_re = '\$\>'
     _prompt_sep = '\x00'
-    _prompt_regex = '.*(' + _base_prompt_re + _prompt_sep + ')'
+    _agentWarning = '##AGENT-WARNING##'
     _agentErrorRE = re.compile('^##AGENT-WARNING##\ ?(.*)')
     default_timeout = 300
 
     reboot_timeout = 600
     reboot_settling_time = 60
 
-    def __init__(self, host, port = 20701, retryLimit = 5, deviceRoot = None, **kwargs):
+    # size of the pieces files are read and sent in by pushFile()
+    push_chunk_size = 65536
+    # maximum number of commands written before reading their responses
+    pipeline_depth = 64
+    # largest amount of data read from the agent in one go
+    recv_buffer_size = 65536
+
+    def __init__(self, host, port = 20701, retryLimit = 5, deviceRoot = None,
+                 poolSize = 1, metrics = None, **kwargs):
         self.host = host
         self.port = port
         self.retryLimit = retryLimit
+        # statistics about the commands sent, shared with pooled connections
+        self.metrics = metrics or DeviceMetrics()
+        # number of connections multi-file operations are spread over
+        self.poolSize = poolSize
+        self._pool = SUTConnectionPool(self, poolSize)
         self._sock = None
+        self._recvBuf = ''
+        self._bytesReceived = 0
         self._everConnected = False
         self.deviceRoot = deviceRoot
 
@@ -43,6 +147,94 @@ class DeviceManagerSUT(DeviceManager):
         self.agentProductName = ver_re.group(1)
         self.agentVersion = ver_re.group(2)
 
+    def close(self):
+        """
+        Closes the connection to the agent, and those of any idle pooled
+        connections. They are reopened if the device manager is used again.
+        """
+        self._pool.close()
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+
+    def _newConnection(self):
+        """
+        Returns a copy of this device manager with a connection of its own
+        """
+        conn = copy.copy(self)
+        conn._sock = None
+        conn._recvBuf = ''
+        # its first connection isn't a reconnection
+        conn._everConnected = False
+        conn.poolSize = 1
+        conn._pool = SUTConnectionPool(conn, 1)
+        return conn
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        Checks out a connection from this device manager's pool for the
+        duration of a with block. The connection is a DeviceManagerSUT, and
+        may be used from another thread while this one is in use.
+
+        timeout - seconds to wait for a free connection (forever if None)
+        """
+        conn = self._pool.checkout(timeout)
+        try:
+            yield conn
+        finally:
+            self._pool.checkin(conn)
+
+    def _runParallel(self, func, items, batchSize=None):
+        """
+        Calls func(conn, batch) for batches of up to batchSize items (by
+        default pipeline_depth). With a poolSize above 1 the batches are
+        spread over that many connections, this one and poolSize - 1 pooled
+        ones, each worked by its own thread; otherwise they are all run on
+        this connection.
+        """
+        batchSize = batchSize or self.pipeline_depth
+        batches = [items[i:i + batchSize] for i in range(0, len(items), batchSize)]
+        if self.poolSize <= 1 or len(batches) <= 1:
+            for batch in batches:
+                func(self, batch)
+            return
+
+        work = Queue.Queue()
+        for batch in batches:
+            work.put(batch)
+        errors = []
+
+        def runBatches(conn):
+            while not errors:
+                try:
+                    batch = work.get_nowait()
+                except Queue.Empty:
+                    return
+                func(conn, batch)
+
+        def worker(conn=None):
+            try:
+                if conn:
+                    runBatches(conn)
+                else:
+                    with self.connection() as conn:
+                        runBatches(conn)
+            except Exception, e:
+                errors.append(e)
+
+        # this connection is one of the poolSize the agent sees
+        threads = [threading.Thread(target=worker)
+                   for i in range(min(self.poolSize, len(batches)) - 1)]
+        for t in threads:
+            t.start()
+        worker(self)
+        for t in threads:
+            t.join()
+
+        if errors:
+            raise errors[0]
+
     def _cmdNeedsResponse(self, cmd):
         """ Not all commands need a response from the agent:
             * rebt obviously doesn't get a response
@@ -60,32 +252,6 @@ class DeviceManagerSUT(DeviceManager):
         # If the command is not in our list, then it gets a response
         return True
 
-    def _stripPrompt(self, data):
-        """
-        take a data blob and strip instances of the prompt '$>\x00'
-        """
-        promptre = re.compile(self._prompt_regex + '.*')
-        retVal = []
-        lines = data.split('\n')
-        for line in lines:
-            foundPrompt = False
-            try:
-                while (promptre.match(line)):
-                    foundPrompt = True
-                    pieces = line.split(self._prompt_sep)
-                    index = pieces.index('$>')
-                    pieces.pop(index)
-                    line = self._prompt_sep.join(pieces)
-            except(ValueError):
-                pass
-
-            # we don't want to append lines that are blank after stripping the
-            # prompt (those are basically "prompts")
-            if not foundPrompt or line:
-                retVal.append(line)
-
-        return '\n'.join(retVal)
-
     def _shouldCmdCloseSocket(self, cmd):
         """
         Some commands need to close the socket after they are sent:
@@ -102,7 +268,18 @@ class DeviceManagerSUT(DeviceManager):
                 return True
         return False
 
-    def _sendCmds(self, cmdlist, outputfile, timeout = None, retryLimit = None):
+    @staticmethod
+    def _operationName(cmdline):
+        """
+        Returns the name metrics are recorded under for an agent command
+        """
+        name = cmdline.split(' ', 1)[0]
+        if name.startswith('exec'):
+            return 'shell'
+        return name
+
+    def _sendCmds(self, cmdlist, outputfile, timeout = None, retryLimit = None,
+                  pipelined = False):
         """
         Wrapper for _doCmds that loops up to retryLimit iterations
         """
@@ -116,7 +293,7 @@ class DeviceManagerSUT(DeviceManager):
         retries = 0
         while retries < retryLimit:
             try:
-                self._doCmds(cmdlist, outputfile, timeout)
+                self._doCmds(cmdlist, outputfile, timeout, pipelined)
                 return
             except DMError, err:
                 # re-raise error if it's fatal (i.e. the device got the command but
@@ -126,6 +303,8 @@ class DeviceManagerSUT(DeviceManager):
                 if self.debug >= 4:
                     print err
                 retries += 1
+                if retries < retryLimit:
+                    self.metrics.countRetry(self._operationName(cmdlist[0]['cmd']))
                 # if we lost the connection or failed to establish one, wait a bit
                 if retries < retryLimit and not self._sock:
                     sleep_time = 5 * retries
@@ -145,8 +324,32 @@ class DeviceManagerSUT(DeviceManager):
         outputfile.seek(0)
         return outputfile.read()
 
-    def _doCmds(self, cmdlist, outputfile, timeout):
-        promptre = re.compile(self._prompt_regex + '$')
+    def _runCmdsPipelined(self, cmdlist, timeout = None, retryLimit = None):
+        """
+        Sends cmdlist to the agent in bursts of up to pipeline_depth commands.
+        Every command in a burst is written before any of the responses are
+        read, so a whole burst costs a single round trip.
+
+        returns: list with the output of each command, in order
+        """
+        for cmd in cmdlist:
+            if not self._cmdNeedsResponse(cmd['cmd']) or \
+                    self._shouldCmdCloseSocket(cmd['cmd']):
+                raise DMError("Automation Error: command '%s' can't be pipelined" %
+                              cmd['cmd'])
+
+        retryLimit = retryLimit or self.retryLimit
+        outputs = []
+        for i in range(0, len(cmdlist), self.pipeline_depth):
+            burst = cmdlist[i:i + self.pipeline_depth]
+            for cmd in burst:
+                cmd['output'] = StringIO.StringIO()
+            self._sendCmds(burst, None, timeout, retryLimit=retryLimit,
+                           pipelined=True)
+            outputs.extend(cmd.pop('output').getvalue() for cmd in burst)
+        return outputs
+
+    def _doCmds(self, cmdlist, outputfile, timeout, pipelined=False):
         shouldCloseSocket = False
 
         if not timeout:
@@ -154,6 +357,8 @@ class DeviceManagerSUT(DeviceManager):
             timeout = self.default_timeout
 
         if not self._sock:
+            if self._everConnected:
+                self.metrics.countReconnect()
             try:
                 if self.debug >= 1 and self._everConnected:
                     print "reconnecting socket"
@@ -180,103 +385,67 @@ class DeviceManagerSUT(DeviceManager):
 
             # future recv() timeouts are handled by select() calls
             self._sock.settimeout(None)
+            self._recvBuf = ''
+
+        if pipelined:
+            # write every command up front; the responses come back in order,
+            # each terminated by a prompt. Each command's latency is counted
+            # from the start of the burst.
+            start = time.time()
+            # a retried burst starts its outputs afresh, rather than adding
+            # to what came back before the connection was lost
+            for cmd in cmdlist:
+                if 'output' in cmd:
+                    cmd['output'].seek(0)
+                    cmd['output'].truncate()
+            sent = [self._sendCmd(cmd) for cmd in cmdlist]
+
+            # read all the responses even if one of them reports an error, so
+            # we stay in sync with the agent
+            failures = []
+            for (cmd, bytesSent) in zip(cmdlist, sent):
+                received = self._bytesReceived
+                try:
+                    agentError = self._recvResponse(cmd, cmd.get('output', outputfile),
+                                                    timeout)
+                except DMError, e:
+                    self.metrics.record(self._operationName(cmd['cmd']),
+                                        time.time() - start, bytesSent=bytesSent,
+                                        bytesReceived=self._bytesReceived - received,
+                                        failed=True, timedOut=e.timeout)
+                    raise
+                self.metrics.record(self._operationName(cmd['cmd']),
+                                    time.time() - start, bytesSent=bytesSent,
+                                    bytesReceived=self._bytesReceived - received,
+                                    failed=agentError is not None)
+                if agentError is not None:
+                    failures.append((cmd, agentError))
+
+            if failures:
+                raise DMError("Automation Error: Error processing command '%s'; err='%s'" %
+                              (failures[0][0]['cmd'], failures[0][1]), fatal=True)
+            return
 
         for cmd in cmdlist:
-            cmdline = '%s\r\n' % cmd['cmd']
-
-            try:
-                sent = self._sock.send(cmdline)
-                if sent != len(cmdline):
-                    raise DMError("Remote Device Error: our cmd was %s bytes and we "
-                                  "only sent %s" % (len(cmdline), sent))
-                if cmd.get('data'):
-                    sent = self._sock.send(cmd['data'])
-                    if sent != len(cmd['data']):
-                        raise DMError("Remote Device Error: we had %s bytes of data to send, but "
-                                      "only sent %s" % (len(cmd['data']), sent))
-
-                if self.debug >= 4:
-                    print "sent cmd: " + str(cmd['cmd'])
-            except socket.error, msg:
-                self._sock.close()
-                self._sock = None
-                if self.debug >= 1:
-                    print "Remote Device Error: Error sending data to socket. cmd="+str(cmd['cmd'])+"; err="+str(msg)
-                return False
-
             # Check if the command should close the socket
             shouldCloseSocket = self._shouldCmdCloseSocket(cmd['cmd'])
 
-            # Handle responses from commands
-            if self._cmdNeedsResponse(cmd['cmd']):
-                foundPrompt = False
-                data = ""
-                timer = 0
-                select_timeout = 1
-                commandFailed = False
-
-                while not foundPrompt:
-                    socketClosed = False
-                    errStr = ''
-                    temp = ''
-                    if self.debug >= 4:
-                        print "recv'ing..."
+            if not self._cmdNeedsResponse(cmd['cmd']):
+                # the caller reads the response (and measures the command)
+                self._sendCmd(cmd)
+                continue
 
-                    # Get our response
-                    try:
-                          # Wait up to a second for socket to become ready for reading...
-                        if select.select([self._sock], [], [], select_timeout)[0]:
-                            temp = self._sock.recv(1024)
-                            if self.debug >= 4:
-                                print "response: " + str(temp)
-                            timer = 0
-                            if not temp:
-                                socketClosed = True
-                                errStr = 'connection closed'
-                        timer += select_timeout
-                        if timer > timeout:
-                            raise DMError("Automation Error: Timeout in command %s" % cmd['cmd'], fatal=True)
-                    except socket.error, err:
-                        socketClosed = True
-                        errStr = str(err)
-                        # This error shows up with we have our tegra rebooted.
-                        if err[0] == errno.ECONNRESET:
-                            errStr += ' - possible reboot'
-
-                    if socketClosed:
-                        self._sock.close()
-                        self._sock = None
-                        raise DMError("Automation Error: Error receiving data from socket. cmd=%s; err=%s" % (cmd, errStr))
-
-                    data += temp
-
-                    # If something goes wrong in the agent it will send back a string that
-                    # starts with '##AGENT-WARNING##'
-                    if not commandFailed:
-                        errorMatch = self._agentErrorRE.match(data)
-                        if errorMatch:
-                            # We still need to consume the prompt, so raise an error after
-                            # draining the rest of the buffer.
-                            commandFailed = True
-
-                    for line in data.splitlines():
-                        if promptre.match(line):
-                            foundPrompt = True
-                            data = self._stripPrompt(data)
-                            break
-
-                    # periodically flush data to output file to make sure it doesn't get
-                    # too big/unwieldly
-                    if len(data) > 1024:
-                            outputfile.write(data[0:1024])
-                            data = data[1024:]
-
-                if commandFailed:
+            # Handle responses from commands
+            with self.metrics.measure(self._operationName(cmd['cmd'])) as measurement:
+                received = self._bytesReceived
+                try:
+                    measurement.bytesSent = self._sendCmd(cmd)
+                    agentError = self._recvResponse(cmd, outputfile, timeout)
+                finally:
+                    measurement.bytesReceived = self._bytesReceived - received
+                if agentError is not None:
                     raise DMError("Automation Error: Error processing command '%s'; err='%s'" %
-                                  (cmd['cmd'], errorMatch.group(1)), fatal=True)
-
-                # Write any remaining data to outputfile
-                outputfile.write(data)
+                                  (cmd['cmd'], agentError), fatal=True)
 
         if shouldCloseSocket:
             try:
@@ -286,6 +455,148 @@ class DeviceManagerSUT(DeviceManager):
                 self._sock = None
                 raise DMError("Automation Error: Error closing socket")
 
+    def _sendCmd(self, cmd):
+        """
+        Writes a single command, and any data that goes with it, to the agent
+
+        returns: the number of bytes sent
+        """
+        cmdline = '%s\r\n' % cmd['cmd']
+        sent = len(cmdline)
+
+        try:
+            self._sock.sendall(cmdline)
+            if cmd.get('data'):
+                self._sock.sendall(cmd['data'])
+                sent += len(cmd['data'])
+            elif cmd.get('datafile'):
+                (cmd['datahash'], size) = self._sendFile(cmd['datafile'])
+                sent += size
+
+            if self.debug >= 4:
+                print "sent cmd: " + str(cmd['cmd'])
+            return sent
+        except IOError, msg:
+            # the agent is now waiting for data we can't give it, so the
+            # connection is unusable
+            self._sock.close()
+            self._sock = None
+            raise DMError("DeviceManager: Error reading file to push: %s" % msg,
+                          fatal=True)
+        except socket.error, msg:
+            self._sock.close()
+            self._sock = None
+            raise DMError("Remote Device Error: Error sending data to socket. "
+                          "cmd=%s; err=%s" % (cmd['cmd'], msg))
+
+    def _recvResponse(self, cmd, outputfile, timeout):
+        """
+        Reads the response to cmd up to the next prompt and writes it to
+        outputfile. Anything received after the prompt belongs to the next
+        response, and is kept for it in self._recvBuf.
+
+        Data is written out as it arrives, and only newly received bytes are
+        searched for the prompt, so long responses are handled in linear time.
+
+        returns: the agent's error message if it reported one, None otherwise
+        """
+        prompt = self._base_prompt + self._prompt_sep
+        data = self._recvBuf
+        self._recvBuf = ''
+        # whether the response starts with an agent warning; None until we
+        # have enough data to tell
+        isError = None
+        timer = 0
+        select_timeout = 1
+
+        while True:
+            index = data.find(prompt)
+
+            # If something goes wrong in the agent it will send back a string that
+            # starts with '##AGENT-WARNING##'. We still need to consume the
+            # prompt, so the error is only reported once the response is read.
+            if isError is None and (index != -1 or
+                                    len(data) >= len(self._agentWarning)):
+                isError = data.startswith(self._agentWarning)
+
+            if index != -1:
+                self._recvBuf = data[index + len(prompt):]
+                data = data[:index]
+                break
+
+            # write out everything but the tail, which may hold the start of
+            # a prompt split across two reads. Error messages are short, so
+            # those are kept whole.
+            if isError is False and len(data) > len(prompt):
+                outputfile.write(data[:-len(prompt)])
+                data = data[-len(prompt):]
+
+            socketClosed = False
+            errStr = ''
+            temp = ''
+            if self.debug >= 4:
+                print "recv'ing..."
+
+            # Get our response
+            try:
+                # Wait up to a second for socket to become ready for reading...
+                if select.select([self._sock], [], [], select_timeout)[0]:
+                    temp = self._sock.recv(self.recv_buffer_size)
+                    self._bytesReceived += len(temp)
+                    if self.debug >= 4:
+                        print "response: " + str(temp)
+                    timer = 0
+                    if not temp:
+                        socketClosed = True
+                        errStr = 'connection closed'
+                timer += select_timeout
+                if timer > timeout:
+                    raise DMError("Automation Error: Timeout in command %s" % cmd['cmd'],
+                                  fatal=True, timeout=True)
+            except socket.error, err:
+                socketClosed = True
+                errStr = str(err)
+                # This error shows up with we have our tegra rebooted.
+                if err[0] == errno.ECONNRESET:
+                    errStr += ' - possible reboot'
+
+            if socketClosed:
+                self._sock.close()
+                self._sock = None
+                raise DMError("Automation Error: Error receiving data from socket. cmd=%s; err=%s" % (cmd, errStr))
+
+            data += temp
+
+        # the prompt is normally on a line of its own
+        if data.endswith('\n'):
+            data = data[:-1]
+
+        if isError:
+            return self._agentErrorRE.match(data).group(1)
+
+        # Write any remaining data to outputfile
+        outputfile.write(data)
+        return None
+
+    def _sendFile(self, filename):
+        """
+        Streams the contents of filename to the agent in push_chunk_size
+        pieces, so that the whole file never has to be held in memory.
+
+        returns: (md5 hash of the data sent, number of bytes sent)
+        """
+        mdsum = hashlib.md5()
+        size = 0
+        with open(filename, 'rb') as f:
+            while True:
+                data = f.read(self.push_chunk_size)
+                if not data:
+                    break
+                mdsum.update(data)
+                self._sock.sendall(data)
+                size += len(data)
+        return (mdsum.hexdigest(), size)
+
     def shell(self, cmd, outputfile, env=None, cwd=None, timeout=None, root=False):
         """
         Executes shell command on device. Returns exit code.
@@ -320,29 +631,100 @@ class DeviceManagerSUT(DeviceManager):
         if root and haveExecSu:
             cmd += "su"
 
+        # the output is streamed, with the "return code [N]" line held back
+        output = _ShellOutput(outputfile)
         if cwd:
-            self._sendCmds([{ 'cmd': '%s %s %s' % (cmd, cwd, cmdline) }], outputfile, timeout)
+            self._sendCmds([{ 'cmd': '%s %s %s' % (cmd, cwd, cmdline) }], output, timeout)
         else:
             if (not root) or haveExecSu:
-                self._sendCmds([{ 'cmd': '%s %s' % (cmd, cmdline) }], outputfile, timeout)
+                self._sendCmds([{ 'cmd': '%s %s' % (cmd, cmdline) }], output, timeout)
             else:
                 # need to manually inject su -c for backwards compatibility (this may
                 # not work on ICS or above!!)
                 # (FIXME: this backwards compatibility code is really ugly and should
                 # be deprecated at some point in the future)
-                self._sendCmds([ { 'cmd': '%s su -c "%s"' % (cmd, cmdline) }], outputfile,
+                self._sendCmds([ { 'cmd': '%s su -c "%s"' % (cmd, cmdline) }], output,
                                timeout)
 
         # dig through the output to get the return code
-        lastline = _pop_last_line(outputfile)
-        if lastline:
-            m = re.search('return code \[([0-9]+)\]', lastline)
-            if m:
-                return int(m.group(1))
+        m = output.finish('return code \[([0-9]+)\]')
+        if m:
+            return int(m.group(1))
 
         # woops, we couldn't find an end of line/return value
         raise DMError("Automation Error: Error finding end of line/return value when running '%s'" % cmdline)
 
+    def _streamShell(self, cmd, lineCallback, root=False):
+        """
+        Starts a shell command which runs until it is stopped (like logcat)
+        in the background, calling lineCallback with each line of its output
+        as it arrives and then with None once the command has ended
+
+        returns: a function which stops the command
+        """
+        # the command gets a connection of its own, which it holds until
+        # it's stopped, and which isn't retried: that would run it twice
+        conn = self._newConnection()
+        conn.retryLimit = 1
+        stopped = threading.Event()
+
+        def callback(line):
+            if not stopped.is_set():
+                lineCallback(line)
+
+        def run():
+            try:
+                conn.shell(cmd, callback, timeout=sys.maxint, root=root)
+            except DMError, e:
+                if not stopped.is_set() and self.debug >= 2:
+                    print "background command '%s' failed: %s" % (' '.join(cmd), e)
+            finally:
+                lineCallback(None)
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+
+        def stop():
+            stopped.set()
+            while t.is_alive():
+                # wakes up the thread waiting for output; it may not have
+                # connected yet, so keep trying until it has finished
+                sock = conn._sock
+                if sock:
+                    try:
+                        sock.shutdown(socket.SHUT_RDWR)
+                    except socket.error:
+                        pass
+                t.join(0.1)
+        return stop
+
+    def _iterTransfer(self, transfer, abort=None):
+        """
+        Runs transfer(dm, put) on a connection of its own, yielding the data
+        it passes to put (see DeviceManager._iterTransfer). The connection
+        isn't retried, as that would yield data a second time, and closing
+        the iterator early closes the connection rather than waiting for the
+        rest of the data.
+        """
+        conn = self._newConnection()
+        conn.retryLimit = 1
+
+        def abortConnection():
+            sock = conn._sock
+            if sock:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+        try:
+            for data in DeviceManager._iterTransfer(conn, transfer, abortConnection):
+                yield data
+        finally:
+            if conn._sock:
+                conn._sock.close()
+                conn._sock = None
+
     def pushFile(self, localname, destname, retryLimit = None):
         """
         Copies localname from the host to destname on the device
@@ -352,16 +734,18 @@ class DeviceManagerSUT(DeviceManager):
 
         try:
             filesize = os.path.getsize(localname)
-            with open(localname, 'rb') as f:
-                remoteHash = self._runCmds([{ 'cmd': 'push ' + destname + ' ' + str(filesize),
-                                              'data': f.read() }], retryLimit=retryLimit).strip()
         except OSError:
             raise DMError("DeviceManager: Error reading file to push")
 
+        # the local hash is computed while the file is streamed to the agent,
+        # so the file only has to be read once
+        cmd = { 'cmd': 'push %s %s' % (destname, filesize), 'datafile': localname }
+        remoteHash = self._runCmds([cmd], retryLimit=retryLimit).strip()
+
         if (self.debug >= 3):
             print "push returned: %s" % remoteHash
 
-        localHash = self._getLocalHash(localname)
+        localHash = cmd['datahash']
 
         if localHash != remoteHash:
             raise DMError("Automation Error: Push File failed to Validate! (localhash: %s, "
@@ -382,7 +766,7 @@ class DeviceManagerSUT(DeviceManager):
         if (self.debug >= 2):
             print "pushing directory: %s to %s" % (localDir, remoteDir)
 
-        existentDirectories = []
+        pushes = []
         for root, dirs, files in os.walk(localDir, followlinks=True):
             parts = root.split(localDir)
             for f in files:
@@ -392,16 +776,82 @@ class DeviceManagerSUT(DeviceManager):
                 else:
                     remoteName = remoteRoot + '/' + f
 
-                if (parts[1] == ""):
-                    remoteRoot = remoteDir
+                pushes.append((os.path.join(root, f), remoteName))
 
-                parent = os.path.dirname(remoteName)
-                if parent not in existentDirectories:
-                    self.mkDirs(remoteName)
-                    existentDirectories.append(parent)
+        self._pushFiles(pushes, retryLimit=retryLimit)
 
-                self.pushFile(os.path.join(root, f), remoteName, retryLimit=retryLimit)
+    def _pushFiles(self, pushes, retryLimit = None):
+        """
+        Copies a list of (localname, destname) tuples from the host to the
+        device, creating any missing directories first. The pushes are
+        pipelined, and spread over the connection pool if there is one.
+        """
+        self._mkDirsPipelined(set(posixpath.dirname(destname)
+                                  for (localname, destname) in pushes))
+
+        self._runParallel(lambda conn, batch: conn._pushBatch(batch, retryLimit),
+                          pushes)
 
+    def _pushBatch(self, pushes, retryLimit = None):
+        """
+        Pushes a list of (localname, destname) tuples in a single pipelined
+        burst, and validates them
+        """
+        cmds = []
+        for (localname, destname) in pushes:
+            try:
+                filesize = os.path.getsize(localname)
+            except OSError:
+                raise DMError("DeviceManager: Error reading file to push")
+            cmds.append({ 'cmd': 'push %s %s' % (destname, filesize),
+                          'datafile': localname })
+
+        remoteHashes = self._runCmdsPipelined(cmds, retryLimit=retryLimit)
+        for (cmd, remoteHash) in zip(cmds, remoteHashes):
+            remoteHash = remoteHash.strip()
+            if cmd['datahash'] != remoteHash:
+                raise DMError("Automation Error: Push File failed to Validate! (file: %s, "
+                              "localhash: %s, remotehash: %s)" %
+                              (cmd['datafile'], cmd['datahash'], remoteHash))
+
+    def _mkDirsPipelined(self, dirs):
+        """
+        Creates every directory in dirs on the device, along with any missing
+        parents. Uses one pipelined burst of isdir checks for the directories
+        themselves, and only looks at (and creates) parents of missing ones.
+        """
+        dirs = sorted(dirs)
+        exists = self._runCmdsPipelined([{ 'cmd': 'isdir ' + d } for d in dirs])
+        missing = [d for (d, e) in zip(dirs, exists) if e.strip() != 'TRUE']
+        if not missing:
+            return
+
+        def ancestors(d):
+            name = ''
+            for part in d.split('/')[:-1]:
+                if part:
+                    name += '/' + part
+                    yield name
+
+        # anything above a directory that exists must exist too
+        existing = set()
+        for (d, e) in zip(dirs, exists):
+            if e.strip() == 'TRUE':
+                existing.add(posixpath.normpath(d))
+                existing.update(ancestors(posixpath.normpath(d)))
+        missing = set(posixpath.normpath(d) for d in missing)
+        parents = set()
+        for d in missing:
+            for name in ancestors(d):
+                if name not in existing and name not in missing:
+                    parents.add(name)
+
+        parents = sorted(parents)
+        exists = self._runCmdsPipelined([{ 'cmd': 'isdir ' + d } for d in parents])
+        missing.update(d for (d, e) in zip(parents, exists) if e.strip() != 'TRUE')
+
+        # sorted, so parents are always created before their children
+        self._runCmdsPipelined([{ 'cmd': 'mkdr ' + d } for d in sorted(missing)])
 
     def dirExists(self, remotePath):
         """
@@ -413,16 +863,6 @@ class DeviceManagerSUT(DeviceManager):
 
         return ret == 'TRUE'
 
-    def fileExists(self, filepath):
-        """
-        Return True if filepath exists and is a file on the device file system
-        """
-        # Because we always have / style paths we make this a lot easier with some
-        # assumptions
-        s = filepath.split('/')
-        containingpath = '/'.join(s[:-1])
-        return s[-1] in self.listFiles(containingpath)
-
     def listFiles(self, rootdir):
         """
         Lists files on the device rootdir
@@ -432,7 +872,8 @@ class DeviceManagerSUT(DeviceManager):
         rootdir = rootdir.rstrip('/')
         if (self.dirExists(rootdir) == False):
             return []
-        data = self._runCmds([{ 'cmd': 'cd ' + rootdir }, { 'cmd': 'ls' }])
+        data = self._runCmdsPipelined([{ 'cmd': 'cd ' + rootdir },
+                                       { 'cmd': 'ls' }])[1]
 
         files = filter(lambda x: x, data.splitlines())
         if len(files) == 1 and files[0] == '<empty>':
@@ -504,19 +945,15 @@ class DeviceManagerSUT(DeviceManager):
                 raise DMError("Automation Error: Process is already running")
 
         self._runCmds([{ 'cmd': 'exec ' + appname }])
+        self._invalidateProcessTable()
 
         # The 'exec' command may wait for the process to start and end, so checking
         # for the process here may result in process = None.
         # The normal case is to launch the process and return right away
         # There is one case with robotium (am instrument) where exec returns at the end
         pid = None
-        waited = 0
-        while pid is None and waited < maxWaitTime:
+        if self.waitForProcess(self._processName(appname), 'running', maxWaitTime):
             pid = self.processExist(appname)
-            if pid:
-                break
-            time.sleep(1)
-            waited += 1
 
         if (self.debug >= 4):
             print "got pid: %s for process: %s" % (pid, appname)
@@ -566,6 +1003,7 @@ class DeviceManagerSUT(DeviceManager):
             try:
                 if self.processExist(appname):
                     self._runCmds([{ 'cmd': 'kill ' + appname }])
+                    self._invalidateProcessTable()
                 return
             except DMError, err:
                 retries +=1
@@ -594,60 +1032,75 @@ class DeviceManagerSUT(DeviceManager):
         """
         Returns contents of remoteFile using the "pull" command.
         """
+        buf = StringIO.StringIO()
+        if self._pullToFile(remoteFile, buf) is None:
+            return None
+        return buf.getvalue()
+
+    def _pullToFile(self, remoteFile, outputfile, timeout=None):
+        """
+        Streams the contents of remoteFile into outputfile using the "pull"
+        command. File data is received straight into a fixed-size buffer, so
+        memory use doesn't depend on the size of the file.
+
+        returns: md5 hash of the data received, or None if the agent returned
+                 no metadata
+        """
+        with self.metrics.measure('pull') as measurement:
+            received = self._bytesReceived
+            try:
+                return self._recvFile(remoteFile, outputfile, timeout)
+            finally:
+                measurement.bytesReceived = self._bytesReceived - received
+
+    def _recvFile(self, remoteFile, outputfile, timeout):
+        """
+        Does the work of _pullToFile
+        """
         # The "pull" command is different from other commands in that DeviceManager
         # has to read a certain number of bytes instead of just reading to the
         # next prompt.  This is more robust than the "cat" command, which will be
         # confused if the prompt string exists within the file being catted.
         # However it means we can't use the response-handling logic in sendCMD().
 
-        def err(error_msg):
+        def err(error_msg, timeout=False):
             err_str = 'DeviceManager: pull unsuccessful: %s' % error_msg
             print err_str
             self._sock = None
-            raise DMError(err_str)
+            raise DMError(err_str, timeout=timeout)
 
-        # FIXME: We could possibly move these socket-reading functions up to
-        # the class level if we wanted to refactor sendCMD().  For now they are
-        # only used to pull files.
+        if not timeout:
+            timeout = self.default_timeout
 
-        def uread(to_recv, error_msg, timeout=None):
-            """ unbuffered read """
+        def recv_into(view, error_msg):
+            """ read whatever is available into view; returns the size read """
             timer = 0
             select_timeout = 1
-            if not timeout:
-                timeout = self.default_timeout
-
-            try:
-                if select.select([self._sock], [], [], select_timeout)[0]:
-                    data = self._sock.recv(to_recv)
-                    timer = 0
+            while True:
+                try:
+                    if select.select([self._sock], [], [], select_timeout)[0]:
+                        size = self._sock.recv_into(view)
+                        if not size:
+                            err(error_msg)
+                        self._bytesReceived += size
+                        return size
+                except (select.error, socket.error):
+                    err(error_msg)
                 timer += select_timeout
                 if timer > timeout:
-                    err('timeout in uread while retrieving file')
+                    err('timeout in recv_into while retrieving file', timeout=True)
 
-                if not data:
-                    err(error_msg)
-                return data
-            except:
-                err(error_msg)
+        recvBuf = bytearray(self.recv_buffer_size)
+        recvView = memoryview(recvBuf)
 
         def read_until_char(c, buf, error_msg):
             """ read until 'c' is found; buffer rest """
-            while not '\n' in buf:
-                data = uread(1024, error_msg)
-                buf += data
+            while not c in buf:
+                size = recv_into(recvView, error_msg)
+                buf += recvView[:size].tobytes()
             return buf.partition(c)
 
-        def read_exact(total_to_recv, buf, error_msg):
-            """ read exact number of 'total_to_recv' bytes """
-            while len(buf) < total_to_recv:
-                to_recv = min(total_to_recv - len(buf), 1024)
-                data = uread(to_recv, error_msg)
-                buf += data
-            return buf
-
         prompt = self._base_prompt + self._prompt_sep
-        buf = ''
 
         # expected return value:
         # <filename>,<filesize>\n<filedata>
@@ -656,6 +1109,8 @@ class DeviceManagerSUT(DeviceManager):
 
         # just send the command first, we read the response inline below
         self._runCmds([{ 'cmd': 'pull ' + remoteFile }])
+        buf = self._recvBuf
+        self._recvBuf = ''
 
         # read metadata; buffer the rest
         metadata, sep, buf = read_until_char('\n', buf, 'could not find metadata')
@@ -678,31 +1133,63 @@ class DeviceManagerSUT(DeviceManager):
             if not error_str:
                 err("blank error message")
             # prompt should follow
-            read_exact(len(prompt), buf, 'could not find prompt')
+            while len(buf) < len(prompt):
+                size = recv_into(recvView, 'could not find prompt')
+                buf += recvView[:size].tobytes()
             # failures are expected, so don't use "Remote Device Error" or we'll RETRY
             raise DMError("DeviceManager: pulling file '%s' unsuccessful: %s" % (remoteFile, error_str))
 
-        # read file data
-        total_to_recv = filesize + len(prompt)
-        buf = read_exact(total_to_recv, buf, 'could not get all file data')
-        if buf[-len(prompt):] != prompt:
+        # write out file data as it comes in, hashing it on the way. Whatever
+        # follows the file is the prompt.
+        mdsum = hashlib.md5()
+        data, buf = buf[:filesize], buf[filesize:]
+        mdsum.update(data)
+        outputfile.write(data)
+        remaining = filesize - len(data)
+        while remaining > 0:
+            size = recv_into(recvView, 'could not get all file data')
+            chunk = recvView[:min(size, remaining)]
+            mdsum.update(chunk)
+            outputfile.write(chunk.tobytes())
+            buf = recvView[len(chunk):size].tobytes()
+            remaining -= len(chunk)
+
+        while len(buf) < len(prompt):
+            size = recv_into(recvView, 'could not find prompt')
+            buf += recvView[:size].tobytes()
+        if buf[:len(prompt)] != prompt:
             err('no prompt found after file data--DeviceManager may be out of sync with agent')
-            return buf
-        return buf[:-len(prompt)]
+        self._recvBuf = buf[len(prompt):]
+
+        return mdsum.hexdigest()
 
     def getFile(self, remoteFile, localFile):
         """
         Copy file from device (remoteFile) to host (localFile)
+
+        localFile may be either a path or a file object to write to. The file
+        is streamed to it as it is received, then validated against the
+        device's hash of the file.
         """
-        data = self.pullFile(remoteFile)
+        if isinstance(localFile, basestring):
+            with open(localFile, 'wb') as fhandle:
+                localHash = self._pullToFile(remoteFile, fhandle)
+        else:
+            localHash = self._pullToFile(remoteFile, localFile)
 
-        fhandle = open(localFile, 'wb')
-        fhandle.write(data)
-        fhandle.close()
-        if not self.validateFile(remoteFile, localFile):
+        if localHash is None or localHash != self.getRemoteHashes([remoteFile])[remoteFile]:
             raise DMError("Automation Error: Failed to validate file when downloading %s" %
                           remoteFile)
 
+    def iterFile(self, remoteFile, chunkSize=65536):
+        """
+        Returns an iterator over the contents of remoteFile, in chunks of up
+        to chunkSize bytes, streamed from the device as they are received.
+        The file is validated against the device's hash of it at the end.
+        """
+        return self._iterTransfer(
+            lambda dm, put: dm.getFile(remoteFile, _ChunkWriter(put, chunkSize)))
+
     def getDirectory(self, remoteDir, localDir, checkDir=True):
         """
         Copy directory structure from device (remoteDir) to host (localDir)
@@ -713,21 +1200,52 @@ class DeviceManagerSUT(DeviceManager):
             raise DMError("Automation Error: Error getting directory: %s not a directory" %
                           remoteDir)
 
-        filelist = self.listFiles(remoteDir)
-        if (self.debug >= 3):
-            print filelist
         if not os.path.exists(localDir):
             os.makedirs(localDir)
 
-        for f in filelist:
-            if f == '.' or f == '..':
-                continue
-            remotePath = remoteDir + '/' + f
-            localPath = os.path.join(localDir, f)
-            if self.dirExists(remotePath):
-                self.getDirectory(remotePath, localPath, False)
-            else:
-                self.getFile(remotePath, localPath)
+        files = []
+        for (path, entryType, size, mtime) in self.listDirDetailed(remoteDir):
+            relName = posixpath.relpath(path, remoteDir)
+            localPath = os.path.join(localDir, *relName.split('/'))
+            if entryType == 'd':
+                if not os.path.exists(localPath):
+                    os.makedirs(localPath)
+            elif entryType in ('f', 'l'):
+                files.append((path, localPath))
+
+        self._runParallel(lambda conn, batch: conn._getBatch(batch), files)
+
+    def _getRemoteDirHashes(self, remoteDir):
+        """
+        Returns the md5 hashes of all files under remoteDir on the device,
+        fetched with pipelined bursts of hash commands
+        """
+        files = [path for (path, entryType, size, mtime)
+                 in self.listDirDetailed(remoteDir) if entryType == 'f']
+        return dict((posixpath.relpath(path, remoteDir), h)
+                    for (path, h) in self.getRemoteHashes(files).iteritems())
+
+    def _removeFiles(self, filenames):
+        """
+        Removes a list of files from the device in pipelined bursts
+        """
+        self._runCmdsPipelined([{ 'cmd': 'rm ' + filename } for filename in filenames])
+
+    def _getBatch(self, files):
+        """
+        Pulls a list of (remotePath, localPath) tuples, then validates them
+        all with a single pipelined burst of hash commands
+        """
+        localHashes = []
+        for (remotePath, localPath) in files:
+            with open(localPath, 'wb') as fhandle:
+                localHashes.append(self._pullToFile(remotePath, fhandle))
+
+        remoteHashes = self.getRemoteHashes([remotePath for (remotePath, localPath) in files])
+        for ((remotePath, localPath), localHash) in zip(files, localHashes):
+            if remoteHashes[remotePath] != localHash:
+                raise DMError("Automation Error: Failed to validate file when downloading %s" %
+                              remotePath)
 
     def validateFile(self, remoteFile, localFile):
         """
@@ -748,10 +1266,25 @@ class DeviceManagerSUT(DeviceManager):
         """
         Return the md5 sum of a file on the device
         """
-        data = self._runCmds([{ 'cmd': 'hash ' + filename }]).strip()
-        if self.debug >= 3:
-            print "remote hash returned: '%s'" % data
-        return data
+        return self.getRemoteHashes([filename])[filename]
+
+    def getRemoteHashes(self, paths):
+        """
+        Returns the md5 hashes of a list of files on the device, using
+        pipelined bursts of hash commands
+
+        returns: dict of hashes by path, with None for any file which
+                 couldn't be hashed
+        """
+        paths = list(paths)
+        hashes = {}
+        data = self._runCmdsPipelined([{ 'cmd': 'hash ' + path } for path in paths])
+        for (path, h) in zip(paths, data):
+            h = h.strip()
+            if self.debug >= 3:
+                print "remote hash returned: '%s'" % h
+            hashes[path] = h or None
+        return hashes
 
     def getDeviceRoot(self):
         """
@@ -808,44 +1341,32 @@ class DeviceManagerSUT(DeviceManager):
 
         self._runCmds([{ 'cmd': 'unzp %s %s' % (file_path, dest_dir)}])
 
-    def _wait_for_reboot(self, host, port):
-        if self.debug >= 3:
-            print 'Creating server with %s:%d' % (host, port)
-        timeout_expires = time.time() + self.reboot_timeout
-        conn = None
-        data = ''
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.settimeout(60.0)
-        s.bind((host, port))
-        s.listen(1)
-        while not data and time.time() < timeout_expires:
-            try:
-                if not conn:
-                    conn, _ = s.accept()
-                # Receiving any data is good enough.
-                data = conn.recv(1024)
-                if data:
-                    conn.sendall('OK')
-                conn.close()
-            except socket.timeout:
-                print '.'
-            except socket.error, e:
-                if e.errno != errno.EAGAIN and e.errno != errno.EWOULDBLOCK:
-                    raise
-        if data:
-            # Sleep to ensure not only we are online, but all our services are
-            # also up.
-            time.sleep(self.reboot_settling_time)
-        else:
-            print 'Automation Error: Timed out waiting for reboot callback.'
-        s.close()
-        return data
+    def _wait_for_reboot(self, handle):
+        """
+        Blocks until a reboot started by rebootAsync (or updateApp) is done,
+        returning True if the device came back
+        """
+        handle.wait()
+        if handle.error:
+            print 'Automation Error: %s' % handle.error
+            return False
+        return True
 
-    def reboot(self, ipAddr=None, port=30000):
-        """Reboots the device, optionally waiting for a TCP callback from the
-        SUTAgent once it has restarted.
+    def rebootAsync(self, ipAddr=None, port=30000, monitor=None, timeout=None):
         """
+        Reboots the device without waiting for it to come back.
+
+        ipAddr - if given, wait for a TCP callback from the SUTAgent on this
+                 address once it has restarted; otherwise wait until the
+                 agent answers on its port again
+        port - port to await the callback on (counts up from there if it
+               finds a conflict)
+        monitor - RebootMonitor to wait on, defaults to the shared one
+        timeout - seconds to wait, defaults to reboot_timeout
+
+        returns: RebootHandle
+        """
+        monitor = monitor or rebootmonitor.getDefaultMonitor()
         cmd = 'rebt'
 
         if self.debug > 3:
@@ -861,12 +1382,31 @@ class DeviceManagerSUT(DeviceManager):
 
             ip, port = self._getCallbackIpAndPort(ipAddr, port)
             cmd += " %s %s" % (ip, port)
+            if self.debug >= 3:
+                print 'Creating server with %s:%d' % (ip, port)
+            probe = rebootmonitor.CallbackProbe(ip, port, self.reboot_settling_time)
+        else:
+            probe = rebootmonitor.AgentProbe(self.host, self.port)
 
-        status = self._runCmds([{'cmd': cmd}])
+        try:
+            self._runCmds([{'cmd': cmd}])
+        except:
+            # don't keep the callback port bound when there'll be no reboot
+            probe.discard()
+            raise
+        return monitor.watch(probe, timeout or self.reboot_timeout, name=self.host)
 
-        if ipAddr is not None:
-            status = self._wait_for_reboot(ipAddr, port)
+    def reboot(self, ipAddr=None, port=30000):
+        """Reboots the device, optionally waiting for a TCP callback from the
+        SUTAgent once it has restarted.
+        """
+        if ipAddr is None:
+            if self.debug > 3:
+                print "INFO: sending rebt command"
+            self._runCmds([{'cmd': 'rebt'}])
+            return
 
+        status = self._wait_for_reboot(self.rebootAsync(ipAddr, port))
         if self.debug > 3:
             print "INFO: rebt- got status back: " + str(status)
 
@@ -999,14 +1539,22 @@ class DeviceManagerSUT(DeviceManager):
         if ipAddr is not None:
             ip, port = self._getCallbackIpAndPort(ipAddr, port)
             cmd += " %s %s" % (ip, port)
+            # listen before the update starts, so the callback can't be missed
+            probe = rebootmonitor.CallbackProbe(ip, port, self.reboot_settling_time)
 
         if self.debug >= 3:
             print "INFO: updateApp using command: " + str(cmd)
 
-        status = self._runCmds([{'cmd': cmd}])
+        try:
+            status = self._runCmds([{'cmd': cmd}])
+        except:
+            if ipAddr is not None:
+                probe.discard()
+            raise
 
         if ipAddr is not None:
-            status = self._wait_for_reboot(ip, port)
+            status = self._wait_for_reboot(rebootmonitor.getDefaultMonitor().watch(
+                    probe, self.reboot_timeout, name=self.host))
 
         if self.debug >= 3:
             print "INFO: updateApp: got status back: %s" + str(status)
@@ -0,0 +1,171 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Runs DeviceManager operations on many devices at once
+"""
+
+import Queue
+import sys
+import threading
+import time
+import traceback
+
+class DeviceResult(object):
+    """
+    The outcome of an operation on a single device of a DevicePool
+    """
+
+    def __init__(self, name, value=None, error=None, tb=None, elapsed=None,
+                 timedOut=False):
+        self.name = name
+        # return value of the operation (None if it failed)
+        self.value = value
+        # exception raised by the operation, if any
+        self.error = error
+        # formatted traceback of that exception
+        self.traceback = tb
+        # seconds the operation ran for (or waited before timing out)
+        self.elapsed = elapsed
+        # True if the operation was abandoned after the pool's timeout
+        self.timedOut = timedOut
+
+    @property
+    def ok(self):
+        return self.error is None and not self.timedOut
+
+    def __repr__(self):
+        if self.timedOut:
+            status = 'timed out'
+        elif self.error is not None:
+            status = 'failed: %s' % self.error
+        else:
+            status = 'ok: %r' % (self.value,)
+        return '<DeviceResult %s %s>' % (self.name, status)
+
+class DevicePool(object):
+    """
+    Owns a set of named DeviceManager instances and runs the same operation
+    on all of them through a pool of threads, e.g.
+
+    pool = DevicePool({ 'panda-0001': DroidSUT('10.0.0.1'),
+                        'panda-0002': DroidSUT('10.0.0.2') }, timeout=300)
+    results = pool.call('installApp', '/mnt/sdcard/fennec.apk')
+    for result in pool.failures(results):
+        print result.name, result.error
+
+    An operation which doesn't finish on a device within the timeout is
+    reported as timed out, and its thread is abandoned rather than left to
+    stall the rest of the pool. Such a device shouldn't be used again until
+    the operation has had a chance to finish.
+    """
+
+    def __init__(self, devices, maxWorkers=16, timeout=None):
+        """
+        devices - dict of DeviceManager instances, by name
+        maxWorkers - most operations to run at once
+        timeout - default per-device timeout in seconds (None for no limit)
+        """
+        self.devices = dict(devices)
+        self.maxWorkers = maxWorkers
+        self.timeout = timeout
+
+    @classmethod
+    def connect(cls, names, factory, maxWorkers=16, timeout=None):
+        """
+        Creates a pool by calling factory(name) for every device name in
+        parallel, so one unreachable device doesn't hold up the others
+
+        returns: (pool of the devices which connected, dict of DeviceResults
+                  for those which didn't)
+        """
+        results = _runTasks(dict((name, (lambda name=name: factory(name)))
+                                 for name in names), maxWorkers, timeout)
+        pool = cls(dict((name, result.value) for (name, result) in results.iteritems()
+                        if result.ok),
+                   maxWorkers=maxWorkers, timeout=timeout)
+        return (pool, dict((name, result) for (name, result) in results.iteritems()
+                           if not result.ok))
+
+    def run(self, func, timeout=None, names=None):
+        """
+        Calls func(dm) on every device in the pool
+
+        timeout - per-device timeout in seconds, defaults to the pool's
+        names - only run on these devices (defaults to all of them)
+
+        returns: dict of DeviceResults, by device name
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if names is None:
+            names = self.devices.keys()
+        return _runTasks(dict((name, (lambda dm=self.devices[name]: func(dm)))
+                              for name in names), self.maxWorkers, timeout)
+
+    def call(self, methodName, *args, **kwargs):
+        """
+        Calls a DeviceManager method with the given arguments on every device
+        in the pool, with the pool's timeout
+
+        returns: dict of DeviceResults, by device name
+        """
+        return self.run(lambda dm: getattr(dm, methodName)(*args, **kwargs))
+
+    @staticmethod
+    def failures(results):
+        """
+        Returns the DeviceResults for the devices where an operation failed or
+        timed out, sorted by device name
+        """
+        return [results[name] for name in sorted(results) if not results[name].ok]
+
+def _runTasks(tasks, maxWorkers, timeout):
+    """
+    Runs a dict of callables, by name, on at most maxWorkers threads at once
+
+    returns: dict of DeviceResults, by name
+    """
+    pending = sorted(tasks)
+    running = {}
+    results = {}
+    finished = Queue.Queue()
+
+    def worker(name, func, start):
+        try:
+            value = func()
+        except Exception, e:
+            finished.put(DeviceResult(name, error=e, tb=traceback.format_exc(),
+                                      elapsed=time.time() - start))
+        else:
+            finished.put(DeviceResult(name, value=value, elapsed=time.time() - start))
+
+    while pending or running:
+        while pending and len(running) < maxWorkers:
+            name = pending.pop(0)
+            start = time.time()
+            running[name] = start
+            t = threading.Thread(target=worker, args=(name, tasks[name], start))
+            t.daemon = True
+            t.start()
+
+        # always wait with a timeout, so the wait can be interrupted
+        wait = sys.maxint
+        if timeout is not None:
+            wait = max(0, min(running.values()) + timeout - time.time())
+        try:
+            result = finished.get(True, wait)
+            # results of abandoned operations are ignored
+            if result.name in running:
+                del running[result.name]
+                results[result.name] = result
+        except Queue.Empty:
+            now = time.time()
+            for (name, start) in running.items():
+                if now - start >= timeout:
+                    del running[name]
+                    results[name] = DeviceResult(name, elapsed=now - start,
+                                                 timedOut=True)
+
+    return results
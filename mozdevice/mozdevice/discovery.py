@@ -0,0 +1,231 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Keeps track of where devices can be reached, so that connecting to one by
+its hardware id doesn't have to wait for it to be found on the network
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+from Zeroconf import Zeroconf, ServiceBrowser
+from adbclient import ADBClient
+from devicemanager import DMError, NetworkTools, _parseAgentName, _agentPort
+
+SUTAGENT_SERVICE = "_sutagent._tcp.local."
+
+class DeviceRegistry(object):
+    """
+    A JSON file of the devices seen recently, keyed by hardware id (the
+    SUTAgent's hwid, or the adb serial), each with the transport it was
+    seen on ('sut' or 'adb'), its ip and port where it has them, and the
+    time it was last seen. Entries not seen for ttl seconds are stale.
+
+    Like the CapabilityCache, the file is rewritten atomically, so it can
+    be shared by a DiscoveryService and any number of processes looking
+    devices up.
+    """
+
+    def __init__(self, path=None, ttl=10 * 60):
+        """
+        path - registry file, defaults to ~/.mozdevice/devices.json
+        ttl - seconds after which an entry is no longer trusted
+        """
+        if not path:
+            path = os.path.join(os.path.expanduser('~'), '.mozdevice',
+                                'devices.json')
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        return entries
+
+    def entries(self):
+        """
+        returns: dict of hwid to entry ({'transport', 'ip', 'port',
+                 'lastSeen'}) for every device that isn't stale
+        """
+        now = time.time()
+        return dict((hwid, entry) for (hwid, entry) in self._load().iteritems()
+                    if now - entry.get('lastSeen', 0) <= self.ttl)
+
+    def get(self, hwid):
+        """
+        returns: the entry for hwid, or None if there is none or it is stale
+        """
+        return self.entries().get(hwid)
+
+    def update(self, devices):
+        """
+        Records that devices, a dict of hwid to (transport, ip, port), have
+        just been seen, dropping stale entries on the way
+        """
+        now = time.time()
+        with self._lock:
+            entries = self.entries()
+            for (hwid, (transport, ip, port)) in devices.iteritems():
+                entries[hwid] = { 'transport': transport, 'ip': ip,
+                                  'port': port, 'lastSeen': now }
+            self._save(entries)
+
+    def put(self, hwid, transport, ip=None, port=None):
+        """
+        Records that a device has just been seen
+        """
+        self.update({ hwid: (transport, ip, port) })
+
+    def remove(self, hwid):
+        """
+        Forgets a device, e.g. when it could not be reached where the
+        registry said it was
+        """
+        with self._lock:
+            entries = self._load()
+            if entries.pop(hwid, None) is not None:
+                self._save(entries)
+
+    def _save(self, entries):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            (fd, tmpPath) = tempfile.mkstemp(dir=directory, prefix='.devices')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f, indent=2, sort_keys=True)
+            os.rename(tmpPath, self.path)
+        except (IOError, OSError), e:
+            # without the registry devices are found by browsing instead
+            print "unable to write device registry %s: %s" % (self.path, e)
+
+class _RegistryListener(object):
+    """
+    Records SUTAgents in a registry as their announcements arrive
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def addService(self, zeroconf, type, name):
+        agent = _parseAgentName(name)
+        if agent is None:
+            return
+        (hwid, ip) = agent
+        self.registry.put(hwid, 'sut', ip, _agentPort(zeroconf, name))
+
+    def removeService(self, zeroconf, type, name):
+        pass
+
+class DiscoveryService(object):
+    """
+    Keeps a DeviceRegistry up to date for as long as it runs, by browsing
+    for SUTAgent announcements and polling the adb server for the devices
+    attached to it. Devices that are still around are marked as seen every
+    interval seconds.
+
+    Run it in the background of a long-lived process with start() and
+    stop(), or on its own with run() (e.g. 'dm discover').
+    """
+
+    def __init__(self, registry=None, interval=30, bindaddress=None,
+                 adbClient=None, pollAdb=True):
+        """
+        registry - DeviceRegistry to keep up to date
+        interval - seconds between refreshes
+        bindaddress - interface to browse on, defaults to the LAN address
+        adbClient - ADBClient to list adb devices with
+        pollAdb - whether to look for adb devices at all
+        """
+        self.registry = registry or DeviceRegistry()
+        self.interval = interval
+        self.bindaddress = bindaddress
+        self.adbClient = adbClient
+        self.pollAdb = pollAdb
+        self.zeroconf = None
+        self.browser = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Starts browsing and refreshing the registry in the background
+        """
+        bindaddress = self.bindaddress or NetworkTools().getLanIp()
+        self.zeroconf = Zeroconf(bindaddress)
+        self.browser = ServiceBrowser(self.zeroconf, SUTAGENT_SERVICE,
+                                      _RegistryListener(self.registry))
+        if self.pollAdb and self.adbClient is None:
+            self.adbClient = ADBClient()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._refreshLoop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if self.zeroconf:
+            self.browser.cancel()
+            self.zeroconf.close()
+            self.zeroconf = None
+
+    def run(self):
+        """
+        Keeps the registry up to date until interrupted
+        """
+        self.start()
+        try:
+            while not self._stopped.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def _refreshLoop(self):
+        while not self._stopped.is_set():
+            self.refresh()
+            self._stopped.wait(self.interval)
+
+    def refresh(self):
+        """
+        Marks the SUTAgents still being announced and the devices attached
+        to the adb server as seen now
+        """
+        devices = {}
+        if self.browser:
+            for record in self.browser.services.values():
+                agent = _parseAgentName(record.alias)
+                if agent:
+                    devices[agent[0]] = ('sut', agent[1],
+                                         _agentPort(self.zeroconf, record.alias))
+        if self.pollAdb:
+            try:
+                for (serial, state) in self.adbClient.devices():
+                    if state != 'device':
+                        continue
+                    (ip, port) = (None, None)
+                    if ':' in serial and serial.rsplit(':', 1)[1].isdigit():
+                        # connected over tcp with 'adb connect'
+                        (ip, port) = serial.rsplit(':', 1)
+                        port = int(port)
+                    devices[serial] = ('adb', ip, port)
+            except DMError:
+                # no adb server running, so no adb devices
+                pass
+        if devices:
+            self.registry.update(devices)
@@ -7,12 +7,17 @@ Command-line client to control a device
 """
 
 import errno
+import json
 import os
 import posixpath
+import shlex
 import StringIO
 import sys
 import textwrap
+import threading
+import time
 import mozdevice
+from mozdevice import metrics
 from optparse import OptionParser
 
 class DMCli(object):
@@ -112,6 +117,36 @@ class DMCli(object):
                                       'help_args': '',
                                       'help': 'SUTAgent\'s product name and version (SUT only)'
                                    },
+                          'stats': { 'function': self.stats,
+                                     'min_args': 0,
+                                     'max_args': 1,
+                                     'help_args': '[json|reset]',
+                                     'help': 'show (or clear) the latency, '
+                                     'throughput and error statistics '
+                                     'collected in the --stats file',
+                                     'needs_device': False
+                                   },
+                          'discover': { 'function': self.discover,
+                                        'min_args': 0,
+                                        'max_args': 2,
+                                        'help_args': '[list|scan [seconds]]',
+                                        'help': 'keep the registry of where '
+                                        'devices are (used with --hwid) up '
+                                        'to date until interrupted, list '
+                                        'the devices in it, or browse for '
+                                        'all SUTAgents for a few seconds',
+                                        'needs_device': False
+                                      },
+                          'batch': { 'function': self.batch,
+                                     'min_args': 0,
+                                     'max_args': 1,
+                                     'help_args': '[<script>]',
+                                     'help': 'run the commands in a script '
+                                     '(or read from stdin), one per line, '
+                                     'over the one connection. Lines ending '
+                                     'in & run in the background, and a '
+                                     'line saying wait waits for them'
+                                   },
 
                           }
 
@@ -134,11 +169,6 @@ class DMCli(object):
         if len(self.args) < 1:
             self.parser.error("must specify command")
 
-        if self.options.dmtype == "sut" and not self.options.host and \
-                not self.options.hwid:
-            self.parser.error("Must specify device ip in TEST_DEVICE or "
-                              "with --host option with SUT")
-
         (command_name, command_args) = (self.args[0], self.args[1:])
         if command_name not in self.commands:
             self.parser.error("Invalid command. Valid commands: %s" %
@@ -150,11 +180,27 @@ class DMCli(object):
              command['max_args'])):
             self.parser.error("Wrong number of arguments")
 
+        if not command.get('needs_device', True):
+            ret = command['function'](*command_args)
+            sys.exit(ret or 0)
+
+        if self.options.dmtype == "sut" and not self.options.host and \
+                not self.options.hwid and not self.options.devices:
+            self.parser.error("Must specify device ip in TEST_DEVICE or "
+                              "with --host option with SUT")
+
+        if self.options.devices:
+            sys.exit(self.runOnDevices(command_name, command_args))
+
         self.dm = self.getDevice(dmtype=self.options.dmtype,
                                  hwid=self.options.hwid,
                                  host=self.options.host,
-                                 port=self.options.port)
-        ret = command['function'](*command_args)
+                                 port=self.options.port,
+                                 poolSize=self._poolSize(command_name))
+        try:
+            ret = command['function'](*command_args)
+        finally:
+            self.saveStats([self.dm])
         if ret is None:
             ret = 0
 
@@ -185,8 +231,39 @@ class DMCli(object):
                           type="string", dest="packagename",
                           help="Packagename (if using DeviceManagerADB)",
                           default=None)
+        parser.add_option("--devices", action="store",
+                          type="string", dest="devices",
+                          help="Run the command on each of a comma separated "
+                          "list of devices in parallel (adb serials, or "
+                          "host[:port] with SUT)", default=None)
+        parser.add_option("--device-timeout", action="store",
+                          type="int", dest="devicetimeout",
+                          help="Seconds to allow for connecting to each device "
+                          "and for running the command on it (with --devices)",
+                          default=None)
+        parser.add_option("-j", "--jobs", action="store",
+                          type="int", dest="jobs",
+                          help="Most commands to run at once in the "
+                          "background with batch", default=4)
+        parser.add_option("--stats", action="store",
+                          type="string", dest="statsfile",
+                          help="JSON file to add statistics about the commands "
+                          "sent to the device to, for the stats command "
+                          "(defaults to $DM_STATS)",
+                          default=os.environ.get('DM_STATS'))
+
+    def _poolSize(self, command_name):
+        '''
+        Returns how many connections a SUT device needs for a command: batch
+        runs background commands on connections from the pool, every other
+        command makes do with one
+        '''
+        if command_name == 'batch':
+            return self.options.jobs
+        return 1
 
-    def getDevice(self, dmtype="adb", hwid=None, host=None, port=None):
+    def getDevice(self, dmtype="adb", hwid=None, host=None, port=None,
+                  deviceSerial=None, poolSize=1):
         '''
         Returns a device with the specified parameters
         '''
@@ -194,22 +271,82 @@ class DMCli(object):
             mozdevice.DroidSUT.debug = 4
 
         if hwid:
-            return mozdevice.DroidConnectByHWID(hwid)
+            # devices recorded by 'dm discover' are connected to directly
+            return mozdevice.DroidConnectByHWID(hwid,
+                                                registry=mozdevice.DeviceRegistry())
 
         if dmtype == "adb":
             if host and not port:
                 port = 5555
             return mozdevice.DroidADB(packageName=self.options.packagename,
-                                      host=host, port=port)
+                                      host=host, port=port,
+                                      deviceSerial=deviceSerial)
         elif dmtype == "sut":
             if not host:
                 self.parser.error("Must specify host with SUT!")
             if not port:
                 port = 20701
-            return mozdevice.DroidSUT(host=host, port=port)
+            return mozdevice.DroidSUT(host=host, port=port, poolSize=poolSize)
         else:
             self.parser.error("Unknown device manager type: %s" % type)
 
+    def runOnDevices(self, command_name, command_args):
+        '''
+        Runs a command on every device given with --devices in parallel,
+        printing each device's output prefixed with its name. Returns 0 if
+        the command succeeded everywhere, 1 otherwise.
+        '''
+        names = [name.strip() for name in self.options.devices.split(',')
+                 if name.strip()]
+
+        def connect(name):
+            if self.options.dmtype == "sut":
+                (host, sep, port) = name.partition(':')
+                return self.getDevice(dmtype="sut", host=host,
+                                      port=int(port) if port else None,
+                                      poolSize=self._poolSize(command_name))
+            return self.getDevice(dmtype=self.options.dmtype, deviceSerial=name)
+
+        def runCommand(dm):
+            devices.append(dm)
+            cli = DMCli()
+            cli.options = self.options
+            cli.dm = dm
+            buf = output.capture()
+            try:
+                ret = cli.commands[command_name]['function'](*command_args)
+            finally:
+                output.release()
+            return (ret, buf.getvalue())
+
+        devices = []
+        output = _ThreadOutput(sys.stdout)
+        sys.stdout = output
+        try:
+            (pool, results) = mozdevice.DevicePool.connect(
+                names, connect, timeout=self.options.devicetimeout)
+            results.update(pool.run(runCommand))
+        finally:
+            sys.stdout = output.stdout
+            self.saveStats(devices)
+
+        status = 0
+        for name in names:
+            result = results[name]
+            if result.timedOut:
+                print "%s: timed out after %d seconds" % (name, result.elapsed)
+                status = 1
+            elif result.error is not None:
+                print "%s: error: %s" % (name, result.error)
+                status = 1
+            else:
+                (ret, out) = result.value
+                for line in out.splitlines():
+                    print "%s: %s" % (name, line)
+                if ret:
+                    status = 1
+        return status
+
     def push(self, src, dest):
         if os.path.isdir(src):
             self.dm.pushDir(src, dest)
@@ -246,9 +383,8 @@ class DMCli(object):
             self.dm.killProcess(appname)
 
     def shell(self, *args):
-        buf = StringIO.StringIO()
-        self.dm.shell(args, buf)
-        print str(buf.getvalue()[0:-1]).rstrip()
+        # output is written out as the command produces it
+        self.dm.shell(args, sys.stdout)
 
     def getinfo(self, *args):
         directive=None
@@ -294,6 +430,203 @@ class DMCli(object):
         else:
             print 'Must use SUT transport to get SUT version.'
 
+    def saveStats(self, devices):
+        '''
+        Adds the statistics collected by the device managers to the --stats
+        file, if there is one
+        '''
+        if not self.options.statsfile:
+            return
+        metrics = mozdevice.DeviceMetrics()
+        for dm in devices:
+            if getattr(dm, 'metrics', None):
+                metrics.merge(dm.metrics.summary())
+        metrics.save(self.options.statsfile, merge=True)
+
+    def stats(self, action=None):
+        if not self.options.statsfile:
+            self.parser.error("Must give a statistics file with --stats or "
+                              "DM_STATS")
+        if action == 'reset':
+            if os.path.exists(self.options.statsfile):
+                os.remove(self.options.statsfile)
+        elif action == 'json':
+            print json.dumps(mozdevice.DeviceMetrics.load(self.options.statsfile),
+                             indent=2, sort_keys=True)
+        elif action is None:
+            print metrics.formatSummary(
+                mozdevice.DeviceMetrics.load(self.options.statsfile))
+        else:
+            self.parser.error("Unknown stats action: %s" % action)
+
+    def discover(self, action=None, seconds=5):
+        registry = mozdevice.DeviceRegistry()
+        if action == 'scan':
+            agents = mozdevice.DroidDiscoverAll(float(seconds), registry=registry)
+            for (hwid, agent) in sorted(agents.iteritems(),
+                                        key=lambda (hwid, agent): agent['seconds']):
+                print "%s\t%s:%s\t%.2fs" % (hwid, agent['ip'], agent['port'],
+                                            agent['seconds'])
+            print "%d agents found" % len(agents)
+        elif action == 'list':
+            for (hwid, entry) in sorted(registry.entries().iteritems()):
+                address = entry['ip'] or ''
+                if entry['port']:
+                    address += ':%s' % entry['port']
+                print "%s\t%s\t%s\t%s" % (hwid, entry['transport'], address,
+                                          time.strftime('%H:%M:%S',
+                                                        time.localtime(entry['lastSeen'])))
+        elif action is None:
+            print "Recording devices in %s, press ctrl-c to stop" % registry.path
+            mozdevice.DiscoveryService(registry).run()
+        else:
+            self.parser.error("Unknown discover action: %s" % action)
+
+    def batch(self, script='-'):
+        if script == '-':
+            lines = sys.stdin.readlines()
+        else:
+            with open(script) as f:
+                lines = f.readlines()
+
+        output = _ThreadOutput(sys.stdout)
+        outputLock = threading.Lock()
+        jobSlots = threading.BoundedSemaphore(self.options.jobs)
+        jobs = []
+        failures = []
+        start = time.time()
+
+        def report(number, line, ret, elapsed, out=''):
+            with outputLock:
+                for outline in out.splitlines():
+                    output.stdout.write("[%d] %s\n" % (number, outline))
+                output.stdout.flush()
+                sys.stderr.write("[%d] %s: exit status %s (%.2fs)\n" %
+                                 (number, line, ret, elapsed))
+            if ret:
+                failures.append(number)
+
+        def runJob(number, line, args):
+            try:
+                buf = output.capture()
+                connection = getattr(self.dm, 'connection', None)
+                start = time.time()
+                try:
+                    if connection:
+                        # SUT background commands each get a socket of their own
+                        with connection() as conn:
+                            (ret, elapsed) = self._runBatchCommand(conn, args)
+                    else:
+                        (ret, elapsed) = self._runBatchCommand(self.dm, args)
+                except Exception, e:
+                    # e.g. no connection could be made for the command
+                    print "error: %s" % e
+                    (ret, elapsed) = (1, time.time() - start)
+                finally:
+                    output.release()
+                report(number, line, ret, elapsed, buf.getvalue())
+            finally:
+                jobSlots.release()
+
+        def wait():
+            for job in jobs:
+                job.join()
+            del jobs[:]
+
+        sys.stdout = output
+        try:
+            for (number, line) in enumerate(lines, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                background = line.endswith('&')
+                if background:
+                    line = line[:-1].rstrip()
+                try:
+                    args = shlex.split(line)
+                    self._batchCommand(args)
+                except ValueError, e:
+                    report(number, line, 'error: %s' % e, 0)
+                    continue
+
+                if args == ['wait']:
+                    wait()
+                elif background:
+                    jobSlots.acquire()
+                    job = threading.Thread(target=runJob, args=(number, line, args))
+                    job.daemon = True
+                    jobs.append(job)
+                    job.start()
+                else:
+                    (ret, elapsed) = self._runBatchCommand(self.dm, args)
+                    report(number, line, ret, elapsed)
+            wait()
+        finally:
+            sys.stdout = output.stdout
+
+        sys.stderr.write("%d commands failed, %.2fs in all\n" %
+                         (len(failures), time.time() - start))
+        return 1 if failures else 0
+
+    def _batchCommand(self, args):
+        '''
+        Checks a line of a batch script, raising ValueError if it isn't a
+        command that can be run
+        '''
+        if args == ['wait']:
+            return
+        if not args:
+            raise ValueError("empty command")
+        (name, command_args) = (args[0], args[1:])
+        command = self.commands.get(name)
+        if not command or name == 'batch':
+            raise ValueError("invalid command %s" % name)
+        if (len(command_args) < command['min_args'] or
+            (command['max_args'] is not None and len(command_args) >
+             command['max_args'])):
+            raise ValueError("wrong number of arguments to %s" % name)
+
+    def _runBatchCommand(self, dm, args):
+        '''
+        Runs a command from a batch script on dm, returning its exit status
+        and how many seconds it took
+        '''
+        cli = DMCli()
+        cli.options = self.options
+        cli.dm = dm
+        start = time.time()
+        try:
+            ret = cli.commands[args[0]]['function'](*args[1:]) or 0
+        except Exception, e:
+            print "error: %s" % e
+            ret = 1
+        except SystemExit, e:
+            ret = e.code
+        return (ret, time.time() - start)
+
+class _ThreadOutput(object):
+    '''
+    Stands in for sys.stdout while a command runs on several devices at
+    once, so that each thread's output can be kept separate
+    '''
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self._local = threading.local()
+
+    def capture(self):
+        self._local.buf = StringIO.StringIO()
+        return self._local.buf
+
+    def release(self):
+        self._local.buf = None
+
+    def write(self, data):
+        (getattr(self._local, 'buf', None) or self.stdout).write(data)
+
+    def flush(self):
+        pass
+
 def cli(args=sys.argv[1:]):
     # process the command line
     cli = DMCli()
@@ -7,10 +7,11 @@ import re
 import threading
 
 from Zeroconf import Zeroconf, ServiceBrowser
-from devicemanager import ZeroconfListener, NetworkTools
+from devicemanager import ZeroconfListener, ZeroconfInventoryListener, NetworkTools
 from devicemanagerADB import DeviceManagerADB
 from devicemanagerSUT import DeviceManagerSUT
 from devicemanager import DMError
+from discovery import DeviceRegistry
 
 class DroidMixin(object):
     """Mixin to extend DeviceManager with Android-specific functionality"""
@@ -51,7 +52,9 @@ class DroidMixin(object):
         # show what's going on here... so just create an empty memory buffer
         # and ignore (except on error)
         shellOutput = StringIO.StringIO()
-        if self.shell(acmd, shellOutput) == 0:
+        retcode = self.shell(acmd, shellOutput)
+        self._invalidateProcessTable()
+        if retcode == 0:
             return
 
         shellOutput.seek(0)
@@ -108,8 +111,63 @@ class DroidSUT(DeviceManagerSUT, DroidMixin):
 
         return []
 
-def DroidConnectByHWID(hwid, timeout=30, **kwargs):
-    """Try to connect to the given device by waiting for it to show up using mDNS with the given timeout."""
+def DroidDiscoverAll(timeout=5, count=None, registry=None, zeroconf=None):
+    """Browse for SUTAgents using mDNS for timeout seconds, or until count
+    of them have been found, in a single browse however many there are.
+    Returns a dict of hwid to a dict of the agent's 'ip', 'port' and the
+    'seconds' it took to show up.  The agents found are recorded in
+    registry if one is given.  Browses with zeroconf if given, rather
+    than starting a Zeroconf of its own."""
+    zc = zeroconf
+    if zc is None:
+        zc = Zeroconf(NetworkTools().getLanIp())
+
+    evt = threading.Event()
+    listener = ZeroconfInventoryListener(evt, count)
+    sb = ServiceBrowser(zc, "_sutagent._tcp.local.", listener)
+    evt.wait(timeout)
+    sb.cancel()
+    if zeroconf is None:
+        zc.close()
+
+    agents = dict(listener.agents)
+    if registry is not None and agents:
+        registry.update(dict((hwid, ('sut', agent['ip'], agent['port']))
+                             for (hwid, agent) in agents.iteritems()))
+    return agents
+
+def _connectFromRegistry(hwid, registry, **kwargs):
+    entry = registry.get(hwid)
+    if entry is None:
+        return None
+    # a single attempt: if the device isn't where it was, browsing for it
+    # is quicker than retrying
+    retryLimit = kwargs.get('retryLimit', 5)
+    kwargs = dict(kwargs, retryLimit=1)
+    try:
+        if entry['transport'] == 'sut':
+            dm = DroidSUT(entry['ip'], **dict(kwargs, port=entry['port']))
+        else:
+            dm = DroidADB(deviceSerial=hwid, **kwargs)
+    except Exception:
+        # it has moved or gone away since it was last seen
+        registry.remove(hwid)
+        return None
+    dm.retryLimit = retryLimit
+    print "Connected via %s to %s [registered at %s]" % \
+        (entry['transport'].upper(), hwid, entry['ip'])
+    return dm
+
+def DroidConnectByHWID(hwid, timeout=30, registry=None, **kwargs):
+    """Try to connect to the given device, looking it up first in
+    registry if a DeviceRegistry is given, and if it isn't there or can't
+    be reached where it was, waiting for it to show up using mDNS with the
+    given timeout.  Where the device was found is recorded in registry."""
+    if registry is not None:
+        dm = _connectFromRegistry(hwid, registry, **kwargs)
+        if dm is not None:
+            return dm
+
     nt = NetworkTools()
     local_ip = nt.getLanIp()
 
@@ -126,8 +184,11 @@ def DroidConnectByHWID(hwid, timeout=30, **kwargs):
     zc.close()
 
     if foundIP is not None:
-        return DroidSUT(foundIP, **kwargs)
-    print "Connected via SUT to %s [at %s]" % (hwid, foundIP)
+        sut = DroidSUT(foundIP, **kwargs)
+        if registry is not None:
+            registry.put(hwid, 'sut', foundIP, kwargs.get('port', 20701))
+        print "Connected via SUT to %s [at %s]" % (hwid, foundIP)
+        return sut
 
     # try connecting via adb
     try:
@@ -135,5 +196,7 @@ def DroidConnectByHWID(hwid, timeout=30, **kwargs):
     except:
         return None
 
+    if registry is not None:
+        registry.put(hwid, 'adb')
     print "Connected via ADB to %s" % (hwid)
     return sut
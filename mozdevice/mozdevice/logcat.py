@@ -0,0 +1,137 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Captures a device's logcat continuously in the background
+"""
+
+import collections
+import itertools
+import re
+import threading
+
+def _compileFilterOut(filterOutRegexps):
+    """
+    Combines a list of regular expressions into a single one which matches
+    wherever any of them would, or returns None if the list is empty
+    """
+    if not filterOutRegexps:
+        return None
+    return re.compile('|'.join('(?:%s)' % regex for regex in filterOutRegexps))
+
+def filterLines(lines, filterOutRegexps):
+    """
+    Returns the lines which don't match any of filterOutRegexps, in a
+    single pass over them
+    """
+    filterOut = _compileFilterOut(filterOutRegexps)
+    if not filterOut:
+        return list(lines)
+    return [line for line in lines if not filterOut.search(line)]
+
+class LogcatStreamer(object):
+    """
+    Tails a device's logcat into a bounded ring buffer, so that nothing is
+    lost to logcat's own buffer overflowing and the log doesn't have to be
+    downloaded again every time it is looked at, e.g.
+
+    streamer = LogcatStreamer(dm)
+    streamer.start()
+    marker = streamer.mark()
+    ... run a test ...
+    lines = streamer.linesSince(marker)
+
+    filterSpecs are passed on to logcat itself, and lines matching any of
+    filterOutRegexps are dropped as they arrive. Once the buffer holds
+    maxLines lines, the oldest ones are discarded to make room.
+    """
+
+    def __init__(self, dm, filterSpecs=[], format="time", filterOutRegexps=[],
+                 maxLines=100000):
+        self.dm = dm
+        self.filterSpecs = list(filterSpecs)
+        self.format = format
+        self.maxLines = maxLines
+        self._filterOut = _compileFilterOut(filterOutRegexps)
+        self._lines = collections.deque(maxlen=maxLines)
+        # number of lines kept since the streamer was created
+        self._count = 0
+        self._lock = threading.Lock()
+        self._stop = None
+        self._running = False
+
+    @property
+    def running(self):
+        """
+        True while logcat is being tailed
+        """
+        return self._running
+
+    @property
+    def dropped(self):
+        """
+        Number of captured lines which are no longer in the buffer
+        """
+        with self._lock:
+            return self._count - len(self._lines)
+
+    def start(self):
+        """
+        Starts tailing logcat, if it isn't already
+        """
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+        cmdline = ["/system/bin/logcat", "-v", self.format] + self.filterSpecs
+        self._stop = self.dm._streamShell(cmdline, self._ingest,
+                                          root=self.dm._logcatNeedsRoot)
+
+    def stop(self):
+        """
+        Stops tailing logcat. Lines already captured are kept.
+        """
+        if self._stop:
+            self._stop()
+            self._stop = None
+        self._running = False
+
+    def _ingest(self, line):
+        if line is None:
+            # logcat went away, e.g. because the device rebooted
+            self._running = False
+            return
+        line = line.rstrip('\r\n')
+        if not line or (self._filterOut and self._filterOut.search(line)):
+            return
+        with self._lock:
+            self._lines.append(line + '\n')
+            self._count += 1
+
+    def mark(self):
+        """
+        Returns a marker for the current end of the log, to pass to
+        linesSince() later
+        """
+        with self._lock:
+            return self._count
+
+    def linesSince(self, marker=0, filterOutRegexps=[]):
+        """
+        Returns the lines captured since marker (a value returned by mark(),
+        or 0 for everything still in the buffer), leaving out any which
+        match filterOutRegexps. Lines which have been discarded from the
+        buffer since the marker was taken are missing from the result.
+        """
+        with self._lock:
+            first = self._count - len(self._lines)
+            lines = list(itertools.islice(self._lines, max(0, marker - first), None))
+        return filterLines(lines, filterOutRegexps)
+
+    def clear(self):
+        """
+        Empties the buffer. Markers taken before stay valid.
+        """
+        with self._lock:
+            self._lines.clear()
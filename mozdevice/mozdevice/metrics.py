@@ -0,0 +1,220 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Latency, throughput and error counts for the commands a device manager runs
+"""
+
+import bisect
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds of the latency histogram's buckets, in seconds; the last
+# bucket holds everything slower
+LATENCY_BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+                   1, 2, 5, 10, 30, 60, 300]
+
+class _Measurement(object):
+    """
+    What DeviceMetrics.measure() finds out about a command while it runs
+    """
+
+    def __init__(self):
+        self.bytesSent = 0
+        self.bytesReceived = 0
+        self.timedOut = False
+
+class DeviceMetrics(object):
+    """
+    Collects per-operation statistics about the commands a device manager
+    sends: a latency histogram, bytes sent and received, and counts of
+    failures, timeouts and retries, along with how often the connection to
+    the device had to be re-established. Operations are named after the
+    command run (push, pull, shell, ls, hash and so on).
+
+    A DeviceMetrics may be shared by several device managers, and used from
+    any number of threads. Hooks added with addHook() are called with each
+    event as it is recorded, for passing the figures on elsewhere.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hooks = []
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets everything recorded so far
+        """
+        with self._lock:
+            self._operations = {}
+            self.reconnects = 0
+            self.started = time.time()
+
+    def addHook(self, hook):
+        """
+        Calls hook(event, operation, details) for every event recorded from
+        now on, where event is 'command', 'retry' or 'reconnect', and details
+        is a dict ('seconds', 'bytesSent', 'bytesReceived', 'failed' and
+        'timedOut' for commands, empty otherwise)
+        """
+        self._hooks.append(hook)
+
+    def removeHook(self, hook):
+        self._hooks.remove(hook)
+
+    def _operation(self, operation):
+        stats = self._operations.get(operation)
+        if stats is None:
+            stats = self._operations[operation] = {
+                'count': 0, 'failures': 0, 'timeouts': 0, 'retries': 0,
+                'bytesSent': 0, 'bytesReceived': 0, 'totalSeconds': 0.0,
+                'maxSeconds': 0.0, 'histogram': [0] * (len(LATENCY_BUCKETS) + 1) }
+        return stats
+
+    def _notify(self, event, operation, details):
+        for hook in list(self._hooks):
+            hook(event, operation, details)
+
+    def record(self, operation, seconds, bytesSent=0, bytesReceived=0,
+               failed=False, timedOut=False):
+        """
+        Records one command. seconds may be None if the command's latency
+        isn't known, in which case it's counted but left out of the
+        histogram.
+        """
+        with self._lock:
+            stats = self._operation(operation)
+            stats['count'] += 1
+            stats['bytesSent'] += bytesSent
+            stats['bytesReceived'] += bytesReceived
+            if failed:
+                stats['failures'] += 1
+            if timedOut:
+                stats['timeouts'] += 1
+            if seconds is not None:
+                stats['totalSeconds'] += seconds
+                stats['maxSeconds'] = max(stats['maxSeconds'], seconds)
+                stats['histogram'][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self._notify('command', operation,
+                     { 'seconds': seconds, 'bytesSent': bytesSent,
+                       'bytesReceived': bytesReceived, 'failed': failed,
+                       'timedOut': timedOut })
+
+    @contextmanager
+    def measure(self, operation):
+        """
+        Times the body of a with block as a command, which counts as failed
+        if the block raises an exception. The block can fill in the byte
+        counts and timedOut flag of the object it is given.
+        """
+        measurement = _Measurement()
+        start = time.time()
+        failed = True
+        try:
+            yield measurement
+            failed = False
+        except Exception, e:
+            if getattr(e, 'timeout', False):
+                measurement.timedOut = True
+            raise
+        finally:
+            self.record(operation, time.time() - start,
+                        bytesSent=measurement.bytesSent,
+                        bytesReceived=measurement.bytesReceived,
+                        failed=failed or measurement.timedOut,
+                        timedOut=measurement.timedOut)
+
+    def countRetry(self, operation):
+        with self._lock:
+            self._operation(operation)['retries'] += 1
+        self._notify('retry', operation, {})
+
+    def countReconnect(self):
+        with self._lock:
+            self.reconnects += 1
+        self._notify('reconnect', None, {})
+
+    def summary(self):
+        """
+        returns: dict of everything recorded, which can be saved as JSON.
+                 Histograms are lists of counts, one for each of
+                 LATENCY_BUCKETS plus one for slower commands.
+        """
+        with self._lock:
+            return { 'started': self.started,
+                     'elapsed': time.time() - self.started,
+                     'reconnects': self.reconnects,
+                     'latencyBuckets': LATENCY_BUCKETS,
+                     'operations': dict((name, dict(stats, histogram=list(stats['histogram'])))
+                                        for (name, stats) in self._operations.iteritems()) }
+
+    def toJSON(self):
+        return json.dumps(self.summary(), indent=2, sort_keys=True)
+
+    def merge(self, summary):
+        """
+        Adds the figures from a summary() (e.g. one loaded from a file
+        written by save()) to these ones
+        """
+        with self._lock:
+            self.reconnects += summary.get('reconnects', 0)
+            self.started = min(self.started, summary.get('started', self.started))
+            for (name, other) in summary.get('operations', {}).iteritems():
+                stats = self._operation(name)
+                for key in ('count', 'failures', 'timeouts', 'retries',
+                            'bytesSent', 'bytesReceived', 'totalSeconds'):
+                    stats[key] += other.get(key, 0)
+                stats['maxSeconds'] = max(stats['maxSeconds'], other.get('maxSeconds', 0))
+                for (i, count) in enumerate(other.get('histogram', [])[:len(stats['histogram'])]):
+                    stats['histogram'][i] += count
+
+    @staticmethod
+    def load(path):
+        """
+        returns: the summary saved in path by save(), or an empty one if
+                 there is no such file
+        """
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except IOError:
+            return {}
+
+    def save(self, path, merge=False):
+        """
+        Writes the summary to path as JSON, adding in the figures already
+        there if merge is True. The file is replaced atomically.
+        """
+        metrics = self
+        if merge:
+            metrics = DeviceMetrics()
+            metrics.merge(self.load(path))
+            metrics.merge(self.summary())
+        directory = os.path.dirname(os.path.abspath(path))
+        (fd, tmpPath) = tempfile.mkstemp(dir=directory, prefix='.metrics')
+        with os.fdopen(fd, 'w') as f:
+            f.write(metrics.toJSON())
+        os.rename(tmpPath, path)
+
+def formatSummary(summary):
+    """
+    returns: a summary() as a human readable table, one operation per line
+    """
+    lines = ['%-10s %7s %6s %8s %7s %9s %9s %10s %10s' %
+             ('operation', 'count', 'failed', 'timeouts', 'retries',
+              'mean ms', 'max ms', 'sent', 'received')]
+    for (name, stats) in sorted(summary.get('operations', {}).iteritems()):
+        timed = sum(stats['histogram'])
+        mean = stats['totalSeconds'] / timed * 1000 if timed else 0
+        lines.append('%-10s %7d %6d %8d %7d %9.1f %9.1f %10d %10d' %
+                     (name, stats['count'], stats['failures'], stats['timeouts'],
+                      stats['retries'], mean, stats['maxSeconds'] * 1000,
+                      stats['bytesSent'], stats['bytesReceived']))
+    lines.append('reconnects: %d' % summary.get('reconnects', 0))
+    return '\n'.join(lines)
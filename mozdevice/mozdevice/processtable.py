@@ -0,0 +1,77 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Snapshots of a device's process list, indexed for quick lookups
+"""
+
+import time
+
+class ProcessTable(object):
+    """
+    The processes running on a device at one point in time, as returned by
+    DeviceManager.getProcessList(), indexed by pid and by name. Names are
+    indexed by their last path component, so '/system/bin/sh' can be found
+    as 'sh'.
+    """
+
+    def __init__(self, processes, timestamp=None):
+        """
+        processes - list of process tuples, each starting with pid and name
+        timestamp - when the list was taken, defaults to now
+        """
+        self.processes = [tuple(proc) for proc in processes]
+        self.timestamp = timestamp or time.time()
+        self._byPid = {}
+        self._byName = {}
+        for proc in self.processes:
+            self._byPid[int(proc[0])] = proc
+            self._byName.setdefault(proc[1].split('/')[-1], []).append(proc)
+
+    @property
+    def age(self):
+        """
+        Seconds since the snapshot was taken
+        """
+        return time.time() - self.timestamp
+
+    def __len__(self):
+        return len(self.processes)
+
+    def __iter__(self):
+        return iter(self.processes)
+
+    def __contains__(self, name):
+        return name.split('/')[-1] in self._byName
+
+    def get(self, pid):
+        """
+        returns: the process tuple for pid, or None if there is no such process
+        """
+        return self._byPid.get(int(pid))
+
+    def find(self, name):
+        """
+        returns: list of the process tuples for processes called name
+        """
+        return list(self._byName.get(name.split('/')[-1], []))
+
+    def pids(self, name):
+        """
+        returns: list of the pids of processes called name
+        """
+        return [int(proc[0]) for proc in self.find(name)]
+
+    def diff(self, older):
+        """
+        Compares this snapshot with an older one
+
+        returns: (list of processes which have started since, list of
+                  processes which have exited since)
+        """
+        started = [proc for proc in self.processes
+                   if older._byPid.get(int(proc[0]), (None, None))[1] != proc[1]]
+        exited = [proc for proc in older.processes
+                  if self._byPid.get(int(proc[0]), (None, None))[1] != proc[1]]
+        return (started, exited)
@@ -0,0 +1,453 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Waits for rebooting devices to come back, many at once, on a single thread
+"""
+
+import errno
+import heapq
+import Queue
+import select
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+from devicemanager import DMError
+
+class RebootHandle(object):
+    """
+    Returned by rebootAsync(): tracks a single device coming back up
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        # seconds the device took to come back (None while waiting)
+        self.elapsed = None
+        # why waiting for the device failed, if it did
+        self.error = None
+        self._event = threading.Event()
+
+    def done(self):
+        """
+        Returns True once the device is back up or waiting for it has failed
+        """
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the device is back up or waiting for it has failed, or
+        for at most timeout seconds. Returns done().
+        """
+        self._event.wait(timeout)
+        return self.done()
+
+    def result(self, timeout=None):
+        """
+        Blocks like wait(), raising DMError unless the device came back
+        """
+        if not self.wait(timeout):
+            raise DMError("Automation Error: still waiting for %s to reboot" % self.name)
+        if self.error:
+            raise DMError("Automation Error: %s" % self.error)
+        return True
+
+    def __repr__(self):
+        if not self.done():
+            status = 'waiting'
+        elif self.error:
+            status = 'failed: %s' % self.error
+        else:
+            status = 'ready after %.1fs' % self.elapsed
+        return '<RebootHandle %s %s>' % (self.name, status)
+
+class RebootMonitor(object):
+    """
+    Event loop which multiplexes readiness checks for any number of
+    rebooting devices: callback sockets, agent connections and adb
+    processes. Checks which find a device still down are retried with an
+    exponential backoff, from initialDelay up to maxDelay seconds.
+
+    The loop runs on a background thread, which exits whenever there is
+    nothing left to wait for.
+    """
+
+    # longest the loop sleeps before checking on processes and new work
+    tick = 0.1
+
+    def __init__(self, initialDelay=1.0, backoffFactor=2.0, maxDelay=30.0):
+        self.initialDelay = initialDelay
+        self.backoffFactor = backoffFactor
+        self.maxDelay = maxDelay
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._calls = Queue.Queue()
+        self._active = 0
+
+        # only touched on the loop thread
+        self._readers = {}
+        self._writers = {}
+        self._timers = []
+        self._processes = []
+
+    def watch(self, probe, timeout, name=None):
+        """
+        Starts waiting for a device, using a probe from this module
+
+        returns: RebootHandle
+        """
+        handle = RebootHandle(name)
+        probe.handle = handle
+        probe.monitor = self
+        probe.delay = self.initialDelay
+        with self._lock:
+            self._active += 1
+            self._calls.put(lambda: self._startProbe(probe, timeout))
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        return handle
+
+    def _startProbe(self, probe, timeout):
+        self.callLater(probe, timeout, lambda: self.finish(
+                probe, "timed out after %d seconds waiting for reboot" % timeout))
+        self._dispatch(probe, probe.start)
+
+    def _dispatch(self, probe, func, *args):
+        """
+        Runs one of a probe's callbacks, failing only that probe's device if
+        it raises
+        """
+        if probe.handle.done():
+            return
+        try:
+            func(*args)
+        except Exception, e:
+            self.finish(probe, "error waiting for reboot: %s" % e)
+
+    def finish(self, probe, error=None):
+        """
+        Marks a probe's device as ready (or failed) and cleans up after it
+        """
+        handle = probe.handle
+        if handle.done():
+            return
+        probe.stop()
+        handle.error = error
+        handle.elapsed = time.time() - handle.started
+        handle._event.set()
+        with self._lock:
+            self._active -= 1
+
+    def callLater(self, probe, delay, func):
+        heapq.heappush(self._timers, (time.time() + delay, id(func), probe, func))
+
+    def watchRead(self, probe, sock, func):
+        self._readers[sock] = (probe, func)
+
+    def watchWrite(self, probe, sock, func):
+        self._writers[sock] = (probe, func)
+
+    def unwatch(self, sock):
+        self._readers.pop(sock, None)
+        self._writers.pop(sock, None)
+
+    def runProcess(self, probe, args, func):
+        """
+        Starts a process, calling func(returncode, output) once it exits.
+        Returns the Popen object.
+        """
+        output = tempfile.SpooledTemporaryFile()
+        proc = subprocess.Popen(args, stdout=output, stderr=subprocess.STDOUT)
+        self._processes.append((proc, output, probe, func))
+        return proc
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._active and self._calls.empty():
+                    self._readers.clear()
+                    self._writers.clear()
+                    self._timers = []
+                    self._processes = []
+                    self._thread = None
+                    return
+
+            try:
+                while True:
+                    self._calls.get_nowait()()
+            except Queue.Empty:
+                pass
+
+            wait = self.tick
+            if self._timers:
+                wait = max(0, min(wait, self._timers[0][0] - time.time()))
+            if self._readers or self._writers:
+                try:
+                    (readable, writable, _) = select.select(self._readers.keys(),
+                                                            self._writers.keys(), [], wait)
+                except select.error, e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    (readable, writable) = ([], [])
+                for sock in writable:
+                    if sock in self._writers:
+                        self._dispatch(*self._writers.pop(sock))
+                for sock in readable:
+                    if sock in self._readers:
+                        self._dispatch(*self._readers[sock])
+            else:
+                time.sleep(wait)
+
+            now = time.time()
+            while self._timers and self._timers[0][0] <= now:
+                (_, _, probe, func) = heapq.heappop(self._timers)
+                self._dispatch(probe, func)
+
+            for entry in list(self._processes):
+                (proc, output, probe, func) = entry
+                if proc.poll() is not None:
+                    self._processes.remove(entry)
+                    output.seek(0)
+                    data = output.read()
+                    output.close()
+                    self._dispatch(probe, func, proc.returncode, data)
+
+_defaultMonitor = None
+_defaultMonitorLock = threading.Lock()
+
+def getDefaultMonitor():
+    """
+    Returns the RebootMonitor shared by all device managers by default
+    """
+    global _defaultMonitor
+    with _defaultMonitorLock:
+        if not _defaultMonitor:
+            _defaultMonitor = RebootMonitor()
+        return _defaultMonitor
+
+class _Probe(object):
+    """
+    Base class for the checks a RebootMonitor runs to find out whether a
+    device is back up. All methods run on the monitor's thread, apart from
+    the constructor.
+    """
+
+    handle = None
+    monitor = None
+    delay = None
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def discard(self):
+        """
+        Releases what the probe holds when it isn't going to be watched
+        after all, e.g. because the reboot command failed. Not run on the
+        monitor's thread.
+        """
+        pass
+
+    def later(self, func):
+        """
+        Calls func after the current backoff delay, then increases it. Until
+        a probe has seen the device go down there is no backoff, so that a
+        reboot which is over quickly isn't missed between two checks.
+        """
+        delay = self.delay
+        if getattr(self, 'wentDown', True):
+            self.delay = min(self.delay * self.monitor.backoffFactor, self.monitor.maxDelay)
+        self.monitor.callLater(self, delay, func)
+
+    def ready(self):
+        self.monitor.finish(self)
+
+class CallbackProbe(_Probe):
+    """
+    Waits for the SUT agent to connect back to us once it has restarted.
+    The listening socket is opened straight away, so that it's there before
+    the device is told to reboot.
+    """
+
+    def __init__(self, ip, port, settlingTime=0):
+        self.settlingTime = settlingTime
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((ip, port))
+        self._server.listen(1)
+        self._conns = []
+
+    def start(self):
+        self.monitor.watchRead(self, self._server, self._accept)
+
+    def stop(self):
+        for sock in [self._server] + self._conns:
+            self.monitor.unwatch(sock)
+            sock.close()
+        self._conns = []
+
+    def discard(self):
+        self._server.close()
+
+    def _accept(self):
+        try:
+            (conn, _) = self._server.accept()
+        except socket.error:
+            return
+        conn.setblocking(0)
+        self._conns.append(conn)
+        self.monitor.watchRead(self, conn, lambda: self._recv(conn))
+
+    def _recv(self, conn):
+        try:
+            # receiving any data is good enough
+            data = conn.recv(1024)
+            if data:
+                conn.setblocking(1)
+                conn.sendall('OK')
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = None
+        self.monitor.unwatch(conn)
+        self._conns.remove(conn)
+        conn.close()
+
+        if data:
+            self.monitor.unwatch(self._server)
+            # give the device's services time to come up too
+            self.monitor.callLater(self, self.settlingTime, self.ready)
+
+class AgentProbe(_Probe):
+    """
+    Waits until the SUT agent goes away and then answers with its prompt
+    again
+    """
+
+    _inProgress = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, 10035)
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.wentDown = False
+        self._sock = None
+        self._buf = ''
+
+    def start(self):
+        self.later(self._connect)
+
+    def stop(self):
+        self._close()
+
+    def _close(self):
+        if self._sock:
+            self.monitor.unwatch(self._sock)
+            self._sock.close()
+            self._sock = None
+        self._buf = ''
+
+    def _down(self):
+        self._close()
+        self.wentDown = True
+        self.later(self._connect)
+
+    def _connect(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setblocking(0)
+        err = self._sock.connect_ex((self.host, self.port))
+        if err and err not in self._inProgress:
+            self._down()
+            return
+        self.monitor.watchWrite(self, self._sock, self._connected)
+
+    def _connected(self):
+        if self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+            self._down()
+        elif not self.wentDown:
+            # still the agent from before the reboot
+            self._close()
+            self.later(self._connect)
+        else:
+            self.monitor.watchRead(self, self._sock, self._recv)
+
+    def _recv(self):
+        try:
+            data = self._sock.recv(1024)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = None
+        if not data:
+            self._down()
+            return
+        self._buf += data
+        if '$>' in self._buf:
+            self.ready()
+
+class ADBProbe(_Probe):
+    """
+    Waits until adb loses the device and then sees it again, like
+    adb wait-for-device but without blocking on it, and then until Android
+    has finished booting
+    """
+
+    def __init__(self, adbArgs, connectArgs=None):
+        """
+        adbArgs - adb command line up to the command, e.g. ['adb', '-s', serial]
+        connectArgs - adb command line to reconnect to a device over TCP/IP
+        """
+        self.adbArgs = adbArgs
+        self.connectArgs = connectArgs
+        self.wentDown = False
+        self._procs = []
+
+    def start(self):
+        self.later(self._getState)
+
+    def stop(self):
+        for proc in self._procs:
+            if proc.poll() is None:
+                proc.kill()
+        self._procs = []
+
+    def _runProcess(self, args, func):
+        self._procs = [p for p in self._procs if p.poll() is None]
+        self._procs.append(self.monitor.runProcess(self, args, func))
+
+    def _getState(self):
+        self._runProcess(self.adbArgs + ['get-state'], self._gotState)
+
+    def _gotState(self, returncode, output):
+        lines = output.strip().splitlines()
+        state = lines[-1].strip() if lines else ''
+        if state != 'device':
+            self.wentDown = True
+            if self.connectArgs:
+                self._runProcess(self.connectArgs, lambda returncode, output:
+                                     self.later(self._getState))
+            else:
+                self.later(self._getState)
+        elif not self.wentDown:
+            self.later(self._getState)
+        else:
+            self.delay = self.monitor.initialDelay
+            self._checkBooted()
+
+    def _checkBooted(self):
+        self._runProcess(self.adbArgs + ['shell', 'getprop', 'sys.boot_completed'],
+                         self._gotBooted)
+
+    def _gotBooted(self, returncode, output):
+        if output.strip() == '1':
+            self.ready()
+        else:
+            self.later(self._checkBooted)
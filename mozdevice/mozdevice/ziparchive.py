@@ -0,0 +1,70 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Builds zip archives of directory trees in-process, for pushing a whole tree
+to a device in a few transfers rather than one per file
+"""
+
+import os
+import zipfile
+
+# files which are compressed already, and so are stored rather than deflated
+STORED_EXTENSIONS = frozenset(['.xpi', '.apk', '.jar', '.zip', '.gz', '.bz2',
+                               '.png', '.jpg', '.jpeg', '.gif', '.webm',
+                               '.ogg', '.mp3', '.mp4', '.woff'])
+
+def collectFiles(localDir):
+    """
+    Lists the files under localDir, following symbolic links so that the
+    files they point to are archived rather than the links themselves.
+    Empty directories are listed too, so that they get created.
+
+    returns: list of (path, name in the archive, size) tuples
+    """
+    files = []
+    for (root, dirs, filenames) in os.walk(localDir, followlinks=True):
+        dirs.sort()
+        if not dirs and not filenames and root != localDir:
+            files.append((root, os.path.relpath(root, localDir).replace(os.sep, '/') + '/', 0))
+        for filename in sorted(filenames):
+            path = os.path.join(root, filename)
+            arcname = os.path.relpath(path, localDir).replace(os.sep, '/')
+            files.append((path, arcname, os.path.getsize(path)))
+    return files
+
+def splitShards(files, shardSize, maxShards):
+    """
+    Splits a list from collectFiles() into shards of roughly shardSize bytes
+    each, but no more than maxShards of them, balancing their sizes
+
+    returns: list of lists of files
+    """
+    total = sum(size for (path, arcname, size) in files)
+    count = max(1, min(maxShards, len(files), -(-total // shardSize)))
+    shards = [[] for i in range(count)]
+    sizes = [0] * count
+    # largest first, each to the shard with the least in it so far
+    for entry in sorted(files, key=lambda entry: entry[2], reverse=True):
+        i = sizes.index(min(sizes))
+        shards[i].append(entry)
+        sizes[i] += entry[2]
+    return shards
+
+def writeZip(files, fileobj):
+    """
+    Writes the files (a list from collectFiles()) into a zip archive in
+    fileobj, which must be seekable. Each file is read and compressed in
+    pieces, so memory use doesn't depend on the size of the files, and is
+    stored rather than deflated if it's compressed already.
+    """
+    archive = zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+    try:
+        for (path, arcname, size) in files:
+            if os.path.splitext(arcname)[1].lower() in STORED_EXTENSIONS:
+                archive.write(path, arcname, zipfile.ZIP_STORED)
+            else:
+                archive.write(path, arcname, zipfile.ZIP_DEFLATED)
+    finally:
+        archive.close()
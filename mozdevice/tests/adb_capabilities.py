@@ -0,0 +1,90 @@
+from mozdevice import CapabilityCache, DeviceManagerADB
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+
+# stands in for adb, logging the commands it's asked to run and giving the
+# answers of a rooted device with unzip
+FAKE_ADB = """#!%s
+import os, sys
+args = sys.argv[1:]
+if args[:1] == ['-s']:
+    args = args[2:]
+with open(os.environ['FAKE_ADB_LOG'], 'a') as log:
+    log.write(' '.join(args) + '\\n')
+cmd = ' '.join(args[1:])
+if args[0] == 'version':
+    print 'Android Debug Bridge version 1.0.31'
+elif args[0] == 'devices':
+    print 'List of devices attached'
+    print 'emulator-5554\\tdevice'
+elif 'getprop' in cmd:
+    print 'emulator-5554'
+    print os.environ['FAKE_ADB_FINGERPRINT']
+elif cmd == 'id':
+    print 'uid=0(root) gid=0(root)'
+elif cmd == 'unzip':
+    print 'Usage: unzip [-lnopq] FILE[.zip] [FILE]... [-x FILE...] [-d DIR]'
+"""
+
+class CapabilityCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.adb = os.path.join(self.tempdir, 'adb')
+        with open(self.adb, 'w') as f:
+            f.write(FAKE_ADB % sys.executable)
+        os.chmod(self.adb, stat.S_IRWXU)
+        self.log = os.path.join(self.tempdir, 'log')
+        os.environ['FAKE_ADB_LOG'] = self.log
+        os.environ['FAKE_ADB_FINGERPRINT'] = 'generic/sdk/generic:4.2/JB/1:eng/test-keys'
+        self.cache = CapabilityCache(os.path.join(self.tempdir, 'cache', 'capabilities.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def connect(self):
+        if os.path.exists(self.log):
+            os.remove(self.log)
+        dm = DeviceManagerADB(adbPath=self.adb, deviceSerial='emulator-5554',
+                              packageName=None, capabilityCache=self.cache)
+        with open(self.log) as f:
+            return (dm, f.read().splitlines())
+
+    def test_cache(self):
+        (dm, probed) = self.connect()
+        self.assertEqual(dm.deviceRoot, '/mnt/sdcard/tests')
+        self.assertTrue(dm._haveRootShell)
+
+        with open(self.cache.path) as f:
+            entries = json.load(f)
+        self.assertEqual(entries.keys(),
+                         ['emulator-5554 generic/sdk/generic:4.2/JB/1:eng/test-keys'])
+        self.assertTrue(entries.values()[0]['capabilities']['unzip'])
+
+        # the second time round, the device only needs identifying
+        (dm, cached) = self.connect()
+        self.assertEqual(cached, ['version', 'devices',
+                                  'shell getprop ro.serialno; getprop ro.build.fingerprint'])
+        self.assertTrue(len(probed) > len(cached))
+        self.assertEqual(dm.deviceRoot, '/mnt/sdcard/tests')
+        self.assertTrue(dm._haveRootShell)
+
+        # a new build means probing the device again
+        os.environ['FAKE_ADB_FINGERPRINT'] = 'generic/sdk/generic:4.3/JB/2:eng/test-keys'
+        (dm, reprobed) = self.connect()
+        self.assertEqual(reprobed, probed)
+
+    def test_expiry(self):
+        self.cache.put('serial', 'fingerprint', { 'answer': 42 })
+        self.assertEqual(self.cache.get('serial', 'fingerprint'), { 'answer': 42 })
+        self.assertEqual(self.cache.get('serial', 'other'), None)
+        self.cache.ttl = -1
+        self.assertEqual(self.cache.get('serial', 'fingerprint'), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,248 @@
+from mozdevice.adbclient import ADBClient
+import mozdevice
+import os
+import shutil
+import SocketServer
+import StringIO
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+class FakeADBServer(SocketServer.ThreadingTCPServer):
+    """
+    A stand-in for the adb server, with a single device whose file system
+    lives in a temporary directory and whose shell is the host's sh
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, shellV2=True):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), FakeADBHandler)
+        self.shellV2 = shellV2
+        self.root = tempfile.mkdtemp()
+        self.connections = 0
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        shutil.rmtree(self.root)
+
+class FakeADBHandler(SocketServer.BaseRequestHandler):
+
+    def recv(self, length):
+        data = ''
+        while len(data) < length:
+            chunk = self.request.recv(length - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    def reply(self, data):
+        self.request.sendall('OKAY%04x%s' % (len(data), data))
+
+    def fail(self, message):
+        self.request.sendall('FAIL%04x%s' % (len(message), message))
+
+    def localPath(self, path):
+        return os.path.join(self.server.root, path.lstrip('/'))
+
+    def handle(self):
+        self.server.connections += 1
+        try:
+            request = self.recv(int(self.recv(4), 16))
+            if request == 'host:version':
+                self.reply('001f')
+            elif request == 'host:devices':
+                self.reply('emulator-5554\tdevice\n')
+            elif request == 'host-serial:emulator-5554:get-state':
+                self.reply('device')
+            elif request in ('host:transport:emulator-5554', 'host:transport-any'):
+                self.request.sendall('OKAY')
+                self.device(self.recv(int(self.recv(4), 16)))
+            else:
+                self.fail('unknown host service')
+        except EOFError:
+            pass
+
+    def device(self, request):
+        if request.startswith('shell,v2,raw:'):
+            if not self.server.shellV2:
+                self.fail('closed')
+                return
+            self.request.sendall('OKAY')
+            self.recv(5) # close stdin
+            proc = subprocess.Popen(['sh', '-c', request[len('shell,v2,raw:'):]],
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            (out, err) = proc.communicate()
+            for (packetId, data) in [ (1, out), (2, err) ]:
+                if data:
+                    self.request.sendall(struct.pack('<BI', packetId, len(data)) + data)
+            self.request.sendall(struct.pack('<BIB', 3, 1, proc.returncode))
+        elif request.startswith('shell:'):
+            self.request.sendall('OKAY')
+            proc = subprocess.Popen(['sh', '-c', request[len('shell:'):]],
+                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            try:
+                # streamed as it's written, like a real device's output
+                for data in iter(lambda: os.read(proc.stdout.fileno(), 4096), ''):
+                    self.request.sendall(data)
+            finally:
+                if proc.poll() is None:
+                    proc.kill()
+                proc.wait()
+        elif request == 'sync:':
+            self.request.sendall('OKAY')
+            self.sync()
+        else:
+            self.fail('unknown device service')
+
+    def sync(self):
+        while True:
+            (command, length) = struct.unpack('<4sI', self.recv(8))
+            path = self.recv(length)
+            if command == 'STAT':
+                try:
+                    st = os.stat(self.localPath(path))
+                    self.request.sendall('STAT' + struct.pack('<III', st.st_mode, st.st_size,
+                                                              int(st.st_mtime)))
+                except OSError:
+                    self.request.sendall('STAT' + struct.pack('<III', 0, 0, 0))
+            elif command == 'LIST':
+                local = self.localPath(path)
+                names = os.listdir(local) if os.path.isdir(local) else []
+                for name in ['.', '..'] + names:
+                    st = os.stat(os.path.join(local, name))
+                    self.request.sendall('DENT' + struct.pack('<IIII', st.st_mode, st.st_size,
+                                                              int(st.st_mtime), len(name)) + name)
+                self.request.sendall('DONE' + struct.pack('<IIII', 0, 0, 0, 0))
+            elif command == 'SEND':
+                (remotePath, mode) = path.rsplit(',', 1)
+                with open(self.localPath(remotePath), 'wb') as f:
+                    while True:
+                        (packet, length) = struct.unpack('<4sI', self.recv(8))
+                        if packet == 'DONE':
+                            break
+                        f.write(self.recv(length))
+                os.chmod(self.localPath(remotePath), int(mode))
+                self.request.sendall('OKAY' + struct.pack('<I', 0))
+            elif command == 'RECV':
+                try:
+                    f = open(self.localPath(path), 'rb')
+                except IOError:
+                    message = 'No such file or directory'
+                    self.request.sendall('FAIL' + struct.pack('<I', len(message)) + message)
+                    continue
+                for data in iter(lambda: f.read(65536), ''):
+                    self.request.sendall('DATA' + struct.pack('<I', len(data)) + data)
+                f.close()
+                self.request.sendall('DONE' + struct.pack('<I', 0))
+            elif command == 'QUIT':
+                return
+
+class ADBClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeADBServer()
+        self.client = ADBClient('emulator-5554', port=self.server.port)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_host(self):
+        self.assertEqual(self.client.hostCommand('version'), '001f')
+        self.assertEqual(self.client.devices(), [('emulator-5554', 'device')])
+        self.assertEqual(self.client.getState(), 'device')
+        self.assertRaises(mozdevice.DMError, self.client.hostCommand, 'bogus')
+
+    def test_shell(self):
+        for shellV2 in [ True, False ]:
+            self.server.shellV2 = shellV2
+            client = ADBClient(port=self.server.port)
+            for (cmd, expectedOutput, expectedCode) in [
+                ("echo foo; echo bar", "foo\nbar\n", 0),
+                ("echo foo; exit 3", "foo\n", 3),
+                ("echo oops >&2; false", "oops\n", 1),
+                ("printf foo", "foo", 0) ]:
+                output = StringIO.StringIO()
+                self.assertEqual(client.shell(cmd, output), expectedCode)
+                self.assertEqual(output.getvalue(), expectedOutput)
+
+            lines = []
+            self.assertEqual(client.shell("seq 1000", lines.append), 0)
+            self.assertEqual(lines, ["%d\n" % i for i in range(1, 1001)])
+
+    def test_shell_timeout(self):
+        """Tests that a command which keeps sending output still times out"""
+        self.server.shellV2 = False
+        client = ADBClient(port=self.server.port)
+        start = time.time()
+        try:
+            client.shell("while true; do echo more; sleep 0.1; done",
+                         StringIO.StringIO(), timeout=1)
+            self.fail("shell command did not time out")
+        except mozdevice.DMError, e:
+            self.assertTrue(e.timeout)
+        self.assertTrue(time.time() - start < 5)
+
+    def test_verify(self):
+        """Tests that a DeviceManagerADB with the client enabled checks the
+        adb server and the device without running adb"""
+        class UnsetDeviceManagerADB(mozdevice.DeviceManagerADB):
+            def __init__(self):
+                pass
+        dm = UnsetDeviceManagerADB()
+        dm._client = ADBClient('emulator-5554', port=self.server.port)
+        dm._adbPath = os.path.join(self.server.root, 'no-adb-here')
+        dm._deviceSerial = 'emulator-5554'
+        dm._useShellSession = False
+        dm._session = None
+        dm.retryLimit = 1
+        dm.metrics = mozdevice.DeviceMetrics()
+        dm._verifyADB()
+        dm._verifyDevice()
+
+        dm._deviceSerial = 'emulator-5556'
+        self.assertRaises(mozdevice.DMError, dm._verifyDevice)
+        dm._client.close()
+
+    def test_sync(self):
+        data = os.urandom(200 * 1024)
+        local = tempfile.NamedTemporaryFile()
+        local.write(data)
+        local.flush()
+
+        os.mkdir(os.path.join(self.server.root, 'sdcard'))
+        self.client.push(local.name, '/sdcard/foo', 0600)
+        self.assertEqual(self.client.stat('/sdcard/foo')[0] & 0777, 0600)
+        self.assertEqual(self.client.stat('/sdcard/foo')[1], len(data))
+        self.assertEqual(self.client.stat('/sdcard/bar'), None)
+        self.assertTrue(self.client.isDir('/sdcard'))
+        self.assertEqual([entry[0] for entry in self.client.listDir('/sdcard')], ['foo'])
+
+        pulled = StringIO.StringIO()
+        self.client.pull('/sdcard/foo', pulled)
+        self.assertEqual(pulled.getvalue(), data)
+        self.assertRaises(mozdevice.DMError, self.client.pull, '/sdcard/bar',
+                          StringIO.StringIO())
+
+        # the sync connection is reused, apart from after the failure
+        pulled = StringIO.StringIO()
+        self.client.pull('/sdcard/foo', pulled)
+        self.assertEqual(pulled.getvalue(), data)
+        self.assertEqual(self.server.connections, 2)
+
+if __name__ == '__main__':
+    unittest.main()
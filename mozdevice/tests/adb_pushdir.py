@@ -0,0 +1,229 @@
+from mozdevice import DeviceManagerADB, DMError
+from mozdevice import ziparchive
+import filecmp
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+import zipfile
+
+# stands in for adb, with the "device" being the host itself: shell
+# commands run in sh, except for unzip, which is done with zipfile
+FAKE_ADB = """#!%s
+import os, shutil, subprocess, sys, zipfile
+args = sys.argv[1:]
+if args[:1] == ['-s']:
+    args = args[2:]
+if args[0] == 'version':
+    print 'Android Debug Bridge version 1.0.31'
+elif args[0] in ('push', 'pull'):
+    shutil.copyfile(args[1], args[2])
+elif args[1:2] == ['unzip']:
+    if len(args) == 2:
+        print 'Usage: unzip [-o] FILE[.zip] [-d DIR]'
+    else:
+        zipfile.ZipFile(args[3]).extractall(args[5])
+elif args[0] == 'shell':
+    sys.exit(subprocess.call(['sh', '-c', ' '.join(args[1:])]))
+"""
+
+class PushDirTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.adb = os.path.join(self.tempdir, 'adb')
+        with open(self.adb, 'w') as f:
+            f.write(FAKE_ADB % sys.executable)
+        os.chmod(self.adb, stat.S_IRWXU)
+
+        self.localDir = os.path.join(self.tempdir, 'local')
+        for (name, data) in [('a.txt', 'hello ' * 1000),
+                             ('sub/b.xpi', os.urandom(5000)),
+                             ('sub/deeper/c.js', 'var x;\n' * 3000),
+                             ('d.bin', os.urandom(20000))]:
+            path = os.path.join(self.localDir, *name.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(data)
+        os.makedirs(os.path.join(self.localDir, 'empty'))
+        os.symlink(os.path.join(self.localDir, 'a.txt'),
+                   os.path.join(self.localDir, 'link.txt'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_archive(self):
+        files = ziparchive.collectFiles(self.localDir)
+        self.assertEqual([arcname for (path, arcname, size) in files],
+                         ['a.txt', 'd.bin', 'link.txt', 'empty/', 'sub/b.xpi',
+                          'sub/deeper/c.js'])
+
+        shards = ziparchive.splitShards(files, 10000, 3)
+        self.assertEqual(len(shards), 3)
+        self.assertEqual(sorted(sum(shards, [])), sorted(files))
+        self.assertEqual(len(ziparchive.splitShards(files, 10 ** 9, 3)), 1)
+
+        archive = tempfile.TemporaryFile()
+        ziparchive.writeZip(files, archive)
+        infos = dict((info.filename, info) for info in zipfile.ZipFile(archive).infolist())
+        self.assertEqual(infos['sub/b.xpi'].compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(infos['a.txt'].compress_type, zipfile.ZIP_DEFLATED)
+        self.assertTrue('empty/' in infos)
+
+    def test_push_dir(self):
+        remoteDir = os.path.join(self.tempdir, 'device', 'tests')
+        os.makedirs(remoteDir)
+        dm = DeviceManagerADB(adbPath=self.adb, packageName=None, deviceRoot=remoteDir)
+        self.assertTrue(dm._useZip)
+
+        for shardSize in [ 10 ** 9, 8000 ]:
+            dm.push_shard_size = shardSize
+            target = os.path.join(remoteDir, 'pushed-%d' % shardSize)
+            stats = dm.pushDir(self.localDir, target)
+            self.assertEqual(stats['files'], 6)
+            self.assertEqual(stats['shards'], 1 if shardSize > 10 ** 6 else 4)
+            self.assertFalse(filecmp.dircmp(self.localDir, target).diff_files)
+            for name in ['a.txt', 'link.txt', 'sub/b.xpi', 'sub/deeper/c.js', 'd.bin']:
+                self.assertTrue(filecmp.cmp(os.path.join(self.localDir, name),
+                                            os.path.join(target, name), shallow=False))
+            self.assertTrue(os.path.isdir(os.path.join(target, 'empty')))
+            self.assertFalse([name for name in os.listdir(target) if name.endswith('.zip')])
+
+    def test_remote_hashes(self):
+        dm = DeviceManagerADB(adbPath=self.adb, packageName=None, deviceRoot=self.tempdir)
+        names = ['a.txt', 'link.txt', 'sub/b.xpi', 'sub/deeper/c.js', 'd.bin']
+        paths = [os.path.join(self.localDir, *name.split('/')) for name in names]
+        missing = os.path.join(self.localDir, 'missing')
+        expected = dict((path, dm._getLocalHash(path)) for path in paths)
+        expected[missing] = None
+
+        # a tiny limit splits the files over several md5sum commands
+        for limit in [ 4096, 100 ]:
+            dm.hash_cmdline_limit = limit
+            self.assertEqual(dm.getRemoteHashes(paths + [missing]), expected)
+        self.assertTrue(dm._haveMd5sum)
+        self.assertTrue(dm.validateDir(self.localDir, self.localDir))
+        self.assertTrue(dm.validateFile(paths[0], paths[0]))
+        self.assertFalse(dm.validateFile(paths[0], paths[4]))
+
+        with open(paths[4], 'rb') as f:
+            self.assertEqual(''.join(dm.iterFile(paths[4], chunkSize=1000)), f.read())
+
+        # without md5sum, the files get pulled instead
+        dm._haveMd5sum = False
+        self.assertEqual(dm.getRemoteHashes(paths + [missing]), expected)
+
+    def test_remote_hash_batches(self):
+        dm = DeviceManagerADB(adbPath=self.adb, packageName=None, deviceRoot=self.tempdir)
+        paths = [os.path.join(self.localDir, 'a.txt')] * 50
+        commands = []
+        shell = dm.shell
+        def recordingShell(cmd, outputfile, *args, **kwargs):
+            commands.append(cmd)
+            return shell(cmd, outputfile, *args, **kwargs)
+        dm.shell = recordingShell
+
+        dm.hash_cmdline_limit = 10 * len(paths[0])
+        dm.getRemoteHashes(paths)
+        # nine paths fit with the separators and the command name, not ten
+        self.assertEqual([len(cmd) - 1 for cmd in commands], [9] * 5 + [5])
+        for cmd in commands:
+            self.assertTrue(len(' '.join(cmd)) <= dm.hash_cmdline_limit)
+
+    def test_remote_dir_hashes(self):
+        dm = DeviceManagerADB(adbPath=self.adb, packageName=None, deviceRoot=self.tempdir)
+        commands = []
+        shell = dm.shell
+        def recordingShell(cmd, outputfile, *args, **kwargs):
+            commands.append(cmd)
+            return shell(cmd, outputfile, *args, **kwargs)
+        dm.shell = recordingShell
+
+        names = ['a.txt', 'd.bin', 'sub/b.xpi', 'sub/deeper/c.js']
+        self.assertEqual(dm._getRemoteDirHashes(self.localDir),
+                         dict((name, dm._getLocalHash(os.path.join(self.localDir,
+                                                                   *name.split('/'))))
+                              for name in names))
+        # one listing, and one md5sum for all the files
+        self.assertEqual([cmd[0] for cmd in commands], ['ls', 'md5sum'])
+
+    def test_command_latency(self):
+        """Tests that commands run in an adb process of their own are timed"""
+        dm = DeviceManagerADB(adbPath=self.adb, packageName=None, deviceRoot=self.tempdir)
+        dm.metrics.reset()
+        self.assertTrue(dm.dirExists(self.localDir))
+        dm.getProcessList()
+        operations = dm.metrics.summary()['operations']
+        for name in ['ls', 'shell']:
+            self.assertEqual(operations[name]['count'], 1)
+            self.assertEqual(sum(operations[name]['histogram']), 1)
+            self.assertTrue(operations[name]['totalSeconds'] > 0)
+
+    def test_push_validate(self):
+        dm = DeviceManagerADB(adbPath=self.adb, packageName=None, deviceRoot=self.tempdir)
+        dm.push_validate = True
+        target = os.path.join(self.tempdir, 'pushed.bin')
+        dm.pushFile(os.path.join(self.localDir, 'd.bin'), target)
+        self.assertTrue(filecmp.cmp(os.path.join(self.localDir, 'd.bin'), target,
+                                    shallow=False))
+
+    def test_get_directory(self):
+        dm = DeviceManagerADB(adbPath=self.adb, packageName=None, deviceRoot=self.tempdir)
+        target = os.path.join(self.tempdir, 'pulled')
+        journal = os.path.join(target, dm.pull_journal_name)
+        names = ['a.txt', 'd.bin', 'link.txt', 'sub/b.xpi', 'sub/deeper/c.js']
+        # a link to a directory, which isn't followed
+        os.symlink(os.path.join(self.localDir, 'sub'),
+                   os.path.join(self.localDir, 'sublink'))
+
+        # the pull is interrupted by c.js failing
+        runPull = dm._runPull
+        def failingPull(remoteFile, localFile):
+            if remoteFile.endswith('c.js'):
+                raise DMError("connection lost")
+            runPull(remoteFile, localFile)
+        dm._runPull = failingPull
+        dm.retryLimit = 2
+        self.assertRaises(DMError, dm.getDirectory, self.localDir, target)
+        self.assertTrue(os.path.exists(journal))
+        self.assertFalse(os.path.exists(os.path.join(target, 'sub', 'deeper', 'c.js')))
+        self.assertFalse(os.path.exists(os.path.join(target, 'sub', 'deeper', 'c.js.part')))
+
+        # the journal is kept whatever the pull failed with
+        def brokenPull(remoteFile, localFile):
+            if remoteFile.endswith('c.js'):
+                raise IOError("disk full")
+            runPull(remoteFile, localFile)
+        dm._runPull = brokenPull
+        self.assertRaises(IOError, dm.getDirectory, self.localDir, target)
+        self.assertTrue(os.path.exists(journal))
+
+        # and carries on where it stopped, going by the journal alone
+        del dm._runPull
+        dm._haveMd5sum = False
+        stats = dm.getDirectory(self.localDir, target)
+        self.assertEqual((stats['files'], stats['skipped']), (5, 4))
+        self.assertFalse(os.path.exists(journal))
+        for name in names:
+            self.assertTrue(filecmp.cmp(os.path.join(self.localDir, *name.split('/')),
+                                        os.path.join(target, *name.split('/')),
+                                        shallow=False))
+        self.assertTrue(os.path.isdir(os.path.join(target, 'empty')))
+        self.assertFalse(os.path.exists(os.path.join(target, 'sublink')))
+
+        # without a journal, files are compared by size and hash on the device
+        dm._haveMd5sum = None
+        with open(os.path.join(target, 'a.txt'), 'r+b') as f:
+            f.write('jello')
+        os.remove(os.path.join(target, 'd.bin'))
+        dm.pull_workers = 1
+        stats = dm.getDirectory(self.localDir, target)
+        self.assertEqual((stats['skipped'], stats['bytes']), (3, 6000 + 20000))
+        self.assertTrue(filecmp.cmp(os.path.join(self.localDir, 'a.txt'),
+                                    os.path.join(target, 'a.txt'), shallow=False))
+
+if __name__ == '__main__':
+    unittest.main()
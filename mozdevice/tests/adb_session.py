@@ -0,0 +1,57 @@
+from mozdevice.devicemanagerADB import ADBShellSession, ADBShellSessionDied
+import mozdevice
+import sys
+import unittest
+
+class ShellSessionTest(unittest.TestCase):
+    """
+    Runs the session against a local sh standing in for adb shell
+    """
+
+    def test_run(self):
+        session = ADBShellSession(['sh', '-c', 'exec sh'])
+        try:
+            self.assertEqual(session.run('echo foo; echo bar', 10), (0, 'foo\nbar\n'))
+            self.assertEqual(session.run('exit 3', 10), (3, ''))
+            # output without a trailing newline
+            self.assertEqual(session.run('printf baz', 10), (0, 'baz'))
+            # commands don't get to read the session's input
+            self.assertEqual(session.run('cat', 10), (0, ''))
+        finally:
+            session.close()
+
+    def test_echo(self):
+        # like adb shell on a pty, echo every command line back before
+        # running it
+        echo = ("import subprocess, sys\n"
+                "sh = subprocess.Popen(['sh'], stdin=subprocess.PIPE)\n"
+                "for line in iter(sys.stdin.readline, ''):\n"
+                "    sys.stdout.write(line)\n"
+                "    sys.stdout.flush()\n"
+                "    sh.stdin.write(line)\n"
+                "    sh.stdin.flush()\n")
+        session = ADBShellSession([sys.executable, '-c', echo])
+        try:
+            self.assertEqual(session.run('echo foo', 10), (0, 'foo\n'))
+            self.assertEqual(session.run('false', 10), (1, ''))
+        finally:
+            session.close()
+
+    def test_timeout(self):
+        session = ADBShellSession(['sh', '-c', 'exec sh'])
+        try:
+            self.assertRaises(mozdevice.DMError, session.run, 'sleep 5', 0.5)
+            # a new session is started for the next command
+            self.assertEqual(session.run('echo foo', 10), (0, 'foo\n'))
+        finally:
+            session.close()
+
+    def test_died(self):
+        session = ADBShellSession(['sh', '-c', 'exec sh'])
+        try:
+            self.assertRaises(ADBShellSessionDied, session.run, 'kill $$', 10)
+        finally:
+            session.close()
+
+if __name__ == '__main__':
+    unittest.main()
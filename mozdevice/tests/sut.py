@@ -22,6 +22,10 @@ class MockAgent(object):
         self._sock.listen(1)
 
         self.tester = tester
+        # data received from the client but not yet consumed as a command
+        self._buf = ''
+        # payloads received with each push command, in order
+        self.pushed_data = []
 
         self.thread = Thread(target=self._serve_thread)
         self.thread.start()
@@ -30,14 +34,32 @@ class MockAgent(object):
     def port(self):
         return self._sock.getsockname()[1]
 
+    def _recv_command(self, conn):
+        while '\n' not in self._buf:
+            data = conn.recv(1024)
+            if not data:
+                return None
+            self._buf += data
+        line, self._buf = self._buf.split('\n', 1)
+        command = line.strip()
+        # push commands are followed by the file data itself
+        if command.startswith('push '):
+            size = int(command.split()[-1])
+            while len(self._buf) < size:
+                self._buf += conn.recv(65536)
+            self.pushed_data.append(self._buf[:size])
+            self._buf = self._buf[size:]
+        return command
+
     def _serve_thread(self):
         conn = None
         while self.commands:
             if not conn:
                 conn, addr = self._sock.accept()
                 conn.send("$>\x00")
+                self._buf = ''
             (command, response) = self.commands.pop(0)
-            data = conn.recv(1024).strip()
+            data = self._recv_command(conn)
             self.tester.assertEqual(data, command)
             # send response and prompt separately to test for bug 789496
             # FIXME: Improve the mock agent, since overloading the meaning
@@ -52,9 +74,9 @@ class MockAgent(object):
                 # pull is handled specially, as we just pass back the full
                 # command line
                 if "pull" in command:
-                    conn.send(response)
+                    conn.sendall(response)
                 else:
-                    conn.send("%s\n" % response)
+                    conn.sendall("%s\n" % response)
                 conn.send("$>\x00")
 
     def wait(self):
@@ -1,5 +1,6 @@
 from sut import MockAgent
 import mozdevice
+import StringIO
 import unittest
 
 class BasicTest(unittest.TestCase):
@@ -27,9 +28,10 @@ class BasicTest(unittest.TestCase):
 
     def test_timeout_normal(self):
         """Tests DeviceManager timeout, normal case."""
-        a = MockAgent(self, commands = [("isdir /mnt/sdcard/tests", "TRUE"),
-                                        ("cd /mnt/sdcard/tests", ""),
-                                        ("ls", "test.txt"),
+        a = MockAgent(self, commands = [("exec ls -ald /mnt/sdcard/tests/test.txt",
+                                         "-rw-rw-r-- system sdcard_rw 4 2013-01-01 12:00 "
+                                         "/mnt/sdcard/tests/test.txt\n"
+                                         "return code [0]"),
                                         ("rm /mnt/sdcard/tests/test.txt",
                                          "Removed the file")])
         mozdevice.DroidSUT.debug = 4
@@ -40,9 +42,10 @@ class BasicTest(unittest.TestCase):
 
     def test_timeout_timeout(self):
         """Tests DeviceManager timeout, timeout case."""
-        a = MockAgent(self, commands = [("isdir /mnt/sdcard/tests", "TRUE"),
-                                        ("cd /mnt/sdcard/tests", ""),
-                                        ("ls", "test.txt"),
+        a = MockAgent(self, commands = [("exec ls -ald /mnt/sdcard/tests/test.txt",
+                                         "-rw-rw-r-- system sdcard_rw 4 2013-01-01 12:00 "
+                                         "/mnt/sdcard/tests/test.txt\n"
+                                         "return code [0]"),
                                         ("rm /mnt/sdcard/tests/test.txt", 0)])
         mozdevice.DroidSUT.debug = 4
         d = mozdevice.DroidSUT("127.0.0.1", port=a.port)
@@ -72,5 +75,22 @@ class BasicTest(unittest.TestCase):
 
                 a.wait()
 
+    def test_shell_output(self):
+        """Tests streaming shell output to a file and to a line callback"""
+        output = "foo\nbar\n" * 1000
+        for retcode in [ 0, 3 ]:
+            a = MockAgent(self, commands=[("exec foobar",
+                                           output + "return code [%s]" % retcode)] * 2)
+            d = mozdevice.DroidSUT("127.0.0.1", port=a.port)
+
+            buf = StringIO.StringIO()
+            self.assertEqual(d.shell(["foobar"], buf), retcode)
+            self.assertEqual(buf.getvalue(), output)
+
+            lines = []
+            self.assertEqual(d.shell(["foobar"], lines.append), retcode)
+            self.assertEqual(lines, output.splitlines(True))
+            a.wait()
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,127 @@
+from sut import MockAgent
+from mozdevice.dmcli import DMCli
+import errno
+import mozdevice
+import os
+import shutil
+import socket
+import StringIO
+import sys
+import tempfile
+import unittest
+
+class BatchTest(unittest.TestCase):
+
+    def test_batch(self):
+        a = MockAgent(self, commands=[("isdir /mnt/sdcard/tests", "TRUE"),
+                                      ("isdir /mnt/sdcard/nothere", "FALSE")])
+        # the background command is run on a connection of its own
+        background = MockAgent(self, start_commands=[
+                ("exec echo hi", "hi\nreturn code [0]")])
+
+        cli = DMCli()
+        (cli.options, args) = cli.parser.parse_args(["-m", "sut"])
+        cli.dm = mozdevice.DroidSUT("127.0.0.1", port=a.port)
+        cli.dm.port = background.port
+
+        tempdir = tempfile.mkdtemp()
+        script = os.path.join(tempdir, "script")
+        with open(script, "w") as f:
+            f.write("# provisioning\n"
+                    "isdir /mnt/sdcard/tests\n"
+                    "shell echo hi &\n"
+                    "wait\n"
+                    "\n"
+                    "isdir /mnt/sdcard/nothere\n"
+                    "bogus command\n")
+
+        (stdout, stderr) = (sys.stdout, sys.stderr)
+        sys.stdout = StringIO.StringIO()
+        sys.stderr = StringIO.StringIO()
+        try:
+            ret = cli.batch(script)
+            (out, err) = (sys.stdout.getvalue(), sys.stderr.getvalue())
+        finally:
+            (sys.stdout, sys.stderr) = (stdout, stderr)
+        a.wait()
+        background.wait()
+        shutil.rmtree(tempdir)
+
+        self.assertEqual(ret, 1)
+        self.assertEqual(out, "TRUE\n[3] hi\nFALSE\n")
+        report = err.splitlines()
+        self.assertEqual(len(report), 5)
+        self.assertTrue(report[0].startswith("[2] isdir /mnt/sdcard/tests: exit status 0 ("))
+        self.assertTrue(report[1].startswith("[3] shell echo hi: exit status 0 ("))
+        self.assertTrue(report[2].startswith("[6] isdir /mnt/sdcard/nothere: exit status %d (" %
+                                             errno.ENOTDIR))
+        self.assertTrue(report[3].startswith("[7] bogus command: exit status error: "
+                                             "invalid command bogus"))
+        self.assertTrue(report[4].startswith("2 commands failed"))
+
+    def test_batch_errors(self):
+        """Tests that any error is reported as a failed command, whether it
+        comes from the command or from getting a connection for it"""
+        class BrokenDevice(object):
+            def dirExists(self, path):
+                raise ValueError("bad path %s" % path)
+            def connection(self):
+                raise socket.error("connection refused")
+
+        cli = DMCli()
+        (cli.options, args) = cli.parser.parse_args(["-m", "sut"])
+        cli.dm = BrokenDevice()
+
+        tempdir = tempfile.mkdtemp()
+        script = os.path.join(tempdir, "script")
+        with open(script, "w") as f:
+            f.write("isdir /mnt/sdcard/tests\n"
+                    "isdir /mnt/sdcard/tests &\n")
+
+        (stdout, stderr) = (sys.stdout, sys.stderr)
+        sys.stdout = StringIO.StringIO()
+        sys.stderr = StringIO.StringIO()
+        try:
+            ret = cli.batch(script)
+            (out, err) = (sys.stdout.getvalue(), sys.stderr.getvalue())
+        finally:
+            (sys.stdout, sys.stderr) = (stdout, stderr)
+        shutil.rmtree(tempdir)
+
+        self.assertEqual(ret, 1)
+        self.assertEqual(out, "error: bad path /mnt/sdcard/tests\n"
+                              "[2] error: connection refused\n")
+        report = err.splitlines()
+        self.assertTrue(report[0].startswith("[1] isdir /mnt/sdcard/tests: exit status 1 ("))
+        self.assertTrue(report[1].startswith("[2] isdir /mnt/sdcard/tests: exit status 1 ("))
+        self.assertTrue(report[2].startswith("2 commands failed"))
+
+    def test_pool_size(self):
+        """Tests that only batch gets a pool of connections"""
+        cli = DMCli()
+        (cli.options, args) = cli.parser.parse_args(["-m", "sut", "--jobs", "3"])
+        for (command, size) in [("isdir", 1), ("batch", 3)]:
+            a = MockAgent(self)
+            d = cli.getDevice(dmtype="sut", host="127.0.0.1", port=a.port,
+                              poolSize=cli._poolSize(command))
+            a.wait()
+            self.assertEqual(d.poolSize, size)
+
+    def test_usage(self):
+        """Tests that commands which don't need a device still have their
+        arguments checked"""
+        for args in [["stats", "json", "extra"], ["discover", "scan", "5", "extra"]]:
+            stderr = sys.stderr
+            sys.stderr = StringIO.StringIO()
+            try:
+                try:
+                    DMCli().run(args)
+                    self.fail("no usage error for %s" % args)
+                except SystemExit, e:
+                    self.assertEqual(e.code, 2)
+                self.assertTrue("Wrong number of arguments" in sys.stderr.getvalue())
+            finally:
+                sys.stderr = stderr
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+from sut import MockAgent
+import mozdevice
+import unittest
+import time
+
+class DevicePoolTest(unittest.TestCase):
+
+    def test_call(self):
+        agents = dict((name, MockAgent(self, commands = [("isdir /mnt/sdcard", "TRUE")]))
+                      for name in ['a', 'b', 'c'])
+        (pool, failures) = mozdevice.DevicePool.connect(
+            agents.keys(),
+            lambda name: mozdevice.DroidSUT("127.0.0.1", port=agents[name].port))
+        self.assertEqual(failures, {})
+
+        results = pool.call('dirExists', '/mnt/sdcard')
+        for a in agents.values():
+            a.wait()
+        self.assertEqual(sorted(results.keys()), ['a', 'b', 'c'])
+        for result in results.values():
+            self.assertTrue(result.ok)
+            self.assertEqual(result.value, True)
+        self.assertEqual(pool.failures(results), [])
+
+    def test_failures(self):
+        agents = { 'ok': MockAgent(self, commands = [("isdir /mnt/sdcard", "TRUE")]),
+                   'error': MockAgent(self, commands = [("isdir /mnt/sdcard", "")]),
+                   'wedged': MockAgent(self, commands = [("isdir /mnt/sdcard", 3)]) }
+        pool = mozdevice.DevicePool(dict((name, mozdevice.DroidSUT("127.0.0.1",
+                                                                  port=a.port))
+                                         for (name, a) in agents.iteritems()),
+                                    timeout=1)
+
+        start = time.time()
+        results = pool.call('dirExists', '/mnt/sdcard')
+        # the wedged device mustn't hold up the rest of the pool
+        self.assertTrue(time.time() - start < 2)
+
+        self.assertTrue(results['ok'].ok)
+        self.assertTrue(isinstance(results['error'].error, mozdevice.DMError))
+        self.assertTrue(results['wedged'].timedOut)
+        self.assertEqual([r.name for r in pool.failures(results)], ['error', 'wedged'])
+        for a in agents.values():
+            a.wait()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+from sut import MockAgent
+from zeroconf_burst import announcement
+from mozdevice.Zeroconf import Zeroconf, _MDNS_PORT
+import mozdevice
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+
+class DiscoveryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'devices.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_registry(self):
+        registry = mozdevice.DeviceRegistry(self.path)
+        registry.put('015d2bc2825ff206', 'sut', '10.242.29.221', 20701)
+        registry.put('emulator-5554', 'adb')
+
+        # shared through the file
+        entry = mozdevice.DeviceRegistry(self.path).get('015d2bc2825ff206')
+        self.assertEqual((entry['transport'], entry['ip'], entry['port']),
+                         ('sut', '10.242.29.221', 20701))
+        self.assertEqual(sorted(registry.entries().keys()),
+                         ['015d2bc2825ff206', 'emulator-5554'])
+
+        registry.remove('emulator-5554')
+        self.assertEqual(registry.get('emulator-5554'), None)
+
+        stale = mozdevice.DeviceRegistry(self.path, ttl=0.5)
+        time.sleep(1)
+        self.assertEqual(stale.get('015d2bc2825ff206'), None)
+
+    def test_connect(self):
+        """Tests that a registered device is connected to without browsing"""
+        registry = mozdevice.DeviceRegistry(self.path)
+        a = MockAgent(self)
+        registry.put('015d2bc2825ff206', 'sut', '127.0.0.1', a.port)
+
+        start = time.time()
+        d = mozdevice.DroidConnectByHWID('015d2bc2825ff206', registry=registry)
+        a.wait()
+        self.assertTrue(isinstance(d, mozdevice.DroidSUT))
+        self.assertEqual(d.port, a.port)
+        self.assertEqual(d.retryLimit, 5)
+        self.assertTrue(time.time() - start < 5)
+
+    def test_unreachable(self):
+        """Tests that a device which has gone away is forgotten, and looked
+        for on the network instead"""
+        registry = mozdevice.DeviceRegistry(self.path)
+        # a port nothing is listening on
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        registry.put('015d2bc2825ff206', 'sut', '127.0.0.1', port)
+
+        # without retrying the registered address
+        start = time.time()
+        self.assertEqual(mozdevice.DroidConnectByHWID('015d2bc2825ff206',
+                                                      timeout=1,
+                                                      registry=registry), None)
+        self.assertTrue(time.time() - start < 10)
+        self.assertEqual(registry.get('015d2bc2825ff206'), None)
+
+    def test_no_registry(self):
+        """Tests that no registry is written unless one is given"""
+        home = os.environ.get('HOME')
+        os.environ['HOME'] = self.tempdir
+        try:
+            self.assertEqual(mozdevice.DroidConnectByHWID('015d2bc2825ff206',
+                                                          timeout=0.5), None)
+        finally:
+            if home is None:
+                del os.environ['HOME']
+            else:
+                os.environ['HOME'] = home
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+    def test_service(self):
+        registry = mozdevice.DeviceRegistry(self.path)
+        service = mozdevice.DiscoveryService(registry, bindaddress='127.0.0.1',
+                                             pollAdb=False)
+        service.start()
+        try:
+            (name, packet) = announcement(3)
+            service.zeroconf.handlePacket(packet, '10.0.0.4', _MDNS_PORT)
+            for i in range(50):
+                if registry.get('0000000000000003'):
+                    break
+                time.sleep(0.1)
+        finally:
+            service.stop()
+        entry = registry.get('0000000000000003')
+        self.assertEqual((entry['transport'], entry['ip'], entry['port']),
+                         ('sut', '10.0.0.4', 20701))
+
+    def test_service_outlives_other_zeroconf(self):
+        """Tests that the service keeps running when another Zeroconf in
+        the same process, e.g. that of a browse, is closed"""
+        registry = mozdevice.DeviceRegistry(self.path)
+        service = mozdevice.DiscoveryService(registry, bindaddress='127.0.0.1',
+                                             pollAdb=False)
+        service.start()
+        try:
+            Zeroconf('127.0.0.1').close()
+            self.assertTrue(service.zeroconf.engine.is_alive())
+            (name, packet) = announcement(5)
+            service.zeroconf.handlePacket(packet, '10.0.0.6', _MDNS_PORT)
+            for i in range(50):
+                if registry.get('0000000000000005'):
+                    break
+                time.sleep(0.1)
+            self.assertTrue(service.zeroconf.engine.is_alive())
+        finally:
+            service.stop()
+        self.assertEqual(registry.get('0000000000000005')['ip'], '10.0.0.6')
+
+    def test_discover_all(self):
+        """Tests that a single browse finds every agent"""
+        registry = mozdevice.DeviceRegistry(self.path)
+        zc = Zeroconf('127.0.0.1')
+        try:
+            for i in range(5):
+                zc.handlePacket(announcement(i)[1], '10.0.0.1', _MDNS_PORT)
+
+            start = time.time()
+            agents = mozdevice.DroidDiscoverAll(timeout=10, count=5,
+                                                registry=registry, zeroconf=zc)
+            self.assertTrue(time.time() - start < 5)
+        finally:
+            zc.close()
+        self.assertEqual(sorted(agents.keys()),
+                         ['%016x' % i for i in range(5)])
+        self.assertEqual((agents['0000000000000002']['ip'],
+                          agents['0000000000000002']['port']),
+                         ('10.0.0.3', 20701))
+        self.assertEqual(registry.get('0000000000000004')['ip'], '10.0.0.5')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+from sut import MockAgent
+from mozdevice.devicemanager import DeviceManager
+import hashlib
+import mozdevice
+import threading
+import unittest
+
+class FakeDevice(DeviceManager):
+    iter_queue_size = 2
+
+    def __init__(self):
+        pass
+
+class IterTest(unittest.TestCase):
+
+    def test_bounded(self):
+        """Tests that transfers wait for their data to be consumed"""
+        dm = FakeDevice()
+        produced = []
+        finished = threading.Event()
+        def transfer(dm, put):
+            for i in range(10):
+                produced.append(i)
+                put(i)
+            finished.set()
+
+        pieces = dm._iterTransfer(transfer)
+        self.assertEqual(pieces.next(), 0)
+        self.assertFalse(finished.wait(0.2))
+        # one piece consumed, two queued and one waiting to be queued
+        self.assertEqual(len(produced), 4)
+        self.assertEqual(list(pieces), range(1, 10))
+
+        # closed early, the rest of the transfer is discarded
+        produced = []
+        finished.clear()
+        pieces = dm._iterTransfer(transfer)
+        self.assertEqual(pieces.next(), 0)
+        pieces.close()
+        self.assertTrue(finished.is_set())
+        self.assertEqual(len(produced), 10)
+
+    def test_error(self):
+        def transfer(dm, put):
+            put('partial')
+            raise mozdevice.DMError('transfer failed')
+
+        pieces = FakeDevice()._iterTransfer(transfer)
+        self.assertEqual(pieces.next(), 'partial')
+        self.assertRaises(mozdevice.DMError, pieces.next)
+
+    def test_shell_output(self):
+        """Tests iterating over shell output on a connection of its own"""
+        a = MockAgent(self)
+        d = mozdevice.DroidSUT("127.0.0.1", port=a.port)
+        a.wait()
+
+        for (retcode, expectException) in [ (0, False), (3, True) ]:
+            shell = MockAgent(self, start_commands=[
+                    ("exec foobar", "foo\nbar\nreturn code [%s]" % retcode)])
+            d.port = shell.port
+            lines = []
+            try:
+                for line in d.iterShellOutput(["foobar"]):
+                    lines.append(line)
+                exceptionThrown = False
+            except mozdevice.DMError:
+                exceptionThrown = True
+            shell.wait()
+            self.assertEqual(lines, ["foo\n", "bar\n"])
+            self.assertEqual(exceptionThrown, expectException)
+
+    def test_file(self):
+        a = MockAgent(self)
+        d = mozdevice.DroidSUT("127.0.0.1", port=a.port)
+        a.wait()
+
+        data = "cheeseburgers" * 1000
+        remoteName = "/mnt/sdcard/cheeseburgers"
+        for (remoteHash, expectException) in [ (hashlib.md5(data).hexdigest(), False),
+                                               ("BADHASH", True) ]:
+            pull = MockAgent(self, start_commands=[
+                    ("pull %s" % remoteName,
+                     "%s,%s\n%s" % (remoteName, len(data), data)),
+                    ("hash %s" % remoteName, remoteHash)])
+            d.port = pull.port
+            chunks = []
+            try:
+                for chunk in d.iterFile(remoteName, chunkSize=1000):
+                    chunks.append(chunk)
+                exceptionThrown = False
+            except mozdevice.DMError:
+                exceptionThrown = True
+            pull.wait()
+            self.assertTrue(max(len(chunk) for chunk in chunks) <= 1000)
+            self.assertEqual(''.join(chunks), data)
+            self.assertEqual(exceptionThrown, expectException)
+
+    def test_logcat(self):
+        a = MockAgent(self)
+        d = mozdevice.DroidSUT("127.0.0.1", port=a.port)
+        a.wait()
+
+        logcat = MockAgent(self, start_commands=[
+                ("execsu /system/bin/logcat -v time -d dalvikvm:S",
+                 "I/one\r\nI/spam\r\n\r\nI/two\r\nreturn code [0]")])
+        d.port = logcat.port
+        self.assertEqual(list(d.iterLogcat(filterSpecs=["dalvikvm:S"],
+                                           filterOutRegexps=["spam"])),
+                         ["I/one\n", "I/two\n"])
+        logcat.wait()
+
+if __name__ == '__main__':
+    unittest.main()
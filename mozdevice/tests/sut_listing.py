@@ -0,0 +1,102 @@
+from sut import MockAgent
+import mozdevice
+import unittest
+import hashlib
+import tempfile
+import os
+import shutil
+
+# toolbox style ls -alR output for /mnt/sdcard/tests
+listing = "\n".join([
+    "-rw-rw-r-- system sdcard_rw 4 2013-01-01 12:00 a.txt",
+    "drwxrwxr-x system sdcard_rw 2013-01-01 12:00 sub",
+    "lrwxrwxrwx root root 2013-01-01 12:00 lnk -> /mnt/sdcard/tests/a.txt",
+    "",
+    "/mnt/sdcard/tests/sub:",
+    "-rw-rw-r-- system sdcard_rw 11 2013-01-02 08:30 b c.txt",
+    "return code [0]"])
+
+class ListingTest(unittest.TestCase):
+
+    def test_list_dir_detailed(self):
+        a = MockAgent(self, commands = [("exec ls -alR /mnt/sdcard/tests", listing)])
+        d = mozdevice.DroidSUT("127.0.0.1", port=a.port)
+        entries = d.listDirDetailed("/mnt/sdcard/tests/")
+        a.wait()
+
+        self.assertEqual([e[:3] for e in entries],
+                         [("/mnt/sdcard/tests/a.txt", 'f', 4),
+                          ("/mnt/sdcard/tests/sub", 'd', None),
+                          ("/mnt/sdcard/tests/lnk", 'l', None),
+                          ("/mnt/sdcard/tests/sub/b c.txt", 'f', 11)])
+        self.assertTrue(entries[3][3] > entries[0][3])
+
+    def test_list_dir_busybox(self):
+        output = "\n".join([
+            "/mnt/sdcard/tests:",
+            "total 8",
+            "drwxr-xr-x    3 root     root          4096 Jan  1  2012 .",
+            "drwxr-xr-x    3 root     root          4096 Jan  1  2012 ..",
+            "-rw-r--r--    1 root     root          1234 Feb 10 12:00 a.txt",
+            "drwxr-xr-x    2 root     root          4096 Jan  1  2012 sub",
+            "",
+            "/mnt/sdcard/tests/sub:",
+            "total 0",
+            "return code [0]"])
+        a = MockAgent(self, commands = [("exec ls -alR /mnt/sdcard/tests", output)])
+        d = mozdevice.DroidSUT("127.0.0.1", port=a.port)
+        entries = d.listDirDetailed("/mnt/sdcard/tests")
+        a.wait()
+
+        self.assertEqual([e[:3] for e in entries],
+                         [("/mnt/sdcard/tests/a.txt", 'f', 1234),
+                          ("/mnt/sdcard/tests/sub", 'd', None)])
+
+    def test_walk(self):
+        a = MockAgent(self, commands = [("exec ls -alR /mnt/sdcard/tests", listing)])
+        d = mozdevice.DroidSUT("127.0.0.1", port=a.port)
+        self.assertEqual(list(d.walk("/mnt/sdcard/tests")),
+                         [("/mnt/sdcard/tests", ["sub"], ["a.txt", "lnk"]),
+                          ("/mnt/sdcard/tests/sub", [], ["b c.txt"])])
+        a.wait()
+
+    def test_file_exists(self):
+        for (output, expected) in [
+            ("-rw-rw-r-- system sdcard_rw 4 2013-01-01 12:00 /mnt/sdcard/tests/a.txt", True),
+            ("drwxrwxr-x system sdcard_rw 2013-01-01 12:00 /mnt/sdcard/tests/a.txt", False),
+            ("/mnt/sdcard/tests/a.txt: No such file or directory", False) ]:
+            a = MockAgent(self, commands = [("exec ls -ald /mnt/sdcard/tests/a.txt",
+                                             output + "\nreturn code [0]")])
+            d = mozdevice.DroidSUT("127.0.0.1", port=a.port)
+            self.assertEqual(d.fileExists("/mnt/sdcard/tests/a.txt"), expected)
+            a.wait()
+
+    def test_get_directory(self):
+        def pull(name, data):
+            mdsum = hashlib.md5()
+            mdsum.update(data)
+            return [("pull %s" % name, "%s,%s\n%s" % (name, len(data), data)),
+                    ("hash %s" % name, mdsum.hexdigest())]
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            a = MockAgent(self, commands = [("isdir /mnt/sdcard/tests", "TRUE"),
+                                            ("exec ls -alR /mnt/sdcard/tests", listing)] +
+                          [pull("/mnt/sdcard/tests/a.txt", "aaaa")[0],
+                           pull("/mnt/sdcard/tests/lnk", "aaaa")[0],
+                           pull("/mnt/sdcard/tests/sub/b c.txt", "hello world")[0],
+                           pull("/mnt/sdcard/tests/a.txt", "aaaa")[1],
+                           pull("/mnt/sdcard/tests/lnk", "aaaa")[1],
+                           pull("/mnt/sdcard/tests/sub/b c.txt", "hello world")[1]])
+            d = mozdevice.DroidSUT("127.0.0.1", port=a.port)
+            d.getDirectory("/mnt/sdcard/tests", tempdir)
+            a.wait()
+
+            with open(os.path.join(tempdir, "sub", "b c.txt")) as f:
+                self.assertEqual(f.read(), "hello world")
+            self.assertTrue(os.path.exists(os.path.join(tempdir, "lnk")))
+        finally:
+            shutil.rmtree(tempdir)
+
+if __name__ == '__main__':
+    unittest.main()
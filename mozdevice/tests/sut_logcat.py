@@ -0,0 +1,76 @@
+from sut import MockAgent
+from mozdevice.logcat import LogcatStreamer
+import mozdevice
+import time
+import unittest
+
+class FakeDevice(object):
+    """
+    Stands in for a device manager, handing the streamer lines on demand
+    """
+    _logcatNeedsRoot = False
+
+    def _streamShell(self, cmd, lineCallback, root=False):
+        self.cmd = cmd
+        self.feed = lineCallback
+        self.stopped = False
+        def stop():
+            self.stopped = True
+        return stop
+
+class LogcatTest(unittest.TestCase):
+
+    def test_streamer(self):
+        dm = FakeDevice()
+        streamer = LogcatStreamer(dm, filterSpecs=["dalvikvm:S"],
+                                  filterOutRegexps=["spam", "^D/"], maxLines=3)
+        streamer.start()
+        self.assertEqual(dm.cmd, ["/system/bin/logcat", "-v", "time", "dalvikvm:S"])
+        self.assertTrue(streamer.running)
+
+        for line in ["I/one\r\n", "D/debug\r\n", "I/spam\r\n", "I/two\r\n"]:
+            dm.feed(line)
+        self.assertEqual(streamer.linesSince(0), ["I/one\n", "I/two\n"])
+
+        marker = streamer.mark()
+        dm.feed("I/three\n")
+        dm.feed("W/four\n")
+        self.assertEqual(streamer.linesSince(marker), ["I/three\n", "W/four\n"])
+        self.assertEqual(streamer.linesSince(marker, ["^W/"]), ["I/three\n"])
+
+        # the oldest lines make way for new ones
+        self.assertEqual(streamer.linesSince(0), ["I/two\n", "I/three\n", "W/four\n"])
+        self.assertEqual(streamer.dropped, 1)
+
+        dm.feed(None)
+        self.assertFalse(streamer.running)
+        streamer.stop()
+        self.assertTrue(dm.stopped)
+
+    def test_record_sut(self):
+        """Tests capturing logcat over a connection of its own"""
+        a = MockAgent(self, commands=[("execsu /system/bin/logcat -c",
+                                       "return code [0]")])
+        d = mozdevice.DroidSUT("127.0.0.1", port=a.port)
+
+        # the capture's connection goes to another agent, which stands in
+        # for a second connection to the same device
+        logcat = MockAgent(self, start_commands=[
+                ("execsu /system/bin/logcat -v time dalvikvm:S",
+                 "I/one\nI/spam\nI/two\nreturn code [0]")])
+        d.port = logcat.port
+        streamer = d.recordLogcat(filterSpecs=["dalvikvm:S"],
+                                  filterOutRegexps=["spam"])
+        a.wait()
+        logcat.wait()
+        for i in range(100):
+            if not streamer.running:
+                break
+            time.sleep(0.1)
+        self.assertFalse(streamer.running)
+        self.assertEqual(d.getLogcat(filterSpecs=["dalvikvm:S"]), ["I/one\n", "I/two\n"])
+        d.stopLogcat()
+        self.assertEqual(streamer.linesSince(0), ["I/one\n", "I/two\n"])
+
+if __name__ == '__main__':
+    unittest.main()
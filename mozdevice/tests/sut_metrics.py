@@ -0,0 +1,78 @@
+from sut import MockAgent
+import hashlib
+import mozdevice
+import os
+import shutil
+import tempfile
+import unittest
+
+class MetricsTest(unittest.TestCase):
+
+    def test_commands(self):
+        pushfile = "1234ABCD"
+        pushHash = hashlib.md5(pushfile).hexdigest()
+        remoteName = "/mnt/sdcard/cheeseburgers"
+        a = MockAgent(self, commands=[
+                ("isdir /mnt/sdcard", "TRUE"),
+                ("push /mnt/sdcard/foobar %s" % len(pushfile), pushHash),
+                ("pull %s" % remoteName, "%s,13\ncheeseburgers" % remoteName),
+                ("hash /mnt/sdcard/a", "hash-a"),
+                ("hash /mnt/sdcard/b", "hash-b")])
+        d = mozdevice.DroidSUT("127.0.0.1", port=a.port)
+        events = []
+        d.metrics.addHook(lambda event, operation, details: events.append((event, operation)))
+
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(pushfile)
+            f.flush()
+            d.pushFile(f.name, '/mnt/sdcard/foobar')
+        self.assertEqual(d.pullFile(remoteName), "cheeseburgers")
+        d.getRemoteHashes(["/mnt/sdcard/a", "/mnt/sdcard/b"])
+        a.wait()
+
+        operations = d.metrics.summary()['operations']
+        # the connection's start commands are counted too
+        self.assertEqual(operations['isdir']['count'], 2)
+        self.assertEqual(operations['push']['count'], 1)
+        self.assertEqual(operations['push']['bytesSent'],
+                         len("push /mnt/sdcard/foobar 8\r\n") + len(pushfile))
+        self.assertEqual(operations['pull']['count'], 1)
+        self.assertTrue(operations['pull']['bytesReceived'] >= 13)
+        self.assertEqual(operations['hash']['count'], 2)
+        self.assertEqual(sum(operations['hash']['histogram']), 2)
+        self.assertEqual(events[-2:], [('command', 'hash'), ('command', 'hash')])
+
+    def test_timeouts(self):
+        metrics = mozdevice.DeviceMetrics()
+        for error in [ mozdevice.DMError("timed out", timeout=True),
+                       mozdevice.DMError("failed") ]:
+            try:
+                with metrics.measure('shell'):
+                    raise error
+            except mozdevice.DMError:
+                pass
+        metrics.countRetry('shell')
+        metrics.countReconnect()
+        stats = metrics.summary()['operations']['shell']
+        self.assertEqual((stats['count'], stats['failures'], stats['timeouts'],
+                          stats['retries']), (2, 2, 1, 1))
+        self.assertEqual(metrics.summary()['reconnects'], 1)
+
+    def test_save(self):
+        tempdir = tempfile.mkdtemp()
+        path = os.path.join(tempdir, 'stats.json')
+        metrics = mozdevice.DeviceMetrics()
+        metrics.record('push', 0.003, bytesSent=100)
+        metrics.record('push', 20, bytesSent=50)
+        metrics.save(path, merge=True)
+        metrics.save(path, merge=True)
+
+        stats = mozdevice.DeviceMetrics.load(path)['operations']['push']
+        self.assertEqual(stats['count'], 4)
+        self.assertEqual(stats['bytesSent'], 300)
+        self.assertEqual(stats['maxSeconds'], 20)
+        self.assertEqual(sum(stats['histogram']), 4)
+        shutil.rmtree(tempdir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+# Any copyright is dedicated to the Public Domain.
+# http://creativecommons.org/publicdomain/zero/1.0/
+
+import hashlib
+import mozdevice
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+from sut import MockAgent
+
+class HashingAgent(object):
+    """
+    Agent that serves any number of connections at once, answering isdir
+    with TRUE and push with the md5 of the data pushed
+    """
+
+    def __init__(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.bind(("127.0.0.1", 0))
+        self._sock.listen(5)
+        self.connections = 0
+        self.pushed = {}
+        self._lock = threading.Lock()
+        t = threading.Thread(target=self._accept_thread)
+        t.daemon = True
+        t.start()
+
+    @property
+    def port(self):
+        return self._sock.getsockname()[1]
+
+    def _accept_thread(self):
+        while True:
+            conn, addr = self._sock.accept()
+            with self._lock:
+                self.connections += 1
+            t = threading.Thread(target=self._serve_thread, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def _serve_thread(self, conn):
+        conn.sendall("$>\x00")
+        buf = ''
+        while True:
+            while '\n' not in buf:
+                data = conn.recv(1024)
+                if not data:
+                    return
+                buf += data
+            line, buf = buf.split('\n', 1)
+            command = line.strip().split()
+            if command[0] == 'push':
+                size = int(command[2])
+                while len(buf) < size:
+                    buf += conn.recv(65536)
+                with self._lock:
+                    self.pushed[command[1]] = buf[:size]
+                response = hashlib.md5(buf[:size]).hexdigest()
+                buf = buf[size:]
+            elif command[0] == 'isdir':
+                response = 'TRUE'
+            elif command[0] == 'testroot':
+                response = '/mnt/sdcard'
+            elif command[0] == 'ver':
+                response = 'SUTAgentAndroid Version 1.14'
+            conn.sendall("%s\n$>\x00" % response)
+
+class PoolTest(unittest.TestCase):
+
+    def test_checkout(self):
+        a = MockAgent(self)
+        d = mozdevice.DroidSUT("127.0.0.1", port=a.port, poolSize=2)
+        a.wait()
+
+        with d.connection() as c1:
+            with d.connection() as c2:
+                self.assertNotEqual(c1, c2)
+                self.assertNotEqual(c1, d)
+                # the pool is exhausted
+                exceptionThrown = False
+                try:
+                    with d.connection(timeout=0.1):
+                        pass
+                except mozdevice.DMError:
+                    exceptionThrown = True
+                self.assertTrue(exceptionThrown)
+
+        # connections are reused once checked back in
+        with d.connection() as c3:
+            self.assertTrue(c3 in (c1, c2))
+
+    def test_parallel_push_dir(self):
+        tempdir = tempfile.mkdtemp()
+        contents = {}
+        for i in range(200):
+            name = "file%d" % i
+            contents[name] = os.urandom(100 + i)
+            with open(os.path.join(tempdir, name), 'wb') as f:
+                f.write(contents[name])
+
+        a = HashingAgent()
+        d = mozdevice.DroidSUT("127.0.0.1", port=a.port, poolSize=4)
+        d.pipeline_depth = 10
+        d.pushDir(tempdir, "/mnt/sdcard/tests")
+        shutil.rmtree(tempdir)
+
+        # the main connection is one of the poolSize
+        self.assertEqual(a.connections, 4)
+        self.assertEqual(a.pushed, dict(("/mnt/sdcard/tests/" + name, data)
+                                        for (name, data) in contents.iteritems()))
+
+        pooled = list(d._pool._idle)
+        self.assertEqual(len(pooled), 3)
+        d.close()
+        self.assertEqual([conn._sock for conn in pooled + [d]], [None] * 4)
+
+    def test_close_checked_out(self):
+        """Tests that connections checked out when the pool is closed are
+        closed once they are checked back in"""
+        a = HashingAgent()
+        d = mozdevice.DroidSUT("127.0.0.1", port=a.port, poolSize=2)
+        with d.connection() as c1:
+            c1.dirExists("/mnt/sdcard")
+            with d.connection() as c2:
+                c2.dirExists("/mnt/sdcard")
+            d.close()
+            self.assertEqual(c2._sock, None)
+            self.assertNotEqual(c1._sock, None)
+        self.assertEqual(c1._sock, None)
+
+        # the pool can still be used, and keeps its connections open again
+        with d.connection() as c3:
+            c3.dirExists("/mnt/sdcard")
+        self.assertNotEqual(c3._sock, None)
+
+if __name__ == '__main__':
+    unittest.main()
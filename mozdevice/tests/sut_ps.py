@@ -45,5 +45,32 @@ class PsTest(unittest.TestCase):
             self.assertEqual(d.processExist(i[0]), i[1])
             a.wait()
 
+    def test_processTable(self):
+        a = MockAgent(self, commands=self.pscommands + [
+                ('ps', "10029\t549\tcom.android.launcher\n"
+                 "10070\t1300\t/system/bin/sh")])
+        d = mozdevice.DroidSUT("127.0.0.1", port=a.port)
+        table = d.getProcessTable()
+        self.assertEqual(table.pids('com.twitter.android'), [1198])
+        self.assertEqual(table.get(549), (549, 'com.android.launcher', 10029))
+        # a recent snapshot is reused
+        self.assertTrue(d.getProcessTable() is table)
+        self.assertEqual(d.processExist('com.twitter.android'), 1198)
+
+        newer = d.getProcessTable(maxAge=0)
+        self.assertTrue('sh' in newer)
+        self.assertEqual(newer.diff(table),
+                         ([(1300, '/system/bin/sh', 10070)],
+                          [(1198, 'com.twitter.android', 10066)]))
+        a.wait()
+
+    def test_waitForProcess(self):
+        a = MockAgent(self, commands=[('ps', "10029\t549\tcom.android.launcher")] * 2 +
+                      self.pscommands + [('ps', "10029\t549\tcom.android.launcher")])
+        d = mozdevice.DroidSUT("127.0.0.1", port=a.port)
+        self.assertTrue(d.waitForProcess('com.twitter.android', 'running', 10))
+        self.assertTrue(d.waitForProcess('com.twitter.android', 'stopped', 10))
+        a.wait()
+
 if __name__ == '__main__':
     unittest.main()
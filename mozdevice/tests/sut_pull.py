@@ -4,6 +4,7 @@ import unittest
 import hashlib
 import tempfile
 import os
+import StringIO
 
 class PullTest(unittest.TestCase):
 
@@ -43,6 +44,50 @@ class PullTest(unittest.TestCase):
             exceptionThrown = True
         self.assertTrue(exceptionThrown)
 
+    def test_get_file(self):
+        remoteName = "/mnt/sdcard/cheeseburgers"
+        cheeseburgers = "cheeseburgers" * 20000
+        mdsum = hashlib.md5()
+        mdsum.update(cheeseburgers)
+
+        # (hash returned by the agent, expect exception)
+        for (remoteHash, expectException) in [ (mdsum.hexdigest(), False),
+                                               ("BADHASH", True) ]:
+            a = MockAgent(self, commands = [("pull %s" % remoteName,
+                                             "%s,%s\n%s" % (remoteName,
+                                                            len(cheeseburgers),
+                                                            cheeseburgers)),
+                                            ("hash %s" % remoteName,
+                                             remoteHash)])
+            d = mozdevice.DroidSUT("127.0.0.1", port=a.port)
+            with tempfile.NamedTemporaryFile() as f:
+                exceptionThrown = False
+                try:
+                    d.getFile(remoteName, f.name)
+                except mozdevice.DMError:
+                    exceptionThrown = True
+                self.assertEqual(exceptionThrown, expectException)
+                self.assertEqual(open(f.name).read(), cheeseburgers)
+            a.wait()
+
+    def test_get_file_object(self):
+        remoteName = "/mnt/sdcard/cheeseburgers"
+        cheeseburgers = "cheeseburgers"
+        mdsum = hashlib.md5()
+        mdsum.update(cheeseburgers)
+
+        a = MockAgent(self, commands = [("pull %s" % remoteName,
+                                         "%s,%s\n%s" % (remoteName,
+                                                        len(cheeseburgers),
+                                                        cheeseburgers)),
+                                        ("hash %s" % remoteName,
+                                         mdsum.hexdigest())])
+        d = mozdevice.DroidSUT("127.0.0.1", port=a.port)
+        buf = StringIO.StringIO()
+        d.getFile(remoteName, buf)
+        self.assertEqual(buf.getvalue(), cheeseburgers)
+        a.wait()
+
 if __name__ == '__main__':
     unittest.main()
 
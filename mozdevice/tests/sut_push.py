@@ -4,6 +4,7 @@ import unittest
 import hashlib
 import tempfile
 import os
+import shutil
 
 class PushTest(unittest.TestCase):
 
@@ -30,6 +31,23 @@ class PushTest(unittest.TestCase):
                 self.assertEqual(exceptionThrown, response[1])
             a.wait()
 
+    def test_push_large(self):
+        # larger than a single chunk, so the file gets streamed in pieces
+        pushfile = os.urandom(mozdevice.DroidSUT.push_chunk_size * 3 + 17)
+        mdsum = hashlib.md5()
+        mdsum.update(pushfile)
+
+        cmd = "push /mnt/sdcard/foobar %s" % len(pushfile)
+        a = MockAgent(self, commands = [("isdir /mnt/sdcard", "TRUE"),
+                                        (cmd, mdsum.hexdigest())])
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(pushfile)
+            f.flush()
+            d = mozdevice.DroidSUT("127.0.0.1", port=a.port)
+            d.pushFile(f.name, '/mnt/sdcard/foobar')
+        a.wait()
+        self.assertEqual(a.pushed_data, [pushfile])
+
     def test_push_dir(self):
         pushfile = "1234ABCD"
         mdsum = hashlib.md5()
@@ -44,21 +62,24 @@ class PushTest(unittest.TestCase):
         f.flush()
 
         subTests = [ { 'cmds': [ ("isdir /mnt/sdcard//baz", "TRUE"),
-                                 ("isdir /mnt/sdcard//baz", "TRUE"),
                                  ("push /mnt/sdcard//baz/%s %s" %
                                   (os.path.basename(f.name), len(pushfile)),
                                   expectedFileResponse) ],
                        'expectException': False },
                      { 'cmds': [ ("isdir /mnt/sdcard//baz", "TRUE"),
-                                 ("isdir /mnt/sdcard//baz", "TRUE"),
                                  ("push /mnt/sdcard//baz/%s %s" %
                                   (os.path.basename(f.name), len(pushfile)),
                                   "BADHASH") ],
                        'expectException': True },
                      { 'cmds': [ ("isdir /mnt/sdcard//baz", "FALSE"),
                                  ("isdir /mnt", "FALSE"),
+                                 ("isdir /mnt/sdcard", "FALSE"),
                                  ("mkdr /mnt",
-                                  "##AGENT-WARNING## Could not create the directory /mnt") ],
+                                  "##AGENT-WARNING## Could not create the directory /mnt"),
+                                 ("mkdr /mnt/sdcard",
+                                  "##AGENT-WARNING## Could not create the directory /mnt/sdcard"),
+                                 ("mkdr /mnt/sdcard/baz",
+                                  "##AGENT-WARNING## Could not create the directory /mnt/sdcard/baz") ],
                        'expectException': True },
 
                      ]
@@ -79,5 +100,57 @@ class PushTest(unittest.TestCase):
 
         # FIXME: delete directory when done
 
+    def test_push_dir_pipelined(self):
+        tempdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(tempdir, "bar"))
+        pushfiles = { "foo": "1234ABCD", os.path.join("bar", "baz"): "EFGH" }
+        hashes = {}
+        for (name, contents) in pushfiles.iteritems():
+            with open(os.path.join(tempdir, name), 'w') as f:
+                f.write(contents)
+            mdsum = hashlib.md5()
+            mdsum.update(contents)
+            hashes[name] = mdsum.hexdigest()
+
+        # the directory checks and the pushes are each sent in a single burst
+        cmds = [ ("isdir /mnt/sdcard/tests", "TRUE"),
+                 ("isdir /mnt/sdcard/tests//bar", "FALSE"),
+                 ("mkdr /mnt/sdcard/tests/bar",
+                  "/mnt/sdcard/tests/bar successfully created") ]
+        for root, dirs, files in os.walk(tempdir):
+            for name in files:
+                relpath = os.path.relpath(os.path.join(root, name), tempdir)
+                remoteRoot = "/mnt/sdcard/tests/" + root.split(tempdir)[1]
+                cmds.append(("push %s %s" % (os.path.join(remoteRoot, name),
+                                             len(pushfiles[relpath])),
+                             hashes[relpath]))
+
+        a = MockAgent(self, commands = cmds)
+        d = mozdevice.DroidSUT("127.0.0.1", port=a.port)
+        d.pushDir(tempdir, "/mnt/sdcard/tests")
+        a.wait()
+
+        shutil.rmtree(tempdir)
+
+    def test_validate_dir(self):
+        tempdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(tempdir, "bar"))
+        hashes = {}
+        for (name, contents) in [ ("foo", "1234ABCD"), ("bar/baz", "EFGH") ]:
+            with open(os.path.join(tempdir, *name.split('/')), 'w') as f:
+                f.write(contents)
+            hashes[name] = hashlib.md5(contents).hexdigest()
+
+        # all the hashes are fetched in a single burst
+        for (bazHash, expected) in [ (hashes["bar/baz"], True), ("", False) ]:
+            a = MockAgent(self, commands = [
+                    ("hash /mnt/sdcard/tests/foo", hashes["foo"]),
+                    ("hash /mnt/sdcard/tests/bar/baz", bazHash) ])
+            d = mozdevice.DroidSUT("127.0.0.1", port=a.port)
+            self.assertEqual(d.validateDir(tempdir, "/mnt/sdcard/tests"), expected)
+            a.wait()
+
+        shutil.rmtree(tempdir)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,145 @@
+from sut import MockAgent
+import mozdevice
+from mozdevice.devicemanager import NetworkTools
+from mozdevice import rebootmonitor
+import unittest
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+class RebootTest(unittest.TestCase):
+
+    def test_reboot_callback(self):
+        data = "127.0.0.1,30000\rrebooting\r"
+        port = NetworkTools().findOpenPort('127.0.0.1', 30000)
+        a = MockAgent(self, commands = [
+                ("push /data/data/com.mozilla.SUTAgentAndroid/files/update.info %s" %
+                 len(data), ""),
+                ("rebt 127.0.0.1 %s" % port, None)])
+        d = mozdevice.DroidSUT("127.0.0.1", port=a.port)
+        d.reboot_settling_time = 0
+        handle = d.rebootAsync(ipAddr='127.0.0.1')
+        a.wait()
+        self.assertFalse(handle.done())
+
+        # phone home like the agent does once it has restarted
+        s = socket.create_connection(('127.0.0.1', port))
+        s.sendall('hello')
+        self.assertEqual(s.recv(2), 'OK')
+        s.close()
+        self.assertTrue(handle.result(5))
+
+    def test_update_failed(self):
+        """Tests that the callback port is released when the update command
+        fails"""
+        port = NetworkTools().findOpenPort('127.0.0.1', 30000)
+        a = MockAgent(self, commands = [
+                ("updt '' /mnt/sdcard/app.apk 127.0.0.1 %s" % port,
+                 "##AGENT-WARNING## update failed")])
+        d = mozdevice.DroidSUT("127.0.0.1", port=a.port)
+        try:
+            d.updateApp('/mnt/sdcard/app.apk', ipAddr='127.0.0.1')
+            self.fail("updateApp did not fail")
+        except mozdevice.DMError:
+            # while the traceback still holds on to updateApp's frame, so
+            # the port isn't just freed by garbage collection
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.bind(('127.0.0.1', port))
+            s.listen(1)
+            s.close()
+        a.wait()
+
+    def test_agent_prompt(self):
+        def listen(port):
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind(('127.0.0.1', port))
+            server.listen(5)
+            return server
+
+        # the agent is still up just after being told to reboot...
+        server = listen(0)
+        port = server.getsockname()[1]
+        monitor = mozdevice.RebootMonitor(initialDelay=0.1, maxDelay=0.2)
+        handle = monitor.watch(rebootmonitor.AgentProbe('127.0.0.1', port), 10)
+        time.sleep(0.5)
+        self.assertFalse(handle.done())
+
+        # ...then goes away...
+        server.close()
+        time.sleep(0.5)
+        self.assertFalse(handle.done())
+
+        # ...and comes back
+        server = listen(port)
+        def serve():
+            (conn, _) = server.accept()
+            conn.sendall("$>\x00")
+            conn.close()
+        t = threading.Thread(target=serve)
+        t.start()
+        self.assertTrue(handle.result(5))
+        t.join()
+        server.close()
+
+    def test_no_backoff_until_down(self):
+        """Tests that a device which is still up is checked without backing
+        off, so that a quick reboot isn't missed"""
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        # the probe's connections are never accepted
+        server.listen(128)
+        monitor = mozdevice.RebootMonitor(initialDelay=0.05, maxDelay=30)
+        probe = rebootmonitor.AgentProbe('127.0.0.1', server.getsockname()[1])
+        handle = monitor.watch(probe, 10)
+        time.sleep(0.5)
+        self.assertFalse(probe.wentDown)
+        self.assertEqual(probe.delay, 0.05)
+
+        server.close()
+        time.sleep(0.5)
+        self.assertTrue(probe.wentDown)
+        self.assertTrue(probe.delay > 0.05)
+        monitor.finish(probe)
+
+    def test_timeout(self):
+        # several devices which never come back share one loop
+        monitor = mozdevice.RebootMonitor(initialDelay=0.1, maxDelay=0.2)
+        start = time.time()
+        handles = [monitor.watch(rebootmonitor.AgentProbe('127.0.0.1', 1), 0.5,
+                                 name='device%d' % i) for i in range(10)]
+        for handle in handles:
+            self.assertRaises(mozdevice.DMError, handle.result)
+            self.assertTrue(handle.error.startswith('timed out'))
+        self.assertTrue(time.time() - start < 2)
+
+    def test_adb(self):
+        # a stand-in for adb which reports the device as still up, then gone,
+        # then back but still booting, then booted
+        tempdir = tempfile.mkdtemp()
+        try:
+            script = os.path.join(tempdir, 'adb.py')
+            with open(script, 'w') as f:
+                f.write("""
+import os, sys
+counter = os.path.join(os.path.dirname(sys.argv[0]), 'count')
+count = int(open(counter).read()) if os.path.exists(counter) else 0
+open(counter, 'w').write(str(count + 1))
+if sys.argv[-1] == 'get-state':
+    print ['device', 'unknown', 'device'][min(count, 2)]
+else:
+    print '1' if count > 3 else ''
+""")
+            monitor = mozdevice.RebootMonitor(initialDelay=0.05, maxDelay=0.1)
+            handle = monitor.watch(rebootmonitor.ADBProbe([sys.executable, script]), 10)
+            self.assertTrue(handle.result(10))
+            self.assertEqual(open(os.path.join(tempdir, 'count')).read(), '5')
+        finally:
+            shutil.rmtree(tempdir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+# Any copyright is dedicated to the Public Domain.
+# http://creativecommons.org/publicdomain/zero/1.0/
+
+import mozdevice
+import time
+import unittest
+from sut import MockAgent
+
+class ResponseTest(unittest.TestCase):
+
+    def test_large_response(self):
+        """
+        Benchmarks reading multi-megabyte responses, which used to take
+        quadratic time.
+        """
+        for size in [ 1, 4, 16 ]:
+            line = "%s\n" % ("x" * 79)
+            contents = line * (size * 1024 * 1024 / len(line))
+            a = MockAgent(self, commands=[("cat /mnt/sdcard/big.log",
+                                           contents)])
+            d = mozdevice.DroidSUT("127.0.0.1", port=a.port)
+            start = time.time()
+            data = d.catFile("/mnt/sdcard/big.log")
+            elapsed = time.time() - start
+            a.wait()
+
+            self.assertEqual(data, contents)
+            print "read %dMB response in %.3fs (%.1fMB/s)" % \
+                (size, elapsed, size / max(elapsed, 0.001))
+
+    def test_split_prompt(self):
+        """
+        Tests responses whose prompt is split across several reads.
+        """
+        contents = "y" * 10000
+        a = MockAgent(self, commands=[("cat /mnt/sdcard/big.log", contents),
+                                      ("isdir /mnt/sdcard", "TRUE")])
+        d = mozdevice.DroidSUT("127.0.0.1", port=a.port)
+        d.recv_buffer_size = 2
+        self.assertEqual(d.catFile("/mnt/sdcard/big.log"), contents)
+        self.assertTrue(d.dirExists("/mnt/sdcard"))
+        a.wait()
+
+    def test_agent_warning(self):
+        a = MockAgent(self, commands=[("cat /mnt/sdcard/nonexistent",
+                                       "##AGENT-WARNING## no such file")])
+        d = mozdevice.DroidSUT("127.0.0.1", port=a.port)
+        exceptionThrown = False
+        try:
+            d.catFile("/mnt/sdcard/nonexistent")
+        except mozdevice.DMError, e:
+            exceptionThrown = True
+            self.assertTrue("no such file" in str(e))
+        self.assertTrue(exceptionThrown)
+        a.wait()
+
+    def test_pipelined_retry(self):
+        """
+        Tests that a burst retried after losing the connection part way
+        through doesn't repeat the responses received the first time.
+        """
+        a = MockAgent(self, commands=[("isdir /a", "TRUE"),
+                                      ("isdir /b", None),
+                                      ("isdir /a", "TRUE"),
+                                      ("isdir /b", "FALSE")])
+        d = mozdevice.DroidSUT("127.0.0.1", port=a.port)
+        self.assertEqual(d._runCmdsPipelined([{ 'cmd': "isdir /a" },
+                                              { 'cmd': "isdir /b" }],
+                                             retryLimit=2),
+                         ["TRUE", "FALSE"])
+        a.wait()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+from sut import MockAgent
+import mozdevice
+import hashlib
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+def pullResponse(remoteName, data):
+    return [("pull %s" % remoteName, "%s,%s\n%s" % (remoteName, len(data), data)),
+            ("hash %s" % remoteName, hashlib.md5(data).hexdigest())]
+
+def readPNG(filename):
+    """
+    Returns (width, height, rows of RGBA data) of a PNG written by _writePNG
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    assert data[:8] == '\x89PNG\r\n\x1a\n'
+    pos = 8
+    chunks = {}
+    while pos < len(data):
+        (length,) = struct.unpack("!I", data[pos:pos + 4])
+        tag = data[pos + 4:pos + 8]
+        chunk = data[pos + 8:pos + 8 + length]
+        (crc,) = struct.unpack("!I", data[pos + 8 + length:pos + 12 + length])
+        assert crc == 0xFFFFFFFF & zlib.crc32(tag + chunk)
+        chunks[tag] = chunks.get(tag, '') + chunk
+        pos += 12 + length
+    (width, height) = struct.unpack("!2I", chunks['IHDR'][:8])
+    raw = zlib.decompress(chunks['IDAT'])
+    rows = [raw[i + 1:i + 1 + width * 4] for i in range(0, len(raw), width * 4 + 1)]
+    return (width, height, rows)
+
+class ScreenshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_write_png(self):
+        (width, height) = (300, 200)
+        raw = os.urandom(width * height * 4)
+        filename = os.path.join(self.tempdir, 'out.png')
+        for level in [ 1, 9 ]:
+            rawfile = tempfile.TemporaryFile()
+            rawfile.write(raw)
+            rawfile.seek(0)
+            with open(filename, 'wb') as pngfile:
+                mozdevice.DroidSUT._writePNG(rawfile, pngfile, width, height, level)
+            self.assertEqual(readPNG(filename),
+                             (width, height, [raw[i:i + width * 4] for i in
+                                              range(0, len(raw), width * 4)]))
+
+    def test_screencap_png(self):
+        tmp = "/mnt/sdcard/tests/ss-dm.tmp"
+        png = "\x89PNG\r\n\x1a\nnot really a png"
+        a = MockAgent(self, commands=[("isdir /mnt/sdcard/tests", "TRUE"),
+                                      ("exec ls -ald /system/bin/screencap",
+                                       "-rwxr-xr-x root shell 5 2013-01-01 12:00 "
+                                       "/system/bin/screencap\nreturn code [0]"),
+                                      ("execsu /system/bin/screencap -p %s" % tmp,
+                                       "return code [0]"),
+                                      ("exec ls -ald %s" % tmp,
+                                       "-rw-rw-r-- root root 24 2013-01-01 12:00 "
+                                       "%s\nreturn code [0]" % tmp)] +
+                      pullResponse(tmp, png) +
+                      [("exec ls -ald %s" % tmp,
+                        "-rw-rw-r-- root root 24 2013-01-01 12:00 "
+                        "%s\nreturn code [0]" % tmp),
+                       ("rm %s" % tmp, "Removed the file")])
+        d = mozdevice.DroidSUT("127.0.0.1", port=a.port)
+        filename = os.path.join(self.tempdir, 'screen.png')
+        d.saveScreenshot(filename)
+        a.wait()
+        with open(filename, 'rb') as f:
+            self.assertEqual(f.read(), png)
+
+    def test_screencap_raw(self):
+        tmp = "/mnt/sdcard/tests/ss-dm.tmp"
+        (width, height) = (4, 3)
+        pixels = os.urandom(width * height * 4)
+        raw = struct.pack("III", width, height, 1) + pixels
+        a = MockAgent(self, commands=[("isdir /mnt/sdcard/tests", "TRUE"),
+                                      ("exec ls -ald /system/bin/screencap",
+                                       "-rwxr-xr-x root shell 5 2013-01-01 12:00 "
+                                       "/system/bin/screencap\nreturn code [0]"),
+                                      ("execsu /system/bin/screencap -p %s" % tmp,
+                                       "usage: screencap\nreturn code [1]"),
+                                      ("execsu sh -c '/system/bin/screencap > %s'" % tmp,
+                                       "return code [0]")] +
+                      pullResponse(tmp, raw) +
+                      [("exec ls -ald %s" % tmp,
+                        "-rw-rw-r-- root root 60 2013-01-01 12:00 "
+                        "%s\nreturn code [0]" % tmp),
+                       ("rm %s" % tmp, "Removed the file")])
+        d = mozdevice.DroidSUT("127.0.0.1", port=a.port)
+        filename = os.path.join(self.tempdir, 'screen.png')
+        d.saveScreenshot(filename)
+        a.wait()
+        self.assertEqual(readPNG(filename),
+                         (width, height, [pixels[i:i + width * 4] for i in
+                                          range(0, len(pixels), width * 4)]))
+
+if __name__ == '__main__':
+    unittest.main()
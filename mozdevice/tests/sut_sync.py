@@ -0,0 +1,77 @@
+from sut import MockAgent
+import mozdevice
+import unittest
+import hashlib
+import tempfile
+import os
+import shutil
+
+def _md5(data):
+    mdsum = hashlib.md5()
+    mdsum.update(data)
+    return mdsum.hexdigest()
+
+class SyncTest(unittest.TestCase):
+
+    def test_sync_dir(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(tempdir, "sub"))
+            with open(os.path.join(tempdir, "a.txt"), "w") as f:
+                f.write("aaa")
+            with open(os.path.join(tempdir, "sub", "b.txt"), "w") as f:
+                f.write("bbb")
+
+            # a.txt is up to date, sub/b.txt has changed and old.txt is stale
+            listing = "\n".join([
+                "-rw-rw-r-- system sdcard_rw 3 2013-01-01 12:00 a.txt",
+                "-rw-rw-r-- system sdcard_rw 3 2013-01-01 12:00 old.txt",
+                "drwxrwxr-x system sdcard_rw 2013-01-01 12:00 sub",
+                "",
+                "/mnt/sdcard/sync/sub:",
+                "-rw-rw-r-- system sdcard_rw 3 2013-01-01 12:00 b.txt",
+                "return code [0]"])
+            a = MockAgent(self, commands = [("exec ls -alR /mnt/sdcard/sync", listing),
+                                            ("hash /mnt/sdcard/sync/a.txt", _md5("aaa")),
+                                            ("hash /mnt/sdcard/sync/old.txt", _md5("old")),
+                                            ("hash /mnt/sdcard/sync/sub/b.txt", _md5("old")),
+                                            ("isdir /mnt/sdcard/sync/sub", "TRUE"),
+                                            ("push /mnt/sdcard/sync/sub/b.txt 3", _md5("bbb")),
+                                            ("rm /mnt/sdcard/sync/old.txt", "")])
+            d = mozdevice.DroidSUT("127.0.0.1", port=a.port)
+            stats = d.syncDir(tempdir, "/mnt/sdcard/sync/", deleteStale=True)
+            a.wait()
+
+            self.assertEqual(a.pushed_data, ["bbb"])
+            self.assertEqual(stats, { 'filesSent': 1, 'bytesSent': 3,
+                                      'filesSkipped': 1, 'bytesSkipped': 3,
+                                      'filesDeleted': 1 })
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_sync_dir_new(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tempdir, "a.txt"), "w") as f:
+                f.write("aaa")
+
+            # nothing on the device yet, so everything gets pushed
+            a = MockAgent(self, commands = [("exec ls -alR /mnt/sdcard/sync",
+                                             "/mnt/sdcard/sync: No such file or directory\n"
+                                             "return code [1]"),
+                                            ("isdir /mnt/sdcard/sync", "FALSE"),
+                                            ("isdir /mnt", "TRUE"),
+                                            ("isdir /mnt/sdcard", "TRUE"),
+                                            ("mkdr /mnt/sdcard/sync", ""),
+                                            ("push /mnt/sdcard/sync/a.txt 3", _md5("aaa"))])
+            d = mozdevice.DroidSUT("127.0.0.1", port=a.port)
+            stats = d.syncDir(tempdir, "/mnt/sdcard/sync")
+            a.wait()
+
+            self.assertEqual(stats['filesSent'], 1)
+            self.assertEqual(stats['filesSkipped'], 0)
+        finally:
+            shutil.rmtree(tempdir)
+
+if __name__ == '__main__':
+    unittest.main()
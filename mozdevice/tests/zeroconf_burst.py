@@ -0,0 +1,153 @@
+from mozdevice.Zeroconf import Zeroconf, ServiceBrowser, DNSOutgoing, \
+    DNSPointer, DNSService, DNSText, DNSAddress, currentTimeMillis, \
+    _FLAGS_QR_RESPONSE, _FLAGS_AA, _TYPE_PTR, _TYPE_SRV, _TYPE_TXT, \
+    _TYPE_A, _TYPE_ANY, _CLASS_IN, _MDNS_PORT
+import socket
+import sys
+import threading
+import time
+import unittest
+
+SERVICE_TYPE = "_sutagent._tcp.local."
+
+def announcement(i, ttl=120):
+    """Returns the packet an agent sends to announce itself, as in a
+    burst of announcements from a rack of devices coming up at once"""
+    ip = "10.0.%d.%d" % (i / 250, i % 250 + 1)
+    name = "SUTAgent [hwid:%016x] [ip:%s].%s" % (i, ip.replace('.', '_'), SERVICE_TYPE)
+    server = "agent%d.local." % i
+    out = DNSOutgoing(_FLAGS_QR_RESPONSE | _FLAGS_AA)
+    out.addAnswerAtTime(DNSPointer(SERVICE_TYPE, _TYPE_PTR, _CLASS_IN, ttl, name), 0)
+    out.addAnswerAtTime(DNSService(name, _TYPE_SRV, _CLASS_IN, ttl, 0, 0, 20701, server), 0)
+    out.addAnswerAtTime(DNSText(name, _TYPE_TXT, _CLASS_IN, ttl, '\x00'), 0)
+    out.addAnswerAtTime(DNSAddress(server, _TYPE_A, _CLASS_IN, ttl, socket.inet_aton(ip)), 0)
+    return (name, out.packet())
+
+class Listener(object):
+
+    def __init__(self, expected):
+        self.added = set()
+        self.removed = set()
+        self.expected = expected
+        self.done = threading.Event()
+
+    def addService(self, zeroconf, type, name):
+        self.added.add(name)
+        if len(self.added) == self.expected:
+            self.done.set()
+
+    def removeService(self, zeroconf, type, name):
+        self.removed.add(name)
+        if len(self.removed) == self.expected:
+            self.done.set()
+
+def replay(zc, packets, repeat=1):
+    """Feeds packets to zc as if they had arrived from the network, and
+    returns how long that took"""
+    start = time.time()
+    for i in range(repeat):
+        for packet in packets:
+            zc.handlePacket(packet, "10.0.0.1", _MDNS_PORT)
+    return time.time() - start
+
+class ZeroconfBurstTest(unittest.TestCase):
+
+    def setUp(self):
+        self.zc = Zeroconf('127.0.0.1')
+
+    def tearDown(self):
+        self.zc.close()
+
+    def test_burst(self):
+        count = 200
+        announcements = [announcement(i) for i in range(count)]
+        listener = Listener(count)
+        browser = ServiceBrowser(self.zc, SERVICE_TYPE, listener)
+
+        # the same burst again only refreshes what's already cached
+        replay(self.zc, [packet for (name, packet) in announcements], repeat=2)
+        self.assertTrue(listener.done.wait(5))
+        self.assertEqual(listener.added, set(name for (name, packet) in announcements))
+        self.assertEqual(len(self.zc.cache.entries()), count * 4)
+
+        name = announcements[7][0]
+        self.assertEqual(len(self.zc.cache.entriesWithName(name)), 2)
+        srv = self.zc.cache.getByDetails(name, _TYPE_SRV, _CLASS_IN)
+        self.assertEqual(srv.server, "agent7.local.")
+        self.assertEqual(self.zc.cache.getByDetails(name, _TYPE_ANY, _CLASS_IN), None)
+        browser.cancel()
+
+    def test_expiry(self):
+        count = 20
+        announcements = [announcement(i, ttl=1) for i in range(count)]
+        listener = Listener(count)
+        ServiceBrowser(self.zc, SERVICE_TYPE, listener)
+        replay(self.zc, [packet for (name, packet) in announcements])
+        self.assertTrue(listener.done.wait(5))
+
+        # the engine reaps the entries when their TTL runs out, without
+        # having to be woken
+        listener.done.clear()
+        self.assertTrue(listener.done.wait(5))
+        self.assertEqual(listener.removed, listener.added)
+        self.assertEqual(self.zc.cache.entries(), [])
+        self.assertEqual(self.zc.cache.expire(currentTimeMillis() + 10000), [])
+
+    def test_blocking_listener(self):
+        """Tests that a listener calling getServiceInfo() doesn't hold up
+        the engine while it waits for an answer"""
+        class BlockingListener(object):
+            def __init__(self):
+                self.called = threading.Event()
+                self.answered = threading.Event()
+
+            def addService(self, zeroconf, type, name):
+                self.called.set()
+                zeroconf.getServiceInfo(type, "nothere." + type, timeout=2000)
+                self.answered.set()
+
+            def removeService(self, zeroconf, type, name):
+                pass
+
+        class Timer(object):
+            def __init__(self):
+                self.fired = threading.Event()
+
+            def handle_timer(self, now):
+                self.fired.set()
+                return None
+
+        listener = BlockingListener()
+        browser = ServiceBrowser(self.zc, SERVICE_TYPE, listener)
+        replay(self.zc, [announcement(0)[1]])
+        self.assertTrue(listener.called.wait(5))
+
+        timer = Timer()
+        self.zc.engine.addTimer(timer)
+        self.assertTrue(timer.fired.wait(1))
+        self.assertFalse(listener.answered.is_set())
+        self.assertTrue(listener.answered.wait(5))
+        browser.cancel()
+
+def benchmark(count):
+    zc = Zeroconf('127.0.0.1')
+    try:
+        listener = Listener(count)
+        ServiceBrowser(zc, SERVICE_TYPE, listener)
+        packets = [packet for (name, packet) in
+                   [announcement(i) for i in range(count)]]
+        first = replay(zc, packets)
+        listener.done.wait(30)
+        again = replay(zc, packets)
+        print "%d announcements: %.1f ms (%.1f us each), " \
+            "repeated: %.1f ms, services seen: %d" % \
+            (count, first * 1000, first * 1000000 / count, again * 1000,
+             len(listener.added))
+    finally:
+        zc.close()
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == '--benchmark':
+        benchmark(int(sys.argv[2]))
+    else:
+        unittest.main()